@@ -0,0 +1,139 @@
+"""Admission control of password hashing, so that overloaded workers shed load quickly.
+
+bcrypt is the bulk of the work of logins and signups. Under a spike, requests would otherwise
+pile up in front of the hashing pool until clients time out, and the pool would keep hashing
+passwords for clients which already gave up. Instead, in each server worker:
+
+    - at most max_in_flight hashes run at once
+    - at most max_queue requests wait for their turn, first come first served
+    - a request which cannot wait, or waits for longer than queue_timeout, gets a 503 with a
+      Retry-After header, before any hashing
+
+The time an admitted request spends waiting is thus bounded by queue_timeout.
+"""
+import asyncio
+import math
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import HTTPException
+
+import config
+from metrics import HASH_QUEUED, HASH_SHED, stage
+
+
+class AdmissionController:
+    """Limits the concurrent hashes of this server worker, with a bounded wait queue"""
+
+    def __init__(
+        self,
+        max_in_flight: int = None,
+        max_queue: int = None,
+        queue_timeout: float = None,
+    ):
+        self.max_in_flight = (
+            config.AUTH_HASH_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        )
+        self.max_queue = config.AUTH_HASH_MAX_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = (
+            config.AUTH_HASH_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        )
+        self.in_flight = 0
+        # Futures of the waiting requests, resolved when a slot is handed over to them
+        self._waiters = deque()
+
+        self.admitted = 0
+        self.shed = Counter()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.queue_timeout))
+
+    def _reject(self, scope: str, reason: str) -> HTTPException:
+        self.shed[reason] += 1
+        HASH_SHED.labels(scope, reason).inc()
+        return HTTPException(
+            status_code=503,
+            detail="Server overloaded, try again later",
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    async def acquire(self, scope: str):
+        """Wait for a hashing slot, or raise a 503 error"""
+
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject(scope, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        HASH_QUEUED.inc()
+        try:
+            with stage("hash_admission.wait"):
+                await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # The slot was handed over just as the wait ended: pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(scope, "timeout")
+            raise
+        finally:
+            HASH_QUEUED.dec()
+        self.admitted += 1
+
+    def release(self):
+        """Hand the slot over to the oldest waiting request, if any"""
+
+        if self._waiters:
+            # in_flight is unchanged: the slot goes straight to the waiter
+            self._waiters.popleft().set_result(None)
+        else:
+            self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, scope: str):
+        """Run the enclosed block in a hashing slot. Admits everything when disabled"""
+
+        if self.max_in_flight <= 0:
+            yield
+            return
+
+        await self.acquire(scope)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+        }
+
+
+_hash_admission: Optional[AdmissionController] = None
+
+
+def get_hash_admission() -> AdmissionController:
+    global _hash_admission
+
+    if _hash_admission is None:
+        _hash_admission = AdmissionController()
+    return _hash_admission
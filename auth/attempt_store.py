@@ -0,0 +1,164 @@
+"""Stores for pending login attempts, i.e. logins waiting for the OTP check.
+
+Attempts are only meaningful for AUTH_OTP_THRESHOLD_SECONDS, so each backend expires them natively:
+
+    - "sql": the login_attempt table, through crud
+    - "memory": an in-process TTL/LRU map; only correct with a single server worker
+    - "redis": keys with a TTL on REDIS_URL, shared by all server workers
+"""
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+import config
+from kv.redis_client import get_redis
+from sql import crud
+from sql.database import DBSession
+from sql.models import User, make_identifier
+
+
+class AttemptRecord:
+    """A pending login attempt, with what is needed to check its OTP"""
+
+    __slots__ = ("identifier", "user_id", "secret")
+
+    def __init__(self, identifier: str, user_id: int, secret: str):
+        self.identifier = identifier
+        self.user_id = user_id
+        self.secret = secret
+
+
+class AttemptStore(ABC):
+    """Base class for login attempt stores"""
+
+    def __init__(self, ttl: int = None):
+        self.ttl = ttl or config.AUTH_OTP_THRESHOLD_SECONDS
+
+    @abstractmethod
+    async def create(self, db: DBSession, db_user: User) -> str:
+        """Save a new login attempt for the given user and return its identifier.
+
+        SQL writes are left pending in the session transaction: the caller must commit.
+        """
+
+    @abstractmethod
+    async def consume(self, db: DBSession, identifier: str) -> Optional[AttemptRecord]:
+        """Atomically remove and return the login attempt with the given identifier.
+
+        Return None if it is missing, expired or already consumed: an attempt is consumed
+        at most once, even by concurrent requests.
+        SQL writes are left pending in the session transaction: the caller must commit.
+        """
+
+
+class SQLAttemptStore(AttemptStore):
+    """Login attempts stored in the login_attempt table"""
+
+    async def create(self, db: DBSession, db_user: User) -> str:
+        return await crud.create_login_attempt(db=db, db_user=db_user, commit=False)
+
+    async def consume(self, db: DBSession, identifier: str) -> Optional[AttemptRecord]:
+        # Expiry and consumption are checked by the query
+        row = await crud.consume_login_attempt(db, identifier)
+        if not row:
+            return None
+        return AttemptRecord(identifier, row.user_id, row.secret)
+
+
+class MemoryAttemptStore(AttemptStore):
+    """Login attempts kept in this process, bounded to max_size entries.
+
+    Entries share the same TTL, so insertion order is also expiry order:
+    expired entries are dropped from the oldest end, and the oldest entries are evicted when full.
+    """
+
+    def __init__(self, ttl: int = None, max_size: int = None):
+        super().__init__(ttl)
+        self.max_size = max_size or config.LOGIN_ATTEMPT_STORE_MAX_SIZE
+        self._entries = OrderedDict()
+
+    def _purge(self, now: float):
+        while self._entries:
+            expires_at, _ = next(iter(self._entries.values()))
+            if expires_at > now and len(self._entries) < self.max_size:
+                break
+            self._entries.popitem(last=False)
+
+    async def create(self, db: DBSession, db_user: User) -> str:
+        now = time.monotonic()
+        self._purge(now)
+
+        identifier = make_identifier()
+        record = AttemptRecord(identifier, db_user.id, db_user.secret)
+        self._entries[identifier] = (now + self.ttl, record)
+        return identifier
+
+    async def consume(self, db: DBSession, identifier: str) -> Optional[AttemptRecord]:
+        entry = self._entries.pop(identifier, None)
+        if entry is None:
+            return None
+
+        expires_at, record = entry
+        if expires_at <= time.monotonic():
+            return None
+        return record
+
+
+class RedisAttemptStore(AttemptStore):
+    """Login attempts stored as Redis keys expiring after the TTL"""
+
+    key_prefix = "login_attempt:"
+
+    def __init__(self, ttl: int = None, client=None):
+        super().__init__(ttl)
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or get_redis()
+
+    async def create(self, db: DBSession, db_user: User) -> str:
+        identifier = make_identifier()
+        value = json.dumps({"user_id": db_user.id, "secret": db_user.secret})
+        await self.client.set(self.key_prefix + identifier, value, ex=self.ttl)
+        return identifier
+
+    async def consume(self, db: DBSession, identifier: str) -> Optional[AttemptRecord]:
+        # GET and DEL in a MULTI transaction: atomic, in one round trip, on any Redis version
+        key = self.key_prefix + identifier
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.get(key)
+        pipeline.delete(key)
+        value, _ = await pipeline.execute()
+        if value is None:
+            return None
+
+        value = json.loads(value)
+        return AttemptRecord(identifier, value["user_id"], value["secret"])
+
+
+ATTEMPT_STORES = {
+    "sql": SQLAttemptStore,
+    "memory": MemoryAttemptStore,
+    "redis": RedisAttemptStore,
+}
+
+if config.LOGIN_ATTEMPT_STORE == "memory" and config.WEB_CONCURRENCY > 1:
+    # The OTP check would fail whenever another server worker handles it
+    raise ValueError(
+        "LOGIN_ATTEMPT_STORE=memory is per server worker: use sql or redis with several workers"
+    )
+
+_attempt_store: Optional[AttemptStore] = None
+
+
+def get_attempt_store() -> AttemptStore:
+    """Return the login attempt store selected by LOGIN_ATTEMPT_STORE"""
+
+    global _attempt_store
+
+    if _attempt_store is None:
+        _attempt_store = ATTEMPT_STORES[config.LOGIN_ATTEMPT_STORE]()
+    return _attempt_store
@@ -0,0 +1,385 @@
+"""Bulk import of users migrated from other forums.
+
+Users are read from JSONL or CSV (with a header line), one user per line, with these fields:
+
+    - email: string, the user email address
+    - password: string, the plain text password, hashed during the import
+    - hashed_password: string, an already hashed bcrypt password, stored as is
+    - two_factor_enabled: boolean, optional, false by default
+
+Exactly one of password and hashed_password must be given.
+
+Users are processed in chunks: emails already registered are skipped with a single query,
+plain passwords are hashed in parallel in a process pool of the import, separate from the one
+of logins and signups, and the rest is inserted with multi-row INSERTs, committed once per chunk.
+A report is produced for every chunk.
+
+Usage:
+
+    python -m auth.bulk_import users.jsonl [--format csv] [--chunk-size 1000] [--hash-workers 8]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import AsyncIterator, Iterable, List, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import config
+from auth.otp import TOTPManager
+from auth.pwd.pwd_context import get_password_hash, pwd_context
+from sql import crud, schemas
+from sql.database import (
+    AsyncSessionLocal,
+    DBSession,
+    SessionLocal,
+    db_close,
+    db_commit,
+    db_rollback,
+)
+from sql.user_cache import invalidate_user
+
+FORMATS = ("jsonl", "csv")
+
+TRUE_VALUES = ("1", "true", "yes")
+
+
+class ChunkReport:
+    """Outcome of the import of a single chunk"""
+
+    def __init__(self, index: int, first_line: int):
+        self.index = index
+        self.first_line = first_line
+        self.received = 0
+        self.inserted = 0
+        self.already_registered = 0
+        self.duplicates = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    def add_error(self, line: int, message: str):
+        self.errors.append({"line": line, "error": message})
+
+    def as_dict(self) -> dict:
+        return {
+            "chunk": self.index,
+            "first_line": self.first_line,
+            "received": self.received,
+            "inserted": self.inserted,
+            "already_registered": self.already_registered,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+async def aiter_lines(lines: Iterable[str]) -> AsyncIterator[str]:
+    for line in lines:
+        yield line
+
+
+async def aread_lines(file, size_hint: int = 1 << 16) -> AsyncIterator[str]:
+    """Lines of a blocking text file, read in batches in the threadpool"""
+
+    while True:
+        lines = await run_in_threadpool(file.readlines, size_hint)
+        if not lines:
+            return
+        for line in lines:
+            yield line
+
+
+class _LineFeed:
+    """Input of a csv.reader, fed with the lines of a single record at a time"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def iter_csv_records(lines: AsyncIterator[str]):
+    """Parse the input lines with a single CSV reader.
+
+    Yield (first line number, values, error message) for each record: a record spans several
+    lines when its quoted fields contain newlines, i.e. until its quotes are balanced.
+    """
+
+    feed = _LineFeed()
+    reader = csv.reader(feed)
+    line_number = 0
+    first_line, quotes = None, 0
+
+    async for line in lines:
+        line_number += 1
+        if first_line is None:
+            first_line = line_number
+        feed.lines.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            # Inside a quoted field, which goes on with the next line
+            continue
+
+        try:
+            yield first_line, next(reader), None
+        except csv.Error as e:
+            feed.lines.clear()
+            yield first_line, None, str(e)
+        first_line, quotes = None, 0
+
+    if feed.lines:
+        # A quoted field left open at the end of the input
+        try:
+            yield first_line, next(reader), None
+        except csv.Error as e:
+            yield first_line, None, str(e)
+
+
+async def iter_rows(lines: AsyncIterator[str], fmt: str):
+    """Parse the input lines. Yield (line number, fields, error message) for each user"""
+
+    if fmt == "csv":
+        header = None
+        async for line_number, values, error in iter_csv_records(lines):
+            if error:
+                yield line_number, None, error
+            elif not values:
+                # Blank line
+                continue
+            elif header is None:
+                header = [value.strip() for value in values]
+            elif len(values) != len(header):
+                yield line_number, None, f"expected {len(header)} fields"
+            else:
+                yield line_number, dict(zip(header, values)), None
+        return
+
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+
+        try:
+            fields = json.loads(line)
+            if not isinstance(fields, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            yield line_number, None, str(e)
+            continue
+
+        yield line_number, fields, None
+
+
+def validate_user(fields: dict) -> dict:
+    """Return the user described by the given fields, or raise ValueError"""
+
+    email = fields.get("email")
+    if not isinstance(email, str) or "@" not in email:
+        raise ValueError("invalid email")
+
+    password = fields.get("password") or None
+    hashed_password = fields.get("hashed_password") or None
+    if bool(password) == bool(hashed_password):
+        raise ValueError("exactly one of password and hashed_password is required")
+    if (
+        hashed_password
+        and pwd_context.identify(hashed_password, required=False) != "bcrypt"
+    ):
+        raise ValueError("hashed_password is not a bcrypt hash")
+
+    two_factor_enabled = fields.get("two_factor_enabled", False)
+    if isinstance(two_factor_enabled, str):
+        two_factor_enabled = two_factor_enabled.strip().lower() in TRUE_VALUES
+
+    return {
+        "email": schemas.clean_email(email),
+        "password": password,
+        "hashed_password": hashed_password,
+        "two_factor_enabled": bool(two_factor_enabled),
+    }
+
+
+async def import_chunk(
+    db: DBSession,
+    report: ChunkReport,
+    rows: List[Tuple[int, dict]],
+    hash_pool: Executor,
+):
+    """Insert the valid users of a chunk, filling in its report"""
+
+    # The first occurrence of an email in the chunk wins
+    unique = {}
+    for line, user in rows:
+        if user["email"] in unique:
+            report.duplicates += 1
+            report.add_error(line, "duplicate email in chunk")
+        else:
+            unique[user["email"]] = user
+
+    if not unique:
+        return
+
+    registered = await crud.get_registered_emails(db, list(unique))
+    report.already_registered = len(registered)
+    pending = [user for email, user in unique.items() if email not in registered]
+
+    # End the read transaction, so that no connection is held while bcrypt runs
+    await db_commit(db)
+
+    # Hash plain passwords in parallel, across the process pool of the import
+    to_hash = [user for user in pending if user["password"]]
+    loop = asyncio.get_running_loop()
+    hashes = await asyncio.gather(
+        *(
+            loop.run_in_executor(hash_pool, get_password_hash, user["password"])
+            for user in to_hash
+        )
+    )
+    for user, hashed_password in zip(to_hash, hashes):
+        user["hashed_password"] = hashed_password
+
+    users = [
+        {
+            "email": user["email"],
+            "hashed_password": user["hashed_password"],
+            "two_factor_enabled": user["two_factor_enabled"],
+            "secret": TOTPManager.generate_secret(),
+        }
+        for user in pending
+    ]
+    # Emails registered meanwhile are skipped by the insert, and not counted
+    report.inserted = await crud.create_users(db, users)
+    await db_commit(db)
+
+    # Drop negative entries, in every server worker when invalidation is enabled
+    for user in users:
+        await invalidate_user(user["email"])
+
+
+async def import_users(
+    lines: AsyncIterator[str],
+    fmt: str = "jsonl",
+    chunk_size: int = None,
+    db_factory=None,
+    hash_workers: int = None,
+) -> AsyncIterator[ChunkReport]:
+    """Import users from the given lines, yielding the report of each chunk once committed.
+
+    Passwords are hashed in a process pool of hash_workers processes, created for the import:
+    the import never queues in front of the hashing of logins and signups.
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, expected one of {', '.join(FORMATS)}")
+
+    chunk_size = chunk_size or config.BULK_IMPORT_CHUNK_SIZE
+    db_factory = db_factory or (
+        AsyncSessionLocal if config.SQLALCHEMY_ASYNC else SessionLocal
+    )
+
+    hash_pool = ProcessPoolExecutor(
+        max_workers=hash_workers or config.BULK_IMPORT_HASH_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+    async def flush(report, rows):
+        start = time.perf_counter()
+        db = db_factory()
+        try:
+            await import_chunk(db, report, rows, hash_pool)
+        except Exception as e:
+            await db_rollback(db)
+            report.inserted = 0
+            report.add_error(report.first_line, f"chunk not imported: {e}")
+        finally:
+            await db_close(db)
+        report.seconds = time.perf_counter() - start
+        return report
+
+    try:
+        index = 0
+        report, rows = None, []
+        async for line, fields, error in iter_rows(lines, fmt):
+            if report is None:
+                report = ChunkReport(index, line)
+
+            report.received += 1
+            if error:
+                report.add_error(line, error)
+            else:
+                try:
+                    rows.append((line, validate_user(fields)))
+                except ValueError as e:
+                    report.add_error(line, str(e))
+
+            if report.received >= chunk_size:
+                yield await flush(report, rows)
+                index += 1
+                report, rows = None, []
+
+        if report is not None:
+            yield await flush(report, rows)
+    finally:
+        # Idle processes exit right away, busy ones once their hash is done
+        hash_pool.shutdown(wait=False)
+
+
+async def run(path: str, fmt: str, chunk_size: int = None, hash_workers: int = None):
+    """Import users from a file, printing a JSON report line per chunk on stdout"""
+
+    totals = {"received": 0, "inserted": 0, "already_registered": 0, "errors": 0}
+    start = time.perf_counter()
+
+    source = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        async for report in import_users(
+            aread_lines(source), fmt, chunk_size, hash_workers=hash_workers
+        ):
+            print(json.dumps(report.as_dict()), flush=True)
+            totals["received"] += report.received
+            totals["inserted"] += report.inserted
+            totals["already_registered"] += report.already_registered
+            totals["errors"] += len(report.errors)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+    totals["seconds"] = round(time.perf_counter() - start, 3)
+    print(json.dumps(totals), file=sys.stderr)
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import users from JSONL or CSV")
+    parser.add_argument("path", help="file to import, - for stdin")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--chunk-size", type=int, default=config.BULK_IMPORT_CHUNK_SIZE)
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=None,
+        help="processes hashing plain passwords (default: BULK_IMPORT_HASH_WORKERS)",
+    )
+    args = parser.parse_args(argv)
+
+    totals = asyncio.run(
+        run(args.path, args.format, args.chunk_size, args.hash_workers)
+    )
+    return 1 if totals["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
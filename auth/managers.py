@@ -2,35 +2,57 @@ from typing import Optional
 
 from fastapi import HTTPException
 
+from auth.admission import get_hash_admission
+from auth.attempt_store import AttemptRecord, get_attempt_store
 from auth.exceptions import InvalidUserCredentials, AlreadyRegisteredUser
 from auth.otp import TOTPManager
-from auth.pwd.pwd_context import verify_password
+from auth.pwd.pwd_context import (
+    hash_cost,
+    hash_password_async,
+    verify_and_update_password_async,
+)
+from auth.results import UserSessionResult
+from metrics import PASSWORD_REHASHED, PASSWORD_VERIFIED, stage
 from sql import crud
-from sql.models import User, LoginAttempt
-from sql.schemas import UserCreate, UserSession, UserLogin
-from sqlalchemy.orm import Session
+from sql.database import DBSession, db_commit, db_rollback
+from sql.login_events import get_login_events
+from sql.models import User
+from sql.user_cache import UserRecord, cache_user
+from sql.schemas import UserCreate, UserLogin
 
 
 class LoginAttemptManager:
     """Manager for the login attempt. Used to save a new login attempt and activate a new user session"""
 
     @staticmethod
-    def generate_user_session(db: Session, db_user: User):
-        """Generate a new user session and provide login identifier and OTP code, to be used for 2FA, if enabled"""
+    async def generate_user_session(db: DBSession, db_user: User):
+        """Generate a new user session and provide login identifier and OTP code, to be used for 2FA, if enabled.
 
-        login_attempt = crud.create_login_attempt(db=db, db_user=db_user)
+        Without 2FA, no attempt is saved. Commits the session, together with any write still pending in it.
+        """
 
-        otp_code = None
         if db_user.two_factor_enabled:
-            otp_code = TOTPManager(user_secret=db_user.secret).generate_otp()
-
-        user_session = UserSession(
-            email=db_user.email,
-            id=db_user.id,
-            two_factor_enabled=db_user.two_factor_enabled,
-            login_identifier=login_attempt.identifier,
-            otp_code=otp_code,
-        )
+            with stage("attempt_store.create"):
+                login_identifier = await get_attempt_store().create(
+                    db=db, db_user=db_user
+                )
+                await db_commit(db)
+
+            with stage("generate_otp"):
+                otp_code = TOTPManager(user_secret=db_user.secret).generate_otp()
+        else:
+            login_identifier = otp_code = None
+            # No DB round trip unless the caller left writes pending, e.g. signup
+            await db_commit(db)
+
+        with stage("build_user_session"):
+            user_session = UserSessionResult(
+                email=db_user.email,
+                two_factor_enabled=db_user.two_factor_enabled,
+                id=db_user.id,
+                login_identifier=login_identifier,
+                otp_code=otp_code,
+            )
 
         return user_session
 
@@ -39,18 +61,38 @@ class LoginManager:
     """Manager for the login process. Utilizes two-step TOTP checking"""
 
     @staticmethod
-    def authenticate(db: Session, user: UserLogin) -> Optional[User]:
-        """Fetches the user from DB and validates password"""
+    async def authenticate(db: DBSession, user: UserLogin) -> Optional[UserRecord]:
+        """Fetches the user from DB and validates password, rehashing it if the cost changed"""
+
+        db_user = await crud.get_user_by_email(db, email=user.email)
+        if not db_user:
+            return None
+
+        # End the read transaction, so that no connection is held while bcrypt runs
+        await db_commit(db)
 
-        db_user = crud.get_user_by_email(db, email=user.email)
-        if not db_user or not verify_password(user.password, db_user.hashed_password):
+        # Sheds the request with a 503 when too many hashes are already running or waiting
+        async with get_hash_admission().admit("login"):
+            with stage("verify_password"):
+                verified, new_hash = await verify_and_update_password_async(
+                    user.password, db_user.hashed_password
+                )
+        if not verified:
             return None
+
+        cost = hash_cost(db_user.hashed_password)
+        PASSWORD_VERIFIED.labels(cost).inc()
+        if new_hash:
+            # The hashing policy changed: persist the hash computed with the new cost
+            with stage("rehash_password"):
+                db_user = await crud.update_password_hash(db, db_user, new_hash)
+            PASSWORD_REHASHED.labels(cost, hash_cost(new_hash)).inc()
         return db_user
 
-    def login(self, db: Session, user: UserLogin) -> UserSession:
+    async def login(self, db: DBSession, user: UserLogin) -> UserSessionResult:
         """Tries to log the user in"""
 
-        db_user = self.authenticate(db, user)
+        db_user = await self.authenticate(db, user)
         if not db_user:
             # raise InvalidUserCredentials
             raise HTTPException(
@@ -58,43 +100,82 @@ class LoginManager:
                 detail="No user can be found matching provided credentials",
             )
 
-        return LoginAttemptManager.generate_user_session(db=db, db_user=db_user)
+        user_session = await LoginAttemptManager.generate_user_session(
+            db=db, db_user=db_user
+        )
+        if not db_user.two_factor_enabled:
+            # The login saved no attempt: record it as an audit event, written in the background
+            get_login_events().record(crud.email_shard(db, db_user.email), db_user.id)
+        return user_session
 
     @staticmethod
-    def verify_otp(db: Session, identifier, otp_code):
-        """Verifies OTP for a single login attempt"""
-
-        attempt = db.query(LoginAttempt).filter_by(identifier=identifier).first()
-        conditions = [
-            attempt,
-            attempt.is_valid(),
-            TOTPManager(user_secret=attempt.user.secret).validate_otp(otp_code),
-        ]
-        if not all(conditions):
+    async def verify_otp(db: DBSession, identifier, otp_code) -> AttemptRecord:
+        """Verifies OTP for a single login attempt, and returns the consumed attempt.
+
+        The attempt is consumed by the check, so that an OTP is accepted at most once,
+        and a wrong OTP cannot be retried on the same attempt. A code already accepted
+        for the user is rejected too, even on another attempt.
+        """
+
+        with stage("attempt_store.consume"):
+            attempt = await get_attempt_store().consume(db, identifier)
+            await db_commit(db)
+
+        with stage("validate_otp"):
+            valid = attempt and TOTPManager(user_secret=attempt.secret).validate_otp(
+                otp_code, user_id=attempt.user_id
+            )
+        if not valid:
             # raise InvalidOTP
             raise HTTPException(status_code=401, detail="Invalid OTP received")
-        return True
+        return attempt
 
 
 class SignupManager:
     """Manager for the signup process. Utilizes two-step TOTP checking"""
 
     @staticmethod
-    def check_email(db: Session, user: UserCreate):
-        """Check that the provided email has not been already used"""
+    async def check_email(db: DBSession, user: UserCreate):
+        """Check that the provided email is not already used, to avoid hashing for it.
 
-        db_user = crud.get_user_by_email(db, email=user.email)
+        Looked up through the user cache, which keeps the result: the insert in signup
+        is what guarantees uniqueness, e.g. against concurrent signups.
+        """
 
         # Check if provided email is already registered
-        if db_user:
-            # raise AlreadyRegisteredUser
-            raise HTTPException(status_code=400, detail="Email already registered")
+        if await crud.get_user_by_email(db, email=user.email):
+            raise SignupManager.already_registered()
+
+        # End the read transaction, so that no connection is held while bcrypt runs
+        await db_commit(db)
+
+    @staticmethod
+    def already_registered() -> HTTPException:
+        # raise AlreadyRegisteredUser
+        return HTTPException(status_code=400, detail="Email already registered")
+
+    async def signup(self, db: DBSession, user: UserCreate) -> UserSessionResult:
+        """Tries to register the user.
 
-    def signup(self, db: Session, user: UserCreate) -> UserSession:
-        """Tries to register the user"""
+        The user and its login attempt are created in a single transaction, with no reload.
+        """
 
-        self.check_email(db, user)
+        await self.check_email(db, user)
 
-        db_user = crud.create_user(db=db, user=user)
+        async with get_hash_admission().admit("signup"):
+            with stage("hash_password"):
+                hashed_password = await hash_password_async(user.password)
 
-        return LoginAttemptManager.generate_user_session(db=db, db_user=db_user)
+        db_user = await crud.create_user(
+            db=db, user=user, hashed_password=hashed_password, commit=False
+        )
+        if not db_user:
+            await db_rollback(db)
+            raise self.already_registered()
+
+        user_session = await LoginAttemptManager.generate_user_session(
+            db=db, db_user=db_user
+        )
+        await cache_user(db_user)
+
+        return user_session
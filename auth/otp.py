@@ -1,7 +1,146 @@
+"""Time-based OTPs (RFC 6238), with HMAC-SHA1 and 6 digits, compatible with pyotp.
+
+TOTPEngine keeps, per secret, the HMAC state with the decoded key already absorbed: computing
+a code only copies it and hashes the 8 bytes counter. By default, the past steps accepted cover
+the login attempt lifetime, and a single future step is accepted for clock drift.
+
+Codes accepted for a user are remembered until they expire, so that a code is accepted at most
+once per user. The replay cache is kept in this process: across server workers, the login
+attempt store still guarantees that an attempt is consumed once.
+"""
+import base64
+import hashlib
+import hmac
+import struct
+import threading
+import time
+from collections import OrderedDict
+
 import pyotp
 
 import config
 
+_COUNTER = struct.Struct(">Q")
+_TRUNCATED = struct.Struct(">I")
+
+
+class TOTPEngine:
+    """Generates and validates TOTPs, with an LRU of HMAC states and a replay cache"""
+
+    def __init__(
+        self,
+        step: int = None,
+        valid_window: int = None,
+        future_steps: int = None,
+        digits: int = 6,
+        key_cache_size: int = None,
+        replay_cache_size: int = None,
+    ):
+        self.step = step or config.AUTH_OTP_STEP
+        self.valid_window = (
+            config.AUTH_OTP_VALID_WINDOW if valid_window is None else valid_window
+        )
+        self.future_steps = (
+            config.AUTH_OTP_FUTURE_STEPS if future_steps is None else future_steps
+        )
+        self.digits = digits
+        self.key_cache_size = (
+            config.AUTH_OTP_KEY_CACHE_SIZE if key_cache_size is None else key_cache_size
+        )
+        self.replay_cache_size = (
+            config.AUTH_OTP_REPLAY_CACHE_SIZE
+            if replay_cache_size is None
+            else replay_cache_size
+        )
+        self._modulo = 10**digits
+        # secret -> HMAC state with the key absorbed
+        self._keys = OrderedDict()
+        # (user id, counter) of accepted codes, oldest first
+        self._replays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _hmac(self, secret: str):
+        with self._lock:
+            state = self._keys.get(secret)
+            if state is not None:
+                self._keys.move_to_end(secret)
+                return state
+
+        # Same decoding as pyotp: secrets may come unpadded
+        key = base64.b32decode(secret.upper() + "=" * (-len(secret) % 8), casefold=True)
+        state = hmac.new(key, digestmod=hashlib.sha1)
+
+        if self.key_cache_size > 0:
+            with self._lock:
+                self._keys[secret] = state
+                while len(self._keys) > self.key_cache_size:
+                    self._keys.popitem(last=False)
+        return state
+
+    def counter(self, now: float = None) -> int:
+        return int((time.time() if now is None else now) // self.step)
+
+    def code(self, secret: str, counter: int) -> str:
+        mac = self._hmac(secret).copy()
+        mac.update(_COUNTER.pack(counter))
+        digest = mac.digest()
+
+        # Dynamic truncation, RFC 4226 section 5.3
+        offset = digest[-1] & 0x0F
+        value = _TRUNCATED.unpack_from(digest, offset)[0] & 0x7FFFFFFF
+        return str(value % self._modulo).zfill(self.digits)
+
+    def generate(self, secret: str, now: float = None) -> str:
+        return self.code(secret, self.counter(now))
+
+    def verify(
+        self, secret: str, code: str, user_id: int = None, now: float = None
+    ) -> bool:
+        """Check a code against the current step, valid_window steps before it and future_steps after.
+
+        With a user id, the code is also rejected if it was already accepted for that user.
+        """
+
+        if not code or len(code) != self.digits or not code.isdigit():
+            return False
+
+        current = self.counter(now)
+        for counter in range(
+            current - self.valid_window, current + self.future_steps + 1
+        ):
+            if hmac.compare_digest(self.code(secret, counter), code):
+                return user_id is None or self._claim(user_id, counter, current)
+        return False
+
+    def _claim(self, user_id: int, counter: int, current: int) -> bool:
+        """Record the use of a code, unless it was already used"""
+
+        with self._lock:
+            # Codes of steps out of the window cannot be accepted anymore: forget them
+            oldest = current - self.valid_window
+            while self._replays:
+                _, replay_counter = next(iter(self._replays))
+                if (
+                    replay_counter >= oldest
+                    and len(self._replays) < self.replay_cache_size
+                ):
+                    break
+                self._replays.popitem(last=False)
+
+            if (user_id, counter) in self._replays:
+                return False
+            if self.replay_cache_size > 0:
+                self._replays[(user_id, counter)] = None
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self._replays.clear()
+
+
+totp_engine = TOTPEngine()
+
 
 class TOTPManager:
     """Manager class for time-based OTP"""
@@ -10,9 +149,6 @@ class TOTPManager:
         """Initializes TOTP manager on given user"""
 
         self.user_secret = user_secret
-        self.totp = pyotp.TOTP(
-            self.user_secret, interval=config.AUTH_OTP_THRESHOLD_SECONDS
-        )
 
     @staticmethod
     def generate_secret():
@@ -23,9 +159,9 @@ class TOTPManager:
     def generate_otp(self):
         """Function for generating time-based OTP"""
 
-        return self.totp.now()
+        return totp_engine.generate(self.user_secret)
 
-    def validate_otp(self, otp_code):
-        """Function for validating time-based OTP"""
+    def validate_otp(self, otp_code, user_id: int = None):
+        """Function for validating time-based OTP, at most once per user if given"""
 
-        return self.totp.verify(otp_code)
+        return totp_engine.verify(self.user_secret, otp_code, user_id=user_id)
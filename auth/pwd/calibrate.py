@@ -0,0 +1,109 @@
+"""Pick the bcrypt cost factor for a latency budget, by measuring hashing on this host.
+
+Each cost doubles the hashing time. The chosen cost is the highest whose median hashing
+time fits the target, but never under --min-rounds. Run it on the production hardware:
+
+    python -m auth.pwd.calibrate [--target-ms 50] [--samples 5] [--min-rounds 10]
+
+and set AUTH_BCRYPT_ROUNDS to the printed cost. Existing hashes are rehashed on login.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from typing import Callable, Dict, Tuple
+
+from passlib.hash import bcrypt
+
+import config
+
+# Bounds of bcrypt itself
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+
+def measure_hash_time(rounds: int, samples: int = 5) -> float:
+    """Median time, in seconds, to hash a password with the given cost"""
+
+    handler = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.hash("calibration password")
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def calibrate(
+    target: float,
+    min_rounds: int = 10,
+    measure: Callable[[int], float] = measure_hash_time,
+) -> Tuple[int, Dict[int, float]]:
+    """Return the cost to use for the target hashing time in seconds, and the timings measured.
+
+    Costs are measured from the lowest up, and measuring stops at the first one over target.
+    """
+
+    timings = {}
+    chosen = min_rounds
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        timings[rounds] = measure(rounds)
+        if timings[rounds] > target:
+            break
+        chosen = max(chosen, rounds)
+    return chosen, timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Pick the bcrypt cost for a latency budget"
+    )
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        default=50,
+        help="hashing time budget, in milliseconds",
+    )
+    parser.add_argument(
+        "--samples", type=int, default=5, help="hashes measured per cost"
+    )
+    parser.add_argument(
+        "--min-rounds",
+        type=int,
+        default=10,
+        help="lowest cost ever chosen (default 10)",
+    )
+    args = parser.parse_args(argv)
+
+    # Load the bcrypt backend first, so that it is not measured with the lowest cost
+    measure_hash_time(MIN_ROUNDS, samples=1)
+    rounds, timings = calibrate(
+        args.target_ms / 1000,
+        min_rounds=args.min_rounds,
+        measure=lambda rounds: measure_hash_time(rounds, args.samples),
+    )
+    for measured, seconds in timings.items():
+        print(
+            json.dumps({"rounds": measured, "ms": round(seconds * 1000, 2)}),
+            file=sys.stderr,
+        )
+
+    if rounds not in timings:
+        # Over budget: the minimum cost wins, report its expected time
+        timings[rounds] = measure_hash_time(rounds, args.samples)
+    print(
+        json.dumps(
+            {
+                "rounds": rounds,
+                "ms": round(timings[rounds] * 1000, 2),
+                "current_rounds": config.AUTH_BCRYPT_ROUNDS,
+            }
+        )
+    )
+    print(f"AUTH_BCRYPT_ROUNDS={rounds}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
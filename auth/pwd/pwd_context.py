@@ -1,6 +1,28 @@
+import asyncio
+import multiprocessing
+import re
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+import config
+
+# Hashes with any other cost than AUTH_BCRYPT_ROUNDS need an update: they are rehashed,
+# upgraded or downgraded, on the next successful login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=config.AUTH_BCRYPT_ROUNDS,
+    bcrypt__min_rounds=config.AUTH_BCRYPT_ROUNDS,
+    bcrypt__max_rounds=config.AUTH_BCRYPT_ROUNDS,
+)
+
+_BCRYPT_COST = re.compile(r"^\$2[abxy]?\$(\d{2})\$")
+
+# Process pool dedicated to bcrypt, created lazily so that every gunicorn worker owns its pool
+_hash_pool: Optional[ProcessPoolExecutor] = None
 
 
 def verify_password(plain_password, hashed_password):
@@ -9,3 +31,80 @@ def verify_password(plain_password, hashed_password):
 
 def get_password_hash(password):
     return pwd_context.hash(password)
+
+
+def verify_and_update_password(
+    plain_password, hashed_password
+) -> Tuple[bool, Optional[str]]:
+    """Verify a password, and return a new hash of it if the current one needs an update"""
+
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+def hash_cost(hashed_password: str) -> Optional[int]:
+    """Cost factor of a bcrypt hash, or None for other hashes"""
+
+    match = _BCRYPT_COST.match(hashed_password or "")
+    return int(match.group(1)) if match else None
+
+
+def get_hash_pool() -> Optional[Executor]:
+    """Return the executor used for hashing, creating the process pool on first use.
+
+    When AUTH_HASH_WORKERS is 0 no pool is created, and the event loop default executor is used.
+    """
+
+    global _hash_pool
+
+    if config.AUTH_HASH_WORKERS <= 0:
+        return None
+
+    if _hash_pool is None:
+        # Spawn fresh interpreters instead of forking a process that already runs threads
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=config.AUTH_HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _hash_pool
+
+
+def shutdown_hash_pool():
+    """Stop the hashing processes, if any. Called on application shutdown"""
+
+    global _hash_pool
+
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=True)
+        _hash_pool = None
+
+
+async def _run_in_hash_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_hash_pool(), func, *args)
+    except BrokenProcessPool:
+        # A hash worker died (e.g. OOM killed): replace the pool and retry once
+        shutdown_hash_pool()
+        return await loop.run_in_executor(get_hash_pool(), func, *args)
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    """Verify a password in the hashing pool, without blocking the event loop"""
+
+    return await _run_in_hash_pool(verify_password, plain_password, hashed_password)
+
+
+async def verify_and_update_password_async(
+    plain_password, hashed_password
+) -> Tuple[bool, Optional[str]]:
+    """Verify a password in the hashing pool, rehashing it there if needed"""
+
+    return await _run_in_hash_pool(
+        verify_and_update_password, plain_password, hashed_password
+    )
+
+
+async def hash_password_async(password) -> str:
+    """Hash a password in the hashing pool, without blocking the event loop"""
+
+    return await _run_in_hash_pool(get_password_hash, password)
@@ -0,0 +1,280 @@
+"""Sliding-window rate limits of the auth endpoints, checked before any DB access or hashing.
+
+Each key (an email, a client IP, a login identifier) may be hit `limit` times per window.
+The window slides: hits of the previous fixed window are weighted by how much of it still
+overlaps the sliding window, so that each key only needs two counters.
+
+    - "memory": counters kept in this process, evicted once stale; only correct with a
+      single server worker, so refused when WEB_CONCURRENCY is above 1
+    - "redis": a key per fixed window on REDIS_URL, expiring natively, shared by all workers
+    - "none": no rate limiting
+
+When the counters cannot be reached, e.g. Redis is down, requests are let through or
+rejected with a 503 according to RATE_LIMIT_ON_ERROR.
+"""
+import ipaddress
+import logging
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+import config
+from kv.redis_client import get_redis
+from metrics import RATE_LIMIT_ERRORS, RATE_LIMITED
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiterUnavailable(Exception):
+    """The rate limit counters could not be reached"""
+
+
+def _estimate(previous: int, current: int, elapsed: float, window: int) -> float:
+    """Number of hits in the sliding window ending now"""
+
+    return previous * (1 - elapsed / window) + current
+
+
+def _retry_after(
+    previous: int, current: int, elapsed: float, window: int, limit: int
+) -> int:
+    """Seconds until a new hit would be allowed, assuming no hit meanwhile"""
+
+    target = limit - 1
+    if current <= target and previous:
+        # The previous window slides away linearly
+        wait = (
+            (_estimate(previous, current, elapsed, window) - target) * window / previous
+        )
+        if elapsed + wait < window:
+            return max(1, math.ceil(wait))
+
+    # Then hits of the current window become the previous ones
+    wait = window - elapsed + window * max(0, current - target) / current
+    return max(1, math.ceil(wait))
+
+
+class RateLimiter(ABC):
+    """Base class for rate limiters"""
+
+    def __init__(self, window: int = None):
+        self.window = window or config.RATE_LIMIT_WINDOW
+
+    @abstractmethod
+    async def hit(self, limits: Dict[str, int], now: float = None) -> int:
+        """Count a hit on each key, and return the number of seconds before a new hit of
+        every key would be allowed, or 0 if this one is. Keys are mapped to their limits.
+
+        Raise RateLimiterUnavailable when the counters cannot be reached.
+        """
+
+
+class NoRateLimiter(RateLimiter):
+    async def hit(self, limits: Dict[str, int], now: float = None) -> int:
+        return 0
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Counters kept in this process, bounded to max_size keys.
+
+    Keys are kept in order of last hit: stale keys, with no hit in the last two windows,
+    are dropped from the oldest end, and the oldest keys are evicted when full.
+    """
+
+    def __init__(self, window: int = None, max_size: int = None):
+        super().__init__(window)
+        self.max_size = max_size or config.RATE_LIMIT_MAX_KEYS
+        # key -> [fixed window index, hits in that window, hits in the previous one]
+        self._counters = OrderedDict()
+
+    def _purge(self, index: int):
+        while self._counters:
+            counter_index, _, _ = next(iter(self._counters.values()))
+            if counter_index >= index - 1 and len(self._counters) < self.max_size:
+                break
+            self._counters.popitem(last=False)
+
+    def clear(self):
+        self._counters.clear()
+
+    async def hit(self, limits: Dict[str, int], now: float = None) -> int:
+        now = time.time() if now is None else now
+        index, elapsed = divmod(now, self.window)
+        self._purge(index)
+
+        retry_after = 0
+        for key, limit in limits.items():
+            counter = self._counters.pop(key, None)
+            if counter is None or counter[0] < index - 1:
+                counter = [index, 0, 0]
+            elif counter[0] == index - 1:
+                counter = [index, 0, counter[1]]
+            counter[1] += 1
+            self._counters[key] = counter
+
+            _, current, previous = counter
+            if _estimate(previous, current, elapsed, self.window) > limit:
+                retry_after = max(
+                    retry_after,
+                    _retry_after(previous, current, elapsed, self.window, limit),
+                )
+        return retry_after
+
+
+class RedisRateLimiter(RateLimiter):
+    """Counters stored as a Redis key per fixed window, expiring after two windows"""
+
+    key_prefix = "rate_limit:"
+
+    def __init__(self, window: int = None, client=None):
+        super().__init__(window)
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or get_redis()
+
+    async def hit(self, limits: Dict[str, int], now: float = None) -> int:
+        now = time.time() if now is None else now
+        index, elapsed = divmod(now, self.window)
+        index = int(index)
+
+        # All keys in one round trip
+        pipeline = self.client.pipeline(transaction=False)
+        for key in limits:
+            current_key = f"{self.key_prefix}{key}:{index}"
+            pipeline.incr(current_key)
+            pipeline.expire(current_key, 2 * self.window)
+            pipeline.get(f"{self.key_prefix}{key}:{index - 1}")
+        # Imported by the client already
+        from redis.exceptions import RedisError
+
+        try:
+            results = await pipeline.execute()
+        except RedisError as e:
+            raise RateLimiterUnavailable(repr(e)) from e
+
+        retry_after = 0
+        for position, limit in enumerate(limits.values()):
+            current, _, previous = results[3 * position : 3 * position + 3]
+            previous = int(previous or 0)
+            if _estimate(previous, current, elapsed, self.window) > limit:
+                retry_after = max(
+                    retry_after,
+                    _retry_after(previous, current, elapsed, self.window, limit),
+                )
+        return retry_after
+
+
+RATE_LIMITERS = {
+    "none": NoRateLimiter,
+    "memory": MemoryRateLimiter,
+    "redis": RedisRateLimiter,
+}
+
+if config.RATE_LIMIT_BACKEND == "memory" and config.WEB_CONCURRENCY > 1:
+    # Each server worker would allow the limits on its own
+    raise ValueError(
+        "RATE_LIMIT_BACKEND=memory is per server worker: use redis with several workers"
+    )
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return the rate limiter selected by RATE_LIMIT_BACKEND"""
+
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        _rate_limiter = RATE_LIMITERS[config.RATE_LIMIT_BACKEND]()
+    return _rate_limiter
+
+
+async def check_rate_limits(scope: str, limits: Dict[str, int]):
+    """Count a hit of each key, and raise a 429 error if any of them is over its limit"""
+
+    try:
+        retry_after = await get_rate_limiter().hit(limits)
+    except RateLimiterUnavailable as e:
+        RATE_LIMIT_ERRORS.labels(scope).inc()
+        logger.warning("Rate limits of %s unavailable: %s", scope, e)
+        if config.RATE_LIMIT_ON_ERROR == "open":
+            return
+        raise HTTPException(
+            status_code=503,
+            detail="Service unavailable, try again later",
+            headers={"Retry-After": "1"},
+        )
+    if retry_after:
+        RATE_LIMITED.labels(scope).inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy, strict=False) for proxy in config.TRUSTED_PROXIES
+]
+
+
+def is_trusted_proxy(host: str, proxies=TRUSTED_PROXIES) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in proxies)
+
+
+def client_ip(request, proxies=TRUSTED_PROXIES) -> str:
+    """IP of the client, behind the trusted reverse proxies if any.
+
+    X-Forwarded-For is only read from a trusted proxy, right to left, as each proxy appends
+    the address it received the request from: the first untrusted one is the client's.
+    Addresses further left are set by the client itself, and are not trusted.
+    """
+
+    host = request.client.host if request.client else "unknown"
+    if not proxies or not is_trusted_proxy(host, proxies):
+        return host
+
+    forwarded = request.headers.get("x-forwarded-for", "")
+    for address in reversed([part.strip() for part in forwarded.split(",")]):
+        if not address:
+            continue
+        host = address
+        if not is_trusted_proxy(address, proxies):
+            break
+    return host
+
+
+async def throttle_signup(request):
+    await check_rate_limits(
+        "signup", {f"ip:{client_ip(request)}": config.RATE_LIMIT_PER_IP}
+    )
+
+
+async def throttle_login(request, email: str):
+    await check_rate_limits(
+        "login",
+        {
+            f"ip:{client_ip(request)}": config.RATE_LIMIT_PER_IP,
+            f"email:{email.strip().lower()}": config.RATE_LIMIT_PER_EMAIL,
+        },
+    )
+
+
+async def throttle_two_factor(request, identifier: str):
+    await check_rate_limits(
+        "two_factor",
+        {
+            f"ip:{client_ip(request)}": config.RATE_LIMIT_PER_IP,
+            f"login_attempt:{identifier}": config.RATE_LIMIT_PER_IDENTIFIER,
+        },
+    )
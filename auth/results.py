@@ -0,0 +1,51 @@
+"""Results of the auth managers, serialized as is by the endpoints.
+
+Unlike the pydantic response models in sql.schemas, which document the responses, these are
+built from already validated values, and are never validated again: endpoints return them as
+ORJSONResponse, bypassing FastAPI response_model validation.
+"""
+from typing import Optional
+
+
+class UserSessionResult:
+    """A user, with its pending login attempt. Mirrors schemas.UserSession"""
+
+    __slots__ = ("email", "two_factor_enabled", "id", "login_identifier", "otp_code")
+
+    def __init__(
+        self,
+        email: str,
+        two_factor_enabled: bool,
+        id: int,
+        login_identifier: Optional[str],
+        otp_code: Optional[str],
+    ):
+        self.email = email
+        self.two_factor_enabled = two_factor_enabled
+        self.id = id
+        self.login_identifier = login_identifier
+        self.otp_code = otp_code
+
+    def user_dict(self) -> dict:
+        """The user alone, as schemas.User"""
+
+        return {
+            "email": self.email,
+            "two_factor_enabled": self.two_factor_enabled,
+            "id": self.id,
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            "email": self.email,
+            "two_factor_enabled": self.two_factor_enabled,
+            "id": self.id,
+            "login_identifier": self.login_identifier,
+            "otp_code": self.otp_code,
+        }
+
+
+def status_ok(**fields) -> dict:
+    """A schemas.Response, or a schemas.ResponseToken with access_token"""
+
+    return {"status": "OK", **fields}
@@ -0,0 +1,178 @@
+"""Online rotation of TOTP secrets shared by several users.
+
+Until secrets were generated per row, every user created by a server worker process got the
+same secret. This finds the secrets used by more than one user, and gives each of their users
+a new secret, in batches by user id:
+
+    - each batch is a single executemany UPDATE by primary key, committed on its own, so that
+      only the rows of the batch are locked, for a short time, and never the whole table
+    - an old secret is only replaced if it did not change meanwhile
+    - the shared secrets and the last rotated user id are saved to a state file after each
+      batch, so that an interrupted run resumes where it stopped, even for users whose secret
+      is not shared anymore because the others were already rotated
+    - progress is reported as a JSON line per batch
+
+Secrets are never shown to users, so rotating them is transparent, apart from the logins
+waiting for their OTP check while their secret is rotated: they must log in again.
+
+Usage:
+
+    python -m auth.rotate_secrets [--state rotate_secrets.json] [--batch-size 1000] [--pause 0.1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import AsyncIterator, List, Optional
+
+import config
+from auth.otp import TOTPManager
+from sql import crud
+from sql.database import AsyncSessionLocal, SessionLocal, db_close, db_commit
+from sql.user_cache import invalidate_user
+
+
+class RotationState:
+    """Progress of a rotation, saved to path after each batch if given"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.secrets: Optional[List[str]] = None
+        self.total = 0
+        self.last_id = 0
+        self.rotated = 0
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "RotationState":
+        state = cls(path)
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            state.secrets = data["secrets"]
+            state.total = data["total"]
+            state.last_id = data["last_id"]
+            state.rotated = data["rotated"]
+        return state
+
+    def save(self):
+        if not self.path:
+            return
+        data = {
+            "secrets": self.secrets,
+            "total": self.total,
+            "last_id": self.last_id,
+            "rotated": self.rotated,
+        }
+        # Replace the file atomically, so that an interruption never leaves it truncated
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+async def rotate_secrets(
+    state: RotationState, batch_size: int = 1000, pause: float = 0, db_factory=None
+) -> AsyncIterator[dict]:
+    """Rotate the secrets shared by several users, yielding progress after each batch"""
+
+    db_factory = db_factory or (
+        AsyncSessionLocal if config.SQLALCHEMY_ASYNC else SessionLocal
+    )
+    start = time.perf_counter()
+
+    if state.secrets is None:
+        db = db_factory()
+        try:
+            state.secrets = await crud.get_shared_secrets(db)
+            state.total = (
+                await crud.count_users_with_secrets(db, state.secrets)
+                if state.secrets
+                else 0
+            )
+        finally:
+            await db_close(db)
+        state.save()
+
+    while state.secrets:
+        db = db_factory()
+        try:
+            users = await crud.get_users_with_secrets(
+                db, state.secrets, state.last_id, batch_size
+            )
+            if not users:
+                break
+            await crud.update_user_secrets(
+                db,
+                [
+                    {
+                        "user_id": user.id,
+                        "email": user.email,
+                        "old_secret": user.secret,
+                        "new_secret": TOTPManager.generate_secret(),
+                    }
+                    for user in users
+                ],
+            )
+            await db_commit(db)
+        finally:
+            await db_close(db)
+
+        for user in users:
+            await invalidate_user(user.email)
+
+        state.last_id = users[-1].id
+        state.rotated += len(users)
+        state.save()
+        yield {
+            "rotated": state.rotated,
+            "total": state.total,
+            "last_id": state.last_id,
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+
+        if pause:
+            # Leave room to the production traffic
+            await asyncio.sleep(pause)
+
+
+async def run(
+    state_path: Optional[str], batch_size: int, pause: float
+) -> RotationState:
+    state = RotationState.load(state_path)
+    async for progress in rotate_secrets(state, batch_size, pause):
+        print(json.dumps(progress), file=sys.stderr, flush=True)
+
+    print(
+        json.dumps(
+            {
+                "shared_secrets": len(state.secrets),
+                "rotated": state.rotated,
+                "done": True,
+            }
+        )
+    )
+    return state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Rotate TOTP secrets shared by several users"
+    )
+    parser.add_argument(
+        "--state",
+        default="rotate_secrets.json",
+        help="progress file, to resume an interrupted run (default rotate_secrets.json)",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--pause", type=float, default=0.1, help="seconds to wait between batches"
+    )
+    args = parser.parse_args(argv)
+
+    asyncio.run(run(args.state, args.batch_size, args.pause))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
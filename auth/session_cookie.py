@@ -0,0 +1,31 @@
+"""Access token cookie, set by the endpoints logging users in.
+
+The cookie holds the access token itself: tokens are already signed and expiring (see
+auth.tokens), so the cookie needs no signature nor encoding of its own. It is only written
+by the endpoints issuing tokens, and only read by the endpoints needing it, instead of being
+decoded and re-signed around every request by a session middleware.
+"""
+from typing import Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+import config
+
+COOKIE_NAME = "access_token"
+
+
+def set_access_token_cookie(response: Response, token: str):
+    response.set_cookie(
+        COOKIE_NAME,
+        token,
+        max_age=config.ACCESS_TOKEN_TTL,
+        httponly=True,
+        samesite="lax",
+        secure=config.SESSION_COOKIE_SECURE,
+    )
+
+
+def get_access_token_cookie(request: Request) -> Optional[str]:
+    # Cookies are only parsed when read
+    return request.cookies.get(COOKIE_NAME)
@@ -0,0 +1,175 @@
+"""Stateless access tokens.
+
+A token is self-contained: it carries the user id, its issue and expiry times, and
+whether the second factor was checked, signed with HMAC-SHA256. Any service holding the
+keys can verify tokens locally, with no DB access nor call to this service:
+
+    verifier = TokenVerifier({"2022-07": b"..."})
+    claims = verifier.verify(token)  # raises InvalidToken
+
+Tokens are formatted as <key id>.<payload>.<signature>, with URL-safe base64 parts.
+New tokens are signed with the first key; all keys are accepted, so that keys can be
+rotated by prepending a new key, then removing the old one once its tokens expired.
+
+This module only depends on the standard library, apart from the config-based helpers.
+"""
+import base64
+import binascii
+import hmac
+import struct
+import time
+from typing import Dict, Optional
+
+# Payload: version, 2FA level, user id, issued at, expires at
+_PAYLOAD = struct.Struct(">BBQQQ")
+_VERSION = 1
+
+# 2FA levels
+PASSWORD_ONLY = 1
+TWO_FACTOR = 2
+
+
+class InvalidToken(ValueError):
+    """The token is malformed, has an invalid signature or an unknown key, or expired"""
+
+
+class AccessTokenClaims:
+    """Verified content of an access token"""
+
+    __slots__ = ("user_id", "issued_at", "expires_at", "auth_level")
+
+    def __init__(self, user_id: int, issued_at: int, expires_at: int, auth_level: int):
+        self.user_id = user_id
+        self.issued_at = issued_at
+        self.expires_at = expires_at
+        self.auth_level = auth_level
+
+    @property
+    def two_factor(self) -> bool:
+        return self.auth_level >= TWO_FACTOR
+
+    def as_dict(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "issued_at": self.issued_at,
+            "expires_at": self.expires_at,
+            "two_factor": self.two_factor,
+        }
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _as_bytes(key) -> bytes:
+    return key.encode("utf-8") if isinstance(key, str) else key
+
+
+class TokenVerifier:
+    """Verifies access tokens signed with any of the given keys, by key id"""
+
+    def __init__(self, keys: Dict[str, bytes]):
+        if not keys:
+            raise ValueError("At least one key is required")
+        self.keys = {kid: _as_bytes(key) for kid, key in keys.items()}
+
+    def _sign(self, kid: str, key: bytes, payload: str) -> bytes:
+        # One-shot digest, computed in C for OpenSSL-supported hashes
+        return hmac.digest(key, f"{kid}.{payload}".encode("ascii"), "sha256")
+
+    def verify(self, token: str, now: Optional[float] = None) -> AccessTokenClaims:
+        """Return the claims of a valid token, or raise InvalidToken"""
+
+        try:
+            kid, payload, signature = token.split(".")
+        except (AttributeError, ValueError):
+            raise InvalidToken("Malformed token")
+
+        key = self.keys.get(kid)
+        if key is None:
+            raise InvalidToken("Unknown key")
+
+        try:
+            expected = self._sign(kid, key, payload)
+            valid = hmac.compare_digest(expected, _decode(signature))
+        except (binascii.Error, ValueError):
+            # Not base64, or not ASCII
+            raise InvalidToken("Malformed token")
+        if not valid:
+            raise InvalidToken("Invalid signature")
+
+        try:
+            version, auth_level, user_id, issued_at, expires_at = _PAYLOAD.unpack(
+                _decode(payload)
+            )
+        except (binascii.Error, struct.error):
+            raise InvalidToken("Malformed token")
+
+        if version != _VERSION:
+            raise InvalidToken("Unsupported token version")
+        if (time.time() if now is None else now) >= expires_at:
+            raise InvalidToken("Expired token")
+
+        return AccessTokenClaims(user_id, issued_at, expires_at, auth_level)
+
+
+class TokenSigner(TokenVerifier):
+    """Issues access tokens with the first key, and verifies them with any key"""
+
+    def __init__(self, keys: Dict[str, bytes], ttl: int):
+        super().__init__(keys)
+        self.ttl = ttl
+        self.kid = next(iter(self.keys))
+
+    def issue(self, user_id: int, auth_level: int, now: Optional[float] = None) -> str:
+        issued_at = int(time.time() if now is None else now)
+        payload = _encode(
+            _PAYLOAD.pack(
+                _VERSION, auth_level, user_id, issued_at, issued_at + self.ttl
+            )
+        )
+        signature = self._sign(self.kid, self.keys[self.kid], payload)
+        return f"{self.kid}.{payload}.{_encode(signature)}"
+
+
+def parse_keys(value: str) -> Dict[str, bytes]:
+    """Parse keys formatted as "kid1:key1,kid2:key2", signing key first"""
+
+    keys = {}
+    for item in value.split(","):
+        kid, _, key = item.strip().partition(":")
+        if not kid or not key or "." in kid:
+            raise ValueError(f"Invalid key definition: {item!r}")
+        keys[kid] = key.encode("utf-8")
+    return keys
+
+
+_signer: Optional[TokenSigner] = None
+
+
+def get_token_signer() -> TokenSigner:
+    """Signer configured by ACCESS_TOKEN_KEYS and ACCESS_TOKEN_TTL"""
+
+    global _signer
+
+    if _signer is None:
+        import config
+
+        _signer = TokenSigner(
+            parse_keys(config.ACCESS_TOKEN_KEYS), config.ACCESS_TOKEN_TTL
+        )
+    return _signer
+
+
+def issue_access_token(user_id: int, two_factor: bool) -> str:
+    return get_token_signer().issue(
+        user_id, TWO_FACTOR if two_factor else PASSWORD_ONLY
+    )
+
+
+def verify_access_token(token: str) -> AccessTokenClaims:
+    return get_token_signer().verify(token)
@@ -0,0 +1,95 @@
+"""Benchmark suite entry point.
+
+    python -m benchmarks micro [--output results/micro.json]
+    python -m benchmarks load [--database-url postgresql://...] [--requests 200] [--concurrency 16]
+    python -m benchmarks boot [--runs 5] [--budget-ms 1000]
+    python -m benchmarks compare results/micro.json baseline/micro.json [--threshold 0.1]
+
+Results are saved as JSON. compare exits with status 1 when a metric regressed
+by more than the threshold compared to the baseline, and boot when the median boot time
+of a server worker is over budget.
+"""
+import argparse
+import json
+import sys
+
+from .results import compare, format_comparison, load_results, save_results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    micro = commands.add_parser("micro", help="run the microbenchmarks")
+    micro.add_argument(
+        "--groups",
+        nargs="*",
+        choices=("passwords", "totp", "schemas", "serialization", "session", "crud"),
+    )
+    micro.add_argument("--output", default="benchmarks/results/micro.json")
+
+    load = commands.add_parser("load", help="run the in-process load generator")
+    load.add_argument("--database-url", help="defaults to a temporary SQLite file")
+    load.add_argument("--requests", type=int, default=200)
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--scenarios", nargs="*", default=None)
+    load.add_argument("--output", default="benchmarks/results/load.json")
+
+    boot = commands.add_parser("boot", help="measure the boot time of a server worker")
+    boot.add_argument("--runs", type=int, default=5)
+    boot.add_argument("--database-url", help="defaults to the configured database")
+    boot.add_argument("--budget-ms", type=float, default=1000)
+    boot.add_argument("--output", default="benchmarks/results/boot.json")
+
+    comparison = commands.add_parser(
+        "compare", help="compare results against a baseline"
+    )
+    comparison.add_argument("current")
+    comparison.add_argument("baseline")
+    comparison.add_argument("--threshold", type=float, default=0.10)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "micro":
+        from .micro import run_micro
+
+        results = run_micro(args.groups)
+        save_results(args.output, "micro", results)
+    elif args.command == "load":
+        from .load import SCENARIOS, run_load
+
+        results = run_load(
+            args.database_url,
+            args.requests,
+            args.concurrency,
+            args.scenarios or SCENARIOS,
+        )
+        save_results(
+            args.output,
+            "load",
+            results,
+            # Do not store credentials with the results
+            database=(args.database_url or "sqlite").split("://")[0],
+            requests=args.requests,
+            concurrency=args.concurrency,
+        )
+    elif args.command == "boot":
+        from .boot import measure_boot
+
+        results = measure_boot(args.runs, args.database_url)
+        save_results(args.output, "boot", results, budget_ms=args.budget_ms)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return 1 if results["boot.total"]["p50_ms"] > args.budget_ms else 0
+    else:
+        rows = compare(
+            load_results(args.current), load_results(args.baseline), args.threshold
+        )
+        print(format_comparison(rows))
+        return 1 if any(row["regression"] for row in rows) else 0
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
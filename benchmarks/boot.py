@@ -0,0 +1,52 @@
+"""Boot time of a server worker: importing main:app, then running its startup handlers.
+
+Each run uses a fresh interpreter, as a new gunicorn worker would.
+"""
+import json
+import os
+import subprocess
+import sys
+from typing import Dict
+
+from .results import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the child interpreter: reports the import and startup times, in seconds
+_BOOT_SCRIPT = """
+import asyncio, json, time
+start = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+
+async def boot():
+    await app.router.startup()
+    started = time.perf_counter()
+    await app.router.shutdown()
+    return started
+
+started = asyncio.run(boot())
+print(json.dumps({"import": imported - start, "startup": started - imported}))
+"""
+
+
+def measure_boot(runs: int = 5, database_url: str = None) -> Dict[str, dict]:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    if database_url:
+        env["DATABASE_URL"] = database_url
+
+    timings = {"import": [], "startup": [], "total": []}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", _BOOT_SCRIPT],
+            cwd=ROOT,
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        run = json.loads(output.decode().strip().splitlines()[-1])
+        timings["import"].append(run["import"])
+        timings["startup"].append(run["startup"])
+        timings["total"].append(run["import"] + run["startup"])
+
+    return {f"boot.{name}": summarize(durations) for name, durations in timings.items()}
@@ -0,0 +1,203 @@
+"""In-process load generator for the signup, login and 2FA endpoints.
+
+Requests are sent straight to the ASGI application, with no network in between,
+so that the numbers measure the service itself: hashing, DB round trips and serialization.
+The database is selected with the DATABASE_URL environment variable, which is set
+before the application is imported. Rate limiting is disabled the same way: every request
+comes from the same client IP, and logins reuse the same emails. So is the admission control
+of password hashing, unless AUTH_HASH_MAX_IN_FLIGHT is set: at high concurrency, requests
+would be shed with 503s instead of measured.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Tuple
+
+from .results import summarize
+
+SCENARIOS = ("signup", "login", "login_2fa", "two_factor")
+
+
+async def asgi_request(
+    app, method: str, path: str, body: dict = None
+) -> Tuple[int, dict]:
+    """Send a single JSON request to the ASGI app, return status and decoded body"""
+
+    payload = json.dumps(body).encode() if body is not None else b""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"benchmark"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(payload)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+
+    request_sent = False
+    response_done = asyncio.Event()
+    status = None
+    chunks = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_done.set()
+
+    await app(scope, receive, send)
+    data = b"".join(chunks)
+    return status, json.loads(data) if data else None
+
+
+async def setup_request(app, path: str, body: dict) -> dict:
+    """Send a request preparing a scenario, failing on any error response"""
+
+    status, data = await asgi_request(app, "POST", path, body)
+    if not 200 <= status < 300:
+        raise RuntimeError(f"Setup request to {path} failed with {status}: {data}")
+    return data
+
+
+async def run_concurrently(
+    requests: List[Tuple[str, dict]], app, concurrency: int
+) -> Tuple[List[float], float, Dict[int, int]]:
+    """Send the requests with at most concurrency in flight. Return durations, elapsed, statuses"""
+
+    queue = list(reversed(requests))
+    durations = []
+    statuses = {}
+
+    async def worker():
+        while queue:
+            path, body = queue.pop()
+            start = time.perf_counter()
+            status, _ = await asgi_request(app, "POST", path, body)
+            durations.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return durations, time.perf_counter() - start, statuses
+
+
+def signup_body(email: str, two_factor_enabled: bool) -> dict:
+    return {
+        "email": email,
+        "password": "SayMyName",
+        "two_factor_enabled": two_factor_enabled,
+    }
+
+
+def login_body(email: str) -> dict:
+    return {"email": email, "password": "SayMyName"}
+
+
+async def run_scenarios(
+    app, requests: int, concurrency: int, scenarios
+) -> Dict[str, dict]:
+    run_id = uuid.uuid4().hex[:8]
+    results = {}
+
+    def emails(kind: str) -> List[str]:
+        return [f"{kind}-{run_id}-{i}@bench.com" for i in range(requests)]
+
+    if "signup" in scenarios:
+        bodies = [
+            ("/auth/signup/", signup_body(email, True)) for email in emails("signup")
+        ]
+        durations, elapsed, statuses = await run_concurrently(bodies, app, concurrency)
+        results["load.signup"] = {**summarize(durations, elapsed), "statuses": statuses}
+
+    for scenario, two_factor_enabled in (("login", False), ("login_2fa", True)):
+        if scenario not in scenarios:
+            continue
+
+        # A single user logs in repeatedly, as the user cache would hide distinct users anyway
+        email = f"{scenario}-{run_id}@bench.com"
+        await setup_request(
+            app, "/auth/signup/", signup_body(email, two_factor_enabled)
+        )
+        bodies = [("/auth/login/", login_body(email))] * requests
+        durations, elapsed, statuses = await run_concurrently(bodies, app, concurrency)
+        results[f"load.{scenario}"] = {
+            **summarize(durations, elapsed),
+            "statuses": statuses,
+        }
+
+    if "two_factor" in scenarios:
+        # Login attempts are single use: create one per request before timing.
+        # A code is accepted once per user, so each attempt belongs to another user.
+        bodies = []
+        for email in emails("two-factor"):
+            await setup_request(app, "/auth/signup/", signup_body(email, True))
+            session = await setup_request(app, "/auth/login/", login_body(email))
+            bodies.append(
+                (
+                    "/auth/two_factor/",
+                    {
+                        "identifier": session["login_identifier"],
+                        "otp_code": session["otp_code"],
+                    },
+                )
+            )
+        durations, elapsed, statuses = await run_concurrently(bodies, app, concurrency)
+        results["load.two_factor"] = {
+            **summarize(durations, elapsed),
+            "statuses": statuses,
+        }
+
+    return results
+
+
+def run_load(
+    database_url: str = None,
+    requests: int = 200,
+    concurrency: int = 16,
+    scenarios=SCENARIOS,
+) -> Dict[str, dict]:
+    """Drive the endpoints against the given database (a temporary SQLite file by default)"""
+
+    if database_url is None:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}"
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["RATE_LIMIT_BACKEND"] = "none"
+    os.environ.setdefault("AUTH_HASH_MAX_IN_FLIGHT", "0")
+
+    # Imported here, so that the application picks up the settings above
+    from main import app
+    from sql.database import Base, engine
+
+    Base.metadata.create_all(bind=engine)
+
+    async def run():
+        await app.router.startup()
+        try:
+            return await run_scenarios(app, requests, concurrency, scenarios)
+        finally:
+            await app.router.shutdown()
+
+    return asyncio.run(run())
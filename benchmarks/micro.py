@@ -0,0 +1,279 @@
+"""Microbenchmarks of the building blocks of signup, login and 2FA"""
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Union
+
+from .results import summarize
+
+# Minimum time spent on each benchmark, and minimum number of calls
+MIN_TIME = 0.5
+MIN_CALLS = 5
+
+
+def bench(func: Callable, min_time: float = MIN_TIME) -> dict:
+    durations = []
+    start = time.perf_counter()
+    while len(durations) < MIN_CALLS or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - call_start)
+    return summarize(durations)
+
+
+async def abench(func: Callable, min_time: float = MIN_TIME) -> dict:
+    durations = []
+    start = time.perf_counter()
+    while len(durations) < MIN_CALLS or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - call_start)
+    return summarize(durations)
+
+
+def bench_passwords(results: Dict[str, dict]):
+    from auth.pwd.pwd_context import get_password_hash, verify_password
+
+    hashed = get_password_hash("SayMyName")
+    results["pwd.get_password_hash"] = bench(lambda: get_password_hash("SayMyName"))
+    results["pwd.verify_password"] = bench(lambda: verify_password("SayMyName", hashed))
+
+
+def bench_totp(results: Dict[str, dict]):
+    import pyotp
+
+    import config
+    from auth.otp import TOTPManager
+
+    secret = TOTPManager.generate_secret()
+    code = TOTPManager(user_secret=secret).generate_otp()
+    results["otp.generate_otp"] = bench(
+        lambda: TOTPManager(user_secret=secret).generate_otp()
+    )
+    results["otp.validate_otp"] = bench(
+        lambda: TOTPManager(user_secret=secret).validate_otp(code)
+    )
+
+    # Reference: a pyotp.TOTP per call, decoding the secret each time
+    def pyotp_totp():
+        return pyotp.TOTP(secret, interval=config.AUTH_OTP_STEP)
+
+    results["otp.pyotp.generate"] = bench(lambda: pyotp_totp().now())
+    results["otp.pyotp.verify"] = bench(
+        lambda: pyotp_totp().verify(code, valid_window=config.AUTH_OTP_VALID_WINDOW)
+    )
+
+
+def bench_schemas(results: Dict[str, dict]):
+    from sql import schemas
+
+    payload = {
+        "email": "walterwhite@gmail.com",
+        "password": "SayMyName",
+        "two_factor_enabled": True,
+    }
+    session = {
+        "email": "walterwhite@gmail.com",
+        "id": 1,
+        "two_factor_enabled": True,
+        "login_identifier": "1372c333fd8c3e54abd528a56208cb40",
+        "otp_code": "254992",
+    }
+    results["schemas.UserCreate.parse"] = bench(lambda: schemas.UserCreate(**payload))
+    results["schemas.UserSession.build"] = bench(lambda: schemas.UserSession(**session))
+    user_session = schemas.UserSession(**session)
+    results["schemas.UserSession.json"] = bench(user_session.json)
+
+
+def bench_serialization(results: Dict[str, dict]):
+    """Building and serializing the login response of a 2FA user, before and after
+    the orjson fast path"""
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, ORJSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    from auth.results import UserSessionResult
+    from sql import schemas
+
+    session = {
+        "email": "walterwhite@gmail.com",
+        "id": 1,
+        "two_factor_enabled": True,
+        "login_identifier": "1372c333fd8c3e54abd528a56208cb40",
+        "otp_code": "254992",
+    }
+    field = create_response_field(
+        name="login_response", type_=Union[schemas.UserSession, schemas.ResponseToken]
+    )
+
+    def pydantic_path():
+        # Model built by the manager, validated again against the Union response_model.
+        # serialize_response never suspends for async endpoints: run it without event loop
+        coroutine = serialize_response(
+            field=field, response_content=schemas.UserSession(**session)
+        )
+        try:
+            coroutine.send(None)
+        except StopIteration as stop:
+            content = stop.value
+        return JSONResponse(jsonable_encoder(content)).body
+
+    def fast_path():
+        return ORJSONResponse(UserSessionResult(**session).as_dict()).body
+
+    results["serialization.login[pydantic+json]"] = bench(pydantic_path)
+    results["serialization.login[result+orjson]"] = bench(fast_path)
+
+
+def bench_session(results: Dict[str, dict]):
+    """Per-request cost of the access token cookie: the former global SessionMiddleware,
+    against the cookie set by the login endpoints only"""
+
+    from starlette.middleware.sessions import SessionMiddleware
+    from starlette.requests import Request
+    from starlette.responses import Response
+
+    import config
+    from auth.session_cookie import set_access_token_cookie
+    from auth.tokens import issue_access_token
+
+    token = issue_access_token(1, two_factor=False)
+
+    def endpoint(writes_token, with_middleware):
+        async def app(scope, receive, send):
+            response = Response(b"{}")
+            if writes_token:
+                if with_middleware:
+                    Request(scope).session["access_token"] = token
+                else:
+                    set_access_token_cookie(response, token)
+            await response(scope, receive, send)
+
+        return (
+            SessionMiddleware(app, secret_key=config.SECRET_KEY)
+            if with_middleware
+            else app
+        )
+
+    loop = asyncio.new_event_loop()
+
+    def request(app, cookie: bytes):
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/",
+            "headers": [(b"cookie", cookie)],
+        }
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            pass
+
+        return app(scope, receive, send)
+
+    # Browsers send the cookie back with every request
+    session = base64.b64encode(json.dumps({"access_token": token}).encode())
+    signed = SessionMiddleware(None, secret_key=config.SECRET_KEY).signer.sign(session)
+    cookie = b"session=" + signed
+
+    try:
+        for name, writes_token in (("signup", False), ("login", True)):
+            for variant, with_middleware in (("middleware", True), ("scoped", False)):
+                app = endpoint(writes_token, with_middleware)
+                results[f"session.{name}[{variant}]"] = bench(
+                    lambda: loop.run_until_complete(request(app, cookie))
+                )
+    finally:
+        loop.close()
+
+
+async def bench_crud(results: Dict[str, dict]):
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from sql import crud, schemas
+    from sql.database import Base, custom_create_engine
+    from sql.user_cache import user_cache
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    Base.metadata.create_all(bind=custom_create_engine(f"sqlite:///{path}"))
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = sessionmaker(
+        autoflush=False, expire_on_commit=False, bind=engine, class_=AsyncSession
+    )
+
+    counter = iter(range(10**9))
+
+    def new_user():
+        return schemas.UserCreate(
+            email=f"user{next(counter)}@bench.com",
+            password="SayMyName",
+            two_factor_enabled=True,
+        )
+
+    async with session_factory() as db:
+        db_user = await crud.create_user(db, new_user(), "hash")
+
+        results["crud.create_user"] = await abench(
+            lambda: crud.create_user(db, new_user(), "hash")
+        )
+
+        cache_size = user_cache.max_size
+        user_cache.max_size = 0
+        user_cache.clear()
+        try:
+            results["crud.get_user_by_email[uncached]"] = await abench(
+                lambda: crud.get_user_by_email(db, db_user.email)
+            )
+        finally:
+            user_cache.max_size = cache_size
+        results["crud.get_user_by_email[cached]"] = await abench(
+            lambda: crud.get_user_by_email(db, db_user.email)
+        )
+        results["crud.get_user"] = await abench(lambda: crud.get_user(db, db_user.id))
+        results["crud.create_login_attempt"] = await abench(
+            lambda: crud.create_login_attempt(db, db_user)
+        )
+
+        async def create_and_consume():
+            identifier = await crud.create_login_attempt(db, db_user)
+            await crud.consume_login_attempt(db, identifier)
+            await db.commit()
+
+        results["crud.create_and_consume_login_attempt"] = await abench(
+            create_and_consume
+        )
+
+    await engine.dispose()
+
+
+def run_micro(groups=None) -> Dict[str, dict]:
+    groups = groups or (
+        "passwords",
+        "totp",
+        "schemas",
+        "serialization",
+        "session",
+        "crud",
+    )
+    results = {}
+    if "passwords" in groups:
+        bench_passwords(results)
+    if "totp" in groups:
+        bench_totp(results)
+    if "schemas" in groups:
+        bench_schemas(results)
+    if "serialization" in groups:
+        bench_serialization(results)
+    if "session" in groups:
+        bench_session(results)
+    if "crud" in groups:
+        asyncio.run(bench_crud(results))
+    return results
@@ -0,0 +1,109 @@
+"""Machine-readable benchmark results, and comparison against a baseline"""
+import json
+import math
+import os
+import platform
+import sys
+import time
+from typing import Dict, List
+
+# Metrics where a higher value is better; for every other metric, lower is better
+HIGHER_IS_BETTER = ("ops_per_sec", "requests_per_sec")
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(durations: List[float], elapsed: float = None) -> dict:
+    """Summary of the given durations in seconds: throughput and latency percentiles in ms"""
+
+    durations = sorted(durations)
+    elapsed = elapsed if elapsed is not None else sum(durations)
+    count = len(durations)
+    return {
+        "count": count,
+        "ops_per_sec": count / elapsed if elapsed else 0.0,
+        "mean_ms": 1000 * sum(durations) / count if count else 0.0,
+        "p50_ms": 1000 * percentile(durations, 0.50),
+        "p95_ms": 1000 * percentile(durations, 0.95),
+        "p99_ms": 1000 * percentile(durations, 0.99),
+        "max_ms": 1000 * durations[-1] if durations else 0.0,
+    }
+
+
+def save_results(path: str, kind: str, results: Dict[str, dict], **meta):
+    """Save results to a JSON file, together with details on where they were produced"""
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    document = {
+        "kind": kind,
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            **meta,
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.10) -> List[dict]:
+    """Compare two result documents metric by metric.
+
+    Return a row per metric found in both, flagged as a regression when it is worse than
+    the baseline by more than threshold (a fraction, e.g. 0.10 for 10%).
+    """
+
+    rows = []
+    for name, metrics in sorted(current["results"].items()):
+        base_metrics = baseline["results"].get(name)
+        if not base_metrics:
+            continue
+
+        for metric, value in sorted(metrics.items()):
+            base = base_metrics.get(metric)
+            if metric == "count" or not isinstance(value, (int, float)) or not base:
+                continue
+
+            change = (value - base) / base
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            rows.append(
+                {
+                    "name": name,
+                    "metric": metric,
+                    "baseline": base,
+                    "current": value,
+                    "change": change,
+                    "regression": worse > threshold,
+                }
+            )
+    return rows
+
+
+def format_comparison(rows: List[dict]) -> str:
+    lines = []
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        lines.append(
+            f"{row['name']:<45} {row['metric']:<16} "
+            f"{row['baseline']:>12.3f} -> {row['current']:>12.3f} "
+            f"({row['change']:+.1%}) {flag}"
+        )
+    return "\n".join(lines)
@@ -3,14 +3,214 @@ from pathlib import Path
 
 BASE_DIR = Path(__file__).parent.parent.absolute()
 LOG_CONFIG = os.path.join(BASE_DIR, "config_logging.yml")
+# Overrides the root level of the logging configuration, e.g. INFO
+LOG_LEVEL = os.environ.get("LOG_LEVEL")
+# Records waiting to be written; further records are dropped while the queue is full
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# Records per second each logger may emit below WARNING, with bursts of LOG_BURST records.
+# 0 disables sampling.
+LOG_RATE_PER_SECOND = float(os.environ.get("LOG_RATE_PER_SECOND", 50))
+LOG_BURST = int(os.environ.get("LOG_BURST", 100))
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql.db"
+
+# Use the async engine (aiosqlite/asyncpg) for request sessions.
+# Set DATABASE_ASYNC=0 to use the sync engine, with DB round trips run in the threadpool.
+SQLALCHEMY_ASYNC = os.environ.get("DATABASE_ASYNC", "1") == "1"
 APP_NAME = "Login OTP App"
 
-AUTH_OTP_THRESHOLD_SECONDS = 300  # OTPs are valid for 5 mins
+# Number of server workers, also read by gunicorn. State kept in each worker, e.g. the user
+# cache, must be invalidated or shared through Redis when there are several.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Node id of this process in the generated user ids, from 0 to 1023. Processes creating users
+# at the same time must have distinct ones: each gunicorn worker adds its slot, from 0 to
+# WEB_CONCURRENCY - 1, to the value given to the host, see gunicorn.conf.py.
+USER_ID_NODE = int(os.environ.get("USER_ID_NODE", 0))
+
+# Connection pool, per server worker and per engine. Not used with SQLite file databases.
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))
+# Seconds to wait for a connection before giving up
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", 30))
+# Seconds after which a connection is replaced, -1 to never recycle
+DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", 1800))
+# Test connections on checkout, so that stale ones are replaced after a failover
+DATABASE_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING", "1") == "1"
+
+# Further databases sharing the users with DATABASE_URL, as comma separated URLs.
+# Users are placed by a hash of their email: see python -m sql.rebalance when adding shards.
+DATABASE_SHARD_URLS = [
+    url.strip()
+    for url in os.environ.get("DATABASE_SHARD_URLS", "").split(",")
+    if url.strip()
+]
+
+# Read replicas of the database, as comma separated URLs, receiving the read-only queries.
+# Each has its own pool, configured as above.
+DATABASE_REPLICA_URLS = [
+    url.strip()
+    for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+# Relative share of the reads sent to each replica, as comma separated numbers (default 1 each)
+DATABASE_REPLICA_WEIGHTS = [
+    float(weight)
+    for weight in os.environ.get("DATABASE_REPLICA_WEIGHTS", "").split(",")
+    if weight
+] + [1.0] * len(DATABASE_REPLICA_URLS)
+# Seconds between two health checks of the replicas, and before a check gives up
+DATABASE_REPLICA_CHECK_INTERVAL = float(
+    os.environ.get("DATABASE_REPLICA_CHECK_INTERVAL", 5)
+)
+DATABASE_REPLICA_CHECK_TIMEOUT = float(
+    os.environ.get("DATABASE_REPLICA_CHECK_TIMEOUT", 2)
+)
+# Read replicas of the shards of DATABASE_SHARD_URLS, as semicolon separated groups of comma
+# separated URLs, one group per shard in the same order, e.g. "url1a,url1b;url2a".
+# Their weights are given the same way (default 1 each).
+DATABASE_SHARD_REPLICA_URLS = [
+    [url.strip() for url in group.split(",") if url.strip()]
+    for group in os.environ.get("DATABASE_SHARD_REPLICA_URLS", "").split(";")
+]
+DATABASE_SHARD_REPLICA_WEIGHTS = [
+    [float(weight) for weight in group.split(",") if weight]
+    for group in os.environ.get("DATABASE_SHARD_REPLICA_WEIGHTS", "").split(";")
+]
+# Replicas lagging behind the primary by more seconds receive no reads (PostgreSQL only)
+DATABASE_REPLICA_MAX_LAG = float(os.environ.get("DATABASE_REPLICA_MAX_LAG", 5))
+
+# Profiling of single requests, see profiling.py. When disabled, nothing is installed.
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+# Key signing the X-Profile-Token headers which trigger profiling; empty disables them
+PROFILING_KEY = os.environ.get("PROFILING_KEY", "")
+# Share of the other requests profiled at random, e.g. 0.001
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0))
+# Directory of the profile files, and number of files kept in it
+PROFILING_DIR = os.environ.get("PROFILING_DIR", os.path.join(BASE_DIR, "profiles"))
+PROFILING_MAX_FILES = int(os.environ.get("PROFILING_MAX_FILES", 100))
+
+# Token required in the X-Internal-Token header by /internal endpoints.
+# When empty, internal endpoints are disabled.
+INTERNAL_API_TOKEN = os.environ.get("INTERNAL_API_TOKEN", "")
+
+AUTH_OTP_THRESHOLD_SECONDS = 300  # Login attempts are valid for 5 mins
+
+# TOTP step, in seconds, number of past steps accepted, and of future steps accepted for
+# clock drift. By default, a code stays valid for the whole login attempt lifetime, as with
+# a single step of AUTH_OTP_THRESHOLD_SECONDS before.
+AUTH_OTP_STEP = int(os.environ.get("AUTH_OTP_STEP", 30))
+AUTH_OTP_VALID_WINDOW = int(
+    os.environ.get(
+        "AUTH_OTP_VALID_WINDOW", -(-AUTH_OTP_THRESHOLD_SECONDS // AUTH_OTP_STEP)
+    )
+)
+AUTH_OTP_FUTURE_STEPS = int(os.environ.get("AUTH_OTP_FUTURE_STEPS", 1))
+# Decoded TOTP keys kept in memory, and accepted codes remembered to reject replays
+AUTH_OTP_KEY_CACHE_SIZE = int(os.environ.get("AUTH_OTP_KEY_CACHE_SIZE", 10000))
+AUTH_OTP_REPLAY_CACHE_SIZE = int(os.environ.get("AUTH_OTP_REPLAY_CACHE_SIZE", 100000))
+
+# Where pending login attempts are kept: "sql", "memory" (single server worker only) or "redis"
+LOGIN_ATTEMPT_STORE = os.environ.get("LOGIN_ATTEMPT_STORE", "sql")
+# Maximum number of attempts kept by the "memory" store
+LOGIN_ATTEMPT_STORE_MAX_SIZE = int(
+    os.environ.get("LOGIN_ATTEMPT_STORE_MAX_SIZE", 100000)
+)
+
+# Partition the login_attempt table by day of expiry, so that old attempts are dropped
+# per partition. Only used on PostgreSQL.
+LOGIN_ATTEMPT_PARTITIONED = os.environ.get("LOGIN_ATTEMPT_PARTITIONED", "1") == "1"
+# Number of daily partitions created in advance
+LOGIN_ATTEMPT_PARTITIONS_AHEAD = int(
+    os.environ.get("LOGIN_ATTEMPT_PARTITIONS_AHEAD", 2)
+)
+# Seconds between two runs of the expired attempts reaper, 0 to disable it
+LOGIN_ATTEMPT_REAPER_INTERVAL = int(os.environ.get("LOGIN_ATTEMPT_REAPER_INTERVAL", 60))
+# Maximum number of attempts deleted per transaction by the reaper
+LOGIN_ATTEMPT_REAPER_BATCH_SIZE = int(
+    os.environ.get("LOGIN_ATTEMPT_REAPER_BATCH_SIZE", 1000)
+)
+
+# Logins without 2FA are recorded as login_event rows, buffered in each server worker and
+# inserted in batches of LOGIN_EVENT_BATCH_SIZE, at least every LOGIN_EVENT_FLUSH_INTERVAL seconds.
+# Events beyond LOGIN_EVENT_BUFFER_SIZE pending ones are dropped; a size of 0 disables them.
+LOGIN_EVENT_BUFFER_SIZE = int(os.environ.get("LOGIN_EVENT_BUFFER_SIZE", 10000))
+# Kept low enough for the multi-row INSERT to stay under the SQLite limit of 999 parameters
+LOGIN_EVENT_BATCH_SIZE = int(os.environ.get("LOGIN_EVENT_BATCH_SIZE", 250))
+LOGIN_EVENT_FLUSH_INTERVAL = float(os.environ.get("LOGIN_EVENT_FLUSH_INTERVAL", 1))
+
+# Cache of users by email, per server worker. A size of 0 disables it.
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))
+# TTL of cached lookups of emails with no user
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get("USER_CACHE_NEGATIVE_TTL", 5))
+# How server workers are told to drop stale entries: "none" (wait for TTL) or "redis",
+# the default with several server workers. Without it, lookups of unknown emails are only
+# cached by a single server worker: others would keep hiding the users signed up elsewhere.
+USER_CACHE_INVALIDATION = os.environ.get(
+    "USER_CACHE_INVALIDATION", "redis" if WEB_CONCURRENCY > 1 else "none"
+)
+
+# Rate limits of the auth endpoints: "memory" (per server worker, refused with several
+# server workers), "redis" (shared by all server workers, the default with several) or "none"
+RATE_LIMIT_BACKEND = os.environ.get(
+    "RATE_LIMIT_BACKEND", "redis" if WEB_CONCURRENCY > 1 else "memory"
+)
+# When the rate limit counters cannot be reached: "open" lets requests through (default),
+# "closed" rejects them with a 503
+RATE_LIMIT_ON_ERROR = os.environ.get("RATE_LIMIT_ON_ERROR", "open")
+# Addresses or networks of the reverse proxies in front of the service, comma separated.
+# Requests from them are limited by the client IP found in their X-Forwarded-For header.
+TRUSTED_PROXIES = [
+    proxy.strip()
+    for proxy in os.environ.get("TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+# Sliding window, in seconds, and hits allowed per key in each window
+RATE_LIMIT_WINDOW = int(os.environ.get("RATE_LIMIT_WINDOW", 60))
+RATE_LIMIT_PER_IP = int(os.environ.get("RATE_LIMIT_PER_IP", 100))
+RATE_LIMIT_PER_EMAIL = int(os.environ.get("RATE_LIMIT_PER_EMAIL", 10))
+RATE_LIMIT_PER_IDENTIFIER = int(os.environ.get("RATE_LIMIT_PER_IDENTIFIER", 5))
+# Maximum number of keys counted by the "memory" backend
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+
+# Number of users inserted per transaction by the bulk import
+BULK_IMPORT_CHUNK_SIZE = int(os.environ.get("BULK_IMPORT_CHUNK_SIZE", 1000))
+# Processes hashing the plain passwords of a bulk import, in a pool of the import: imports
+# never queue in front of the hashing of logins and signups
+BULK_IMPORT_HASH_WORKERS = int(
+    os.environ.get("BULK_IMPORT_HASH_WORKERS", os.cpu_count() or 1)
+)
+
+# Redis server, used for state shared by all server workers
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# bcrypt cost factor, see python -m auth.pwd.calibrate. Changing it is safe: existing hashes are
+# rehashed with the new cost on the next successful login of each user.
+AUTH_BCRYPT_ROUNDS = int(os.environ.get("AUTH_BCRYPT_ROUNDS", 12))
+
+# Number of processes dedicated to bcrypt hashing, per server worker.
+# 0 runs hashing in the event loop default thread pool instead.
+AUTH_HASH_WORKERS = int(os.environ.get("AUTH_HASH_WORKERS", 2))
+
+# Admission control of the hashing in logins and signups, per server worker: at most
+# AUTH_HASH_MAX_IN_FLIGHT hashes at once, and AUTH_HASH_MAX_QUEUE requests waiting for at most
+# AUTH_HASH_QUEUE_TIMEOUT seconds. Other requests get a 503. A limit of 0 disables it.
+AUTH_HASH_MAX_IN_FLIGHT = int(
+    os.environ.get("AUTH_HASH_MAX_IN_FLIGHT", max(AUTH_HASH_WORKERS, 1))
+)
+AUTH_HASH_MAX_QUEUE = int(os.environ.get("AUTH_HASH_MAX_QUEUE", 32))
+AUTH_HASH_QUEUE_TIMEOUT = float(os.environ.get("AUTH_HASH_QUEUE_TIMEOUT", 1))
 
 SECRET_KEY = os.environ.get("SECRET_KEY", "vYSrDoqfBF")
 
+# Access token signing keys, as "kid1:key1,kid2:key2". Tokens are signed with the first key,
+# and verified with any of them.
+ACCESS_TOKEN_KEYS = os.environ.get("ACCESS_TOKEN_KEYS", f"default:{SECRET_KEY}")
+# Access token lifetime, in seconds
+ACCESS_TOKEN_TTL = int(os.environ.get("ACCESS_TOKEN_TTL", 3600))
+# Only send the access token cookie over HTTPS
+SESSION_COOKIE_SECURE = os.environ.get("SESSION_COOKIE_SECURE", "0") == "1"
+
 for k, v in os.environ.items():
     if k == "DATABASE_URL":
         SQLALCHEMY_DATABASE_URL = v
@@ -0,0 +1,31 @@
+# Gunicorn configuration, loaded automatically from the working directory
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+
+def on_starting(server):
+    # Metrics of previous runs must not be aggregated with the new ones
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def pre_fork(server, worker):
+    # Lowest slot not held by a live worker, so that slots stay below WEB_CONCURRENCY
+    taken = {getattr(other, "slot", None) for other in server.WORKERS.values()}
+    worker.slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+
+
+def post_fork(server, worker):
+    # Distinct user id node per worker. The application is loaded after the fork
+    # (no --preload), so that config reads it.
+    node = int(os.environ.get("USER_ID_NODE", 0)) + worker.slot
+    os.environ["USER_ID_NODE"] = str(node)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
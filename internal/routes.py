@@ -0,0 +1,175 @@
+"""Internal endpoints, for operators only. Protected by the INTERNAL_API_TOKEN shared secret"""
+import io
+import json
+import secrets
+import tempfile
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+import config
+import logs
+from auth.admission import get_hash_admission
+from auth.bulk_import import FORMATS, aread_lines, import_users
+from profiling import get_profile_store
+from sql import crud
+from sql.database import AsyncSessionLocal, SessionLocal, db_close, shards
+from sql.login_events import get_login_events
+from sql.pool_stats import get_pool_stats
+from sql.user_cache import user_cache
+
+
+def require_internal_token(x_internal_token: Optional[str] = Header(None)):
+    """Dependency rejecting requests without the configured internal token"""
+
+    if not config.INTERNAL_API_TOKEN:
+        # Internal endpoints are disabled altogether
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if not x_internal_token or not secrets.compare_digest(
+        x_internal_token, config.INTERNAL_API_TOKEN
+    ):
+        raise HTTPException(status_code=403, detail="Invalid internal token")
+
+
+router = APIRouter(
+    prefix="/internal",
+    dependencies=[Depends(require_internal_token)],
+    include_in_schema=False,
+)
+
+
+@router.get("/pool")
+async def pool_stats():
+    """
+    Connection pool statistics of each engine of this server worker.
+
+    Includes current occupancy (size, checked out connections, overflow),
+    connect/checkout/checkin/invalidation counters, and checkout wait times.
+    """
+
+    return get_pool_stats()
+
+
+@router.get("/replicas")
+async def replica_stats():
+    """
+    Read replicas of every shard as seen by this server worker: health, replication lag and
+    last error from the latest check, weight, and number of reads sent to each of them.
+    """
+
+    return {
+        name: stats
+        for shard in shards
+        for name, stats in shard.replicas.stats().items()
+    }
+
+
+@router.get("/admission")
+async def admission_stats():
+    """
+    Admission control of password hashing in this server worker: limits, hashes in flight,
+    requests waiting for their turn, and requests admitted or shed, by reason.
+    """
+
+    return get_hash_admission().stats()
+
+
+@router.get("/login_events")
+async def login_event_stats():
+    """
+    Audit events of the logins without 2FA in this server worker: pending in the buffer,
+    recorded, flushed to the database, dropped while the buffer was full, and failed flushes.
+    """
+
+    return get_login_events().stats()
+
+
+@router.get("/cache")
+async def cache_stats():
+    """User cache statistics of this server worker: size, hits, misses, evictions"""
+
+    return {"users": user_cache.stats()}
+
+
+@router.get("/passwords")
+async def password_stats():
+    """
+    Number of users per bcrypt cost factor of their password hash, e.g. to follow the
+    rehashing of existing users after a change of AUTH_BCRYPT_ROUNDS. Scans the users table.
+    """
+
+    db = AsyncSessionLocal() if config.SQLALCHEMY_ASYNC else SessionLocal()
+    try:
+        users_by_cost = await crud.count_users_by_hash_cost(db)
+    finally:
+        await db_close(db)
+
+    return {"rounds": config.AUTH_BCRYPT_ROUNDS, "users_by_cost": users_by_cost}
+
+
+@router.get("/logs")
+async def log_stats():
+    """Logging pipeline of this server worker: queued records, and records dropped
+    because the queue was full or by per-logger sampling"""
+
+    return logs.logging_stats()
+
+
+@router.get("/profiles")
+async def list_profiles():
+    """Profiled requests still kept on disk, most recent first: id, method, path,
+    what triggered the profiling, response status and duration"""
+
+    return await run_in_threadpool(get_profile_store().summaries)
+
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    """A profiled request: top functions by cumulative time, SQL statements with their
+    duration, and time spent in each stage of the auth flows"""
+
+    profile = await run_in_threadpool(get_profile_store().get, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+
+@router.post("/users/import")
+async def import_users_endpoint(
+    request: Request, format: str = "jsonl", chunk_size: Optional[int] = None
+):
+    """
+    Bulk import users from a JSONL or CSV request body, see auth.bulk_import for the fields.
+
+    Response: a JSON line per imported chunk, streamed as chunks are committed, with
+    counts of received, inserted and already registered users, and per-line errors.
+    """
+
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+
+    # Spool the body first: the response streams while the import runs,
+    # and reading the request then would compete with disconnect detection.
+    # The file is only ever written and read in the threadpool.
+    body = await run_in_threadpool(tempfile.TemporaryFile)
+    try:
+        async for data in request.stream():
+            await run_in_threadpool(body.write, data)
+        await run_in_threadpool(body.seek, 0)
+    except BaseException:
+        await run_in_threadpool(body.close)
+        raise
+    lines = io.TextIOWrapper(body, encoding="utf-8", newline="")
+
+    async def reports():
+        try:
+            async for report in import_users(aread_lines(lines), format, chunk_size):
+                yield json.dumps(report.as_dict()) + "\n"
+        finally:
+            await run_in_threadpool(lines.close)
+
+    return StreamingResponse(reports(), media_type="application/x-ndjson")
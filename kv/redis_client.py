@@ -0,0 +1,32 @@
+"""Shared Redis client, for state that must be shared across server workers"""
+from typing import TYPE_CHECKING, Optional
+
+import config
+
+if TYPE_CHECKING:
+    from redis import asyncio as aioredis
+
+_client: Optional["aioredis.Redis"] = None
+
+
+def get_redis() -> "aioredis.Redis":
+    """Return the Redis client of this server worker, connecting lazily to REDIS_URL"""
+
+    global _client
+
+    if _client is None:
+        # Imported on first use: redis is a large import, and not every deployment uses it
+        from redis import asyncio as aioredis
+
+        _client = aioredis.from_url(config.REDIS_URL)
+    return _client
+
+
+async def close_redis():
+    """Close the Redis client, if any. Called on application shutdown"""
+
+    global _client
+
+    if _client is not None:
+        await _client.close()
+        _client = None
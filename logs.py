@@ -0,0 +1,181 @@
+"""Logging pipeline: records are queued by the request threads, and formatted and written
+by a background thread. Passwords, OTPs and secrets are redacted when formatting, and
+records below WARNING are rate limited per logger, so that log volume stays bounded under load.
+"""
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+import yaml
+from pydantic import BaseModel
+
+import config
+
+REDACTED = "***"
+
+# Fields never written to the logs
+SENSITIVE_FIELDS = ("password", "hashed_password", "otp_code", "secret", "access_token")
+
+# Matches key=value and "key": "value" pairs of sensitive fields, quoted or not
+_SENSITIVE_PATTERN = re.compile(
+    r"(?P<key>\b(?:%s)\b['\"]?\s*[=:]\s*)(?P<quote>['\"]?)(?P<value>.*?)(?P=quote)(?=[\s,;&)}\]]|$)"
+    % "|".join(SENSITIVE_FIELDS)
+)
+
+
+def redact_text(text: str) -> str:
+    return _SENSITIVE_PATTERN.sub(
+        lambda m: f"{m.group('key')}{m.group('quote')}{REDACTED}{m.group('quote')}",
+        text,
+    )
+
+
+def redact(value):
+    """Return a copy of a log argument, safe to write to the logs"""
+
+    if isinstance(value, BaseModel):
+        fields = ", ".join(
+            f"{key}={redact(field_value)!r}" for key, field_value in value
+        )
+        return f"{type(value).__name__}({fields})"
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in SENSITIVE_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    return value
+
+
+class RedactingFormatter(logging.Formatter):
+    """Formatter redacting sensitive fields from the arguments and the message"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = redact(record.args)
+            else:
+                record.args = tuple(redact(arg) for arg in record.args)
+        return redact_text(super().format(record))
+
+
+class SamplingFilter(logging.Filter):
+    """Token bucket per logger: each logger emits at most rate records per second below
+    WARNING, with bursts of up to burst records. Records dropped are counted per logger.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.dropped: Dict[str, int] = {}
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [float(self.burst), now]
+
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+                return False
+
+            bucket[0] = tokens - 1
+            return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler leaving formatting to the listener thread.
+
+    The standard QueueHandler formats records in the calling thread, so that they can be
+    pickled: this queue never leaves the process, so records are queued as they are.
+    When the queue is full, records are dropped instead of blocking the caller.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """Queue listener waiting for room in a full queue on stop, instead of failing"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[LazyQueueHandler] = None
+_sampling_filter: Optional[SamplingFilter] = None
+
+
+def setup_logging(path: str = None):
+    """Apply the YAML logging configuration, then move the root handlers behind a queue"""
+
+    global _listener, _queue_handler, _sampling_filter
+
+    with open(path or config.LOG_CONFIG) as f:
+        logging.config.dictConfig(yaml.load(f, Loader=yaml.FullLoader))
+
+    root = logging.getLogger()
+    if config.LOG_LEVEL:
+        root.setLevel(config.LOG_LEVEL)
+
+    stop_logging()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    _sampling_filter = SamplingFilter(config.LOG_RATE_PER_SECOND, config.LOG_BURST)
+    _queue_handler = LazyQueueHandler(queue.Queue(maxsize=config.LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(_sampling_filter)
+    root.addHandler(_queue_handler)
+
+    _listener = QueueListener(
+        _queue_handler.queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def stop_logging():
+    """Write the queued records and stop the writer thread"""
+
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> dict:
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped_queue_full": _queue_handler.dropped if _queue_handler else 0,
+        "dropped_sampling": dict(_sampling_filter.dropped) if _sampling_filter else {},
+    }
+
+
+atexit.register(stop_logging)
@@ -1,47 +1,144 @@
-import secrets
-from typing import Union
-from starlette.middleware.sessions import SessionMiddleware
+from typing import Optional, Union
 from starlette.requests import Request
-from fastapi import FastAPI, Depends
-from sqlalchemy.orm import Session
-import logging.config
-import yaml
+from fastapi import FastAPI, Depends, Header, HTTPException
+from fastapi.responses import ORJSONResponse
+import logging
 
 import config
+import logs
+import metrics
 from auth.managers import SignupManager, LoginManager
-from sql import models, schemas
-from sql.database import SessionLocal, engine
+from auth.pwd.pwd_context import shutdown_hash_pool
+from auth.rate_limit import throttle_login, throttle_signup, throttle_two_factor
+from auth.results import status_ok
+from auth.session_cookie import get_access_token_cookie, set_access_token_cookie
+from auth.tokens import InvalidToken, issue_access_token, verify_access_token
+from internal import routes as internal_routes
+from kv.redis_client import close_redis
+from profiling import ProfilingMiddleware
+from sql import login_events, reaper, schemas, user_cache
+from sql.database import (
+    AsyncSessionLocal,
+    DBSession,
+    SessionLocal,
+    db_close,
+    dispose_engines,
+    shards,
+)
+from sql.replicas import start_health_checks, stop_health_checks
+
+# Nothing touches the database on import: the schema is managed by Alembic migrations,
+# run once per deployment with `alembic upgrade head`.
+
+logger = logging.getLogger(__name__)
+
+# Responses are serialized with orjson. Auth endpoints return ORJSONResponse themselves,
+# built from manager results which are already valid: response_model then only documents them.
+app = FastAPI(default_response_class=ORJSONResponse)
+
+if config.PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+# Added last, so that it also observes the time spent in the other middlewares
+app.add_middleware(metrics.MetricsMiddleware)
+
+app.include_router(internal_routes.router)
+
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """Metrics of every server worker, in the Prometheus text format"""
+
+    return metrics.metrics_response()
+
+
+# Registered first, so that logging is configured before the other startup handlers run
+@app.on_event("startup")
+def setup_logging():
+    logs.setup_logging(config.LOG_CONFIG)
+
+
+@app.on_event("startup")
+async def start_login_attempt_reaper():
+    # Partitions are created by the migrations and `python -m sql.reaper`, then ahead
+    # of time by the reaper itself: no DDL runs on startup
+    reaper.start_reaper()
+
+
+@app.on_event("shutdown")
+async def stop_login_attempt_reaper():
+    await reaper.stop_reaper()
+
+
+@app.on_event("startup")
+async def start_login_event_flusher():
+    login_events.start_flusher()
+
+
+# Before the engines are disposed: pending login events are flushed
+@app.on_event("shutdown")
+async def stop_login_event_flusher():
+    await login_events.stop_flusher()
+
+
+@app.on_event("startup")
+async def start_user_cache_invalidation():
+    user_cache.start_invalidation_listener()
+
+
+@app.on_event("shutdown")
+async def stop_user_cache_invalidation():
+    await user_cache.stop_invalidation_listener()
+
+
+@app.on_event("shutdown")
+def stop_hash_pool():
+    shutdown_hash_pool()
+
 
-# Create all tables
-models.Base.metadata.create_all(bind=engine)
+@app.on_event("startup")
+async def start_replica_health_checks():
+    start_health_checks([shard.replicas for shard in shards])
 
 
-# Read logging configuration file
-with open(config.LOG_CONFIG) as f:
-    log_config = yaml.load(f, Loader=yaml.FullLoader)
-    logging.config.dictConfig(log_config)
+@app.on_event("shutdown")
+async def stop_replica_health_checks():
+    await stop_health_checks()
 
-app = FastAPI()
 
-# Add SessionMiddleware to store the access_token
-app.add_middleware(SessionMiddleware, secret_key=config.SECRET_KEY)
+@app.on_event("shutdown")
+async def dispose_database_engines():
+    await dispose_engines()
+
+
+@app.on_event("shutdown")
+async def stop_redis_client():
+    await close_redis()
+
+
+@app.on_event("shutdown")
+def flush_logs():
+    logs.stop_logging()
 
 
 # Dependency
 # Create DB session before each request in the dependency with yield, close it afterwards.
-def get_db():
-    db = SessionLocal()
+# The session is an AsyncSession, or a sync Session when DATABASE_ASYNC is disabled.
+async def get_db():
+    db = AsyncSessionLocal() if config.SQLALCHEMY_ASYNC else SessionLocal()
     try:
         yield db
     finally:
         # Make sure the connection is always closed after any request
-        db.close()
+        await db_close(db)
 
 
-# Not using async because SQLAlchemy has not integrated support for using await directly.
-# Should use encode/databases to connect to DBs using async and await.
+# Endpoints are async: bcrypt is awaited in the hashing process pool, and DB round trips
+# either use the async engine, or run in the threadpool on the sync path.
 @app.post("/auth/signup/", response_model=Union[schemas.User, schemas.Response])
-def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def signup(
+    request: Request, user: schemas.UserCreate, db: DBSession = Depends(get_db)
+):
     """
     Create a new User, provided its email, password and 2FA preference.
 
@@ -70,22 +167,27 @@ def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
     If 2FA is not enabled, {"status": "OK"} is returned.
     """
-    logging.debug(f"received data: {user}")
+    logger.debug("received data: %s", user)
+
+    # Before any hashing or DB access
+    await throttle_signup(request)
 
     mgr = SignupManager()
-    user_session = mgr.signup(db=db, user=user)
+    user_session = await mgr.signup(db=db, user=user)
 
     # If 2FA is not enabled, return status OK
     if not user.two_factor_enabled:
-        return {"status": "OK"}
+        return ORJSONResponse(status_ok())
 
-    return user_session
+    return ORJSONResponse(user_session.user_dict())
 
 
 @app.post(
     "/auth/login/", response_model=Union[schemas.UserSession, schemas.ResponseToken]
 )
-def login(request: Request, user: schemas.UserLogin, db: Session = Depends(get_db)):
+async def login(
+    request: Request, user: schemas.UserLogin, db: DBSession = Depends(get_db)
+):
     """
     Endpoint for user login. Receive user email and password.
 
@@ -119,24 +221,28 @@ def login(request: Request, user: schemas.UserLogin, db: Session = Depends(get_d
 
         - access_token: string, token to be used for subsequent calls; it certifies that the used is logged.
     """
-    logging.debug(f"received data: {user}")
+    logger.debug("received data: %s", user)
+
+    # Before any hashing or DB access
+    await throttle_login(request, user.email)
 
     mgr = LoginManager()
-    user_session = mgr.login(db=db, user=user)
+    user_session = await mgr.login(db=db, user=user)
 
-    # If 2FA is not enabled, set secure cookie and return access_token
+    # If 2FA is not enabled, set the access token cookie and return access_token
     if not user_session.two_factor_enabled:
-        request.session["access_token"] = secrets.token_hex(16)
-        return {"status": "OK", "access_token": request.session["access_token"]}
-
-    logging.debug(f"Current OTP: {user_session.otp_code}")
+        with metrics.stage("issue_access_token"):
+            token = issue_access_token(user_session.id, two_factor=False)
+        response = ORJSONResponse(status_ok(access_token=token))
+        set_access_token_cookie(response, token)
+        return response
 
-    return user_session
+    return ORJSONResponse(user_session.as_dict())
 
 
 @app.post("/auth/two_factor/", response_model=schemas.ResponseToken)
-def two_factor_auth(
-    request: Request, body: schemas.VerifyOTPIn, db: Session = Depends(get_db)
+async def two_factor_auth(
+    request: Request, body: schemas.VerifyOTPIn, db: DBSession = Depends(get_db)
 ):
     """
     Verify OTP for a previous login attempt.
@@ -156,10 +262,61 @@ def two_factor_auth(
         - access_token: string, token to be used for subsequent calls; it certifies that the used is logged.
     """
 
-    logging.debug(f"received data: {body}")
+    logger.debug("received data: %s", body)
+
+    # Before any DB access
+    await throttle_two_factor(request, body.identifier)
 
     mgr = LoginManager()
-    mgr.verify_otp(db, body.identifier, body.otp_code)
-    request.session["access_token"] = secrets.token_hex(16)
+    attempt = await mgr.verify_otp(db, body.identifier, body.otp_code)
+    with metrics.stage("issue_access_token"):
+        token = issue_access_token(attempt.user_id, two_factor=True)
+
+    response = ORJSONResponse(status_ok(access_token=token))
+    set_access_token_cookie(response, token)
+    return response
+
+
+@app.get("/auth/verify/", response_model=schemas.AccessTokenInfo)
+async def verify(request: Request, authorization: Optional[str] = Header(None)):
+    """
+    Verify an access token, received by /login or /two_factor_auth endpoints.
 
-    return {"status": "OK", "access_token": request.session["access_token"]}
+    The token is checked locally, from its signature and expiry: no DB access is made.
+    Other services can verify tokens themselves with auth.tokens.TokenVerifier.
+
+
+    Request header: Authorization: Bearer <access_token>, or else the access_token cookie
+    set by the login endpoints
+
+
+    Response: JSON object with following params:
+
+        - status: string, should be "OK" if the token is valid.
+
+        - user_id: int, the user identifier
+
+        - issued_at, expires_at: int, token issue and expiry times, as UNIX timestamps
+
+        - two_factor: boolean, states if the user was authenticated with 2FA
+    """
+
+    if authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() != "bearer":
+            token = None
+    else:
+        token = get_access_token_cookie(request)
+
+    try:
+        if not token:
+            raise InvalidToken("Missing access token")
+        claims = verify_access_token(token)
+    except InvalidToken:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid access token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    return ORJSONResponse(status_ok(**claims.as_dict()))
@@ -0,0 +1,179 @@
+"""Prometheus metrics: request latencies, per-stage timers of the auth flows, DB queries per request.
+
+With gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers:
+each worker then writes its samples there, and /metrics aggregates all of them.
+"""
+import functools
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from starlette.responses import Response
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["method", "endpoint", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+STAGE_DURATION = Histogram(
+    "auth_stage_duration_seconds",
+    "Time spent in each stage of the signup, login and 2FA flows",
+    ["stage"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+DB_QUERIES = Histogram(
+    "db_queries_per_request",
+    "Number of SQL statements executed per HTTP request",
+    ["endpoint"],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50),
+)
+
+RATE_LIMITED = Counter(
+    "auth_rate_limited_total",
+    "Requests rejected by the rate limits of the auth endpoints",
+    ["scope"],
+)
+
+RATE_LIMIT_ERRORS = Counter(
+    "auth_rate_limit_errors_total",
+    "Requests whose rate limits could not be checked, e.g. with Redis down",
+    ["scope"],
+)
+
+HASH_SHED = Counter(
+    "auth_hash_shed_total",
+    "Logins and signups rejected with a 503 by the admission control of password hashing",
+    ["scope", "reason"],
+)
+
+HASH_QUEUED = Gauge(
+    "auth_hash_queued",
+    "Logins and signups waiting for their turn to hash a password",
+    multiprocess_mode="livesum",
+)
+
+PASSWORD_VERIFIED = Counter(
+    "auth_password_verified_total",
+    "Passwords successfully verified, by bcrypt cost factor of the stored hash",
+    ["cost"],
+)
+
+PASSWORD_REHASHED = Counter(
+    "auth_password_rehashed_total",
+    "Password hashes replaced on login, after a change of the bcrypt cost factor",
+    ["from_cost", "to_cost"],
+)
+
+# Called with the name and duration of every stage, e.g. by request profiling
+_stage_listeners = []
+
+# Statements executed by the current request. The list is shared with the threadpool and
+# greenlets running the DB calls, which get a copy of the request context.
+_query_count: ContextVar = ContextVar("query_count", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """Time the enclosed block as the given stage"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.labels(name).observe(duration)
+        for listener in _stage_listeners:
+            listener(name, duration)
+
+
+def add_stage_listener(listener):
+    """Call listener(name, duration) at the end of every stage"""
+
+    if listener not in _stage_listeners:
+        _stage_listeners.append(listener)
+
+
+def timed_stage(name: str):
+    """Decorator timing each call of a coroutine function as the given stage"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_queries(engine):
+    """Count the statements executed on the given (sync) engine in the current request"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        count = _query_count.get()
+        if count is not None:
+            count[0] += 1
+
+
+class MetricsMiddleware:
+    """ASGI middleware observing the duration and DB queries of every HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        count = [0]
+        token = _query_count.set(count)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _query_count.reset(token)
+            # The router stores the matched endpoint in the scope: label by its name,
+            # so that unknown paths cannot create new label values
+            endpoint = scope.get("endpoint")
+            endpoint = endpoint.__name__ if endpoint else "unmatched"
+            REQUEST_DURATION.labels(scope["method"], endpoint, str(status)).observe(
+                time.perf_counter() - start
+            )
+            DB_QUERIES.labels(endpoint).observe(count[0])
+
+
+def metrics_response() -> Response:
+    """Render the metrics of every server worker in the Prometheus text format"""
+
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,64 @@
+"""Alembic environment: migrations run with the sync engine on the application database URL,
+then on every other shard"""
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+import config as app_config
+from sql import models  # noqa: F401, registers the tables on Base.metadata
+from sql.database import Base
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+# An URL set by the caller, e.g. tests, takes precedence, and is then the only one migrated
+if config.get_main_option("sqlalchemy.url"):
+    urls = [config.get_main_option("sqlalchemy.url")]
+else:
+    urls = [app_config.SQLALCHEMY_DATABASE_URL] + app_config.DATABASE_SHARD_URLS
+
+target_metadata = Base.metadata
+
+
+def run_migrations_offline(url):
+    """Emit the SQL to stdout, with --sql"""
+
+    context.configure(
+        url=url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=url.startswith("sqlite"),
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online(url):
+    connectable = engine_from_config(
+        dict(config.get_section(config.config_ini_section), **{"sqlalchemy.url": url}),
+        prefix="sqlalchemy.",
+        poolclass=pool.NullPool,
+    )
+
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            # SQLite cannot alter tables: they are recreated instead
+            render_as_batch=connection.dialect.name == "sqlite",
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+for url in urls:
+    if context.is_offline_mode():
+        run_migrations_offline(url)
+    else:
+        run_migrations_online(url)
@@ -0,0 +1,121 @@
+"""Login attempt expiry and consumption, partitioning, users secret index
+
+Pending login attempts are dropped: they are only valid for a few minutes, and would have
+no expiry. Users who were waiting for their OTP check must log in again.
+
+On PostgreSQL with LOGIN_ATTEMPT_PARTITIONED, login_attempt is recreated partitioned
+by day of expiry, with its first partitions.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2022-07-18 12:00:00
+"""
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+import config
+from sql.reaper import partition_name
+
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def partitioned() -> bool:
+    return (
+        config.LOGIN_ATTEMPT_PARTITIONED and op.get_bind().dialect.name == "postgresql"
+    )
+
+
+def create_partitioned_login_attempt():
+    op.create_table(
+        "login_attempt",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("identifier", sa.String(32), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=True),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.Column("consumed", sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id", "expires_at"),
+        postgresql_partition_by="RANGE (expires_at)",
+    )
+    op.create_index(
+        "ix_login_attempt_identifier",
+        "login_attempt",
+        ["identifier", "expires_at"],
+        unique=True,
+    )
+
+    # Later partitions are created in advance by the reaper
+    today = datetime.utcnow().date()
+    for offset in range(config.LOGIN_ATTEMPT_PARTITIONS_AHEAD + 1):
+        day = today + timedelta(days=offset)
+        op.execute(
+            f"CREATE TABLE {partition_name(day)} PARTITION OF login_attempt "
+            f"FOR VALUES FROM ('{day.isoformat()}') "
+            f"TO ('{(day + timedelta(days=1)).isoformat()}')"
+        )
+
+
+def upgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        # Built without blocking writes to users, outside of the migration transaction
+        with op.get_context().autocommit_block():
+            op.create_index(
+                "ix_users_secret", "users", ["secret"], postgresql_concurrently=True
+            )
+    else:
+        op.create_index("ix_users_secret", "users", ["secret"])
+
+    if partitioned():
+        op.drop_table("login_attempt")
+        create_partitioned_login_attempt()
+        return
+
+    if op.get_bind().dialect.name == "postgresql":
+        # Never reaped so far: the table may be large
+        op.execute("TRUNCATE login_attempt")
+    else:
+        op.execute("DELETE FROM login_attempt")
+
+    op.drop_index("ix_login_attempt_identifier", table_name="login_attempt")
+    with op.batch_alter_table("login_attempt") as batch:
+        batch.alter_column(
+            "identifier",
+            type_=sa.String(32),
+            existing_type=sa.String(),
+            existing_nullable=False,
+        )
+        batch.add_column(sa.Column("expires_at", sa.DateTime(), nullable=False))
+        batch.add_column(
+            sa.Column(
+                "consumed", sa.Boolean(), server_default=sa.false(), nullable=False
+            )
+        )
+    op.create_index(
+        "ix_login_attempt_identifier", "login_attempt", ["identifier"], unique=True
+    )
+    op.create_index("ix_login_attempt_expires_at", "login_attempt", ["expires_at"])
+
+
+def downgrade():
+    # Pending login attempts are dropped, as on upgrade
+    op.drop_table("login_attempt")
+    op.create_table(
+        "login_attempt",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("identifier", sa.String(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_login_attempt_identifier", "login_attempt", ["identifier"])
+
+    op.drop_index("ix_users_secret", table_name="users")
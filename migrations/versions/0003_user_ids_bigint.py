@@ -0,0 +1,55 @@
+"""64 bits user ids
+
+User ids are now generated client side, unique across shards, and do not fit in 32 bits.
+Existing users keep their ids. On PostgreSQL both tables are rewritten: run it off-peak.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2022-08-01 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The referencing column first, so that the foreign key always compares compatible types
+    with op.batch_alter_table("login_attempt") as batch:
+        batch.alter_column(
+            "user_id",
+            type_=sa.BigInteger(),
+            existing_type=sa.Integer(),
+            existing_nullable=False,
+        )
+    with op.batch_alter_table("users") as batch:
+        batch.alter_column(
+            "id",
+            type_=sa.BigInteger(),
+            existing_type=sa.Integer(),
+            existing_nullable=False,
+            autoincrement=False,
+        )
+
+
+def downgrade():
+    # On PostgreSQL, fails once users were created with 64 bits ids
+    with op.batch_alter_table("users") as batch:
+        batch.alter_column(
+            "id",
+            type_=sa.Integer(),
+            existing_type=sa.BigInteger(),
+            existing_nullable=False,
+        )
+    with op.batch_alter_table("login_attempt") as batch:
+        batch.alter_column(
+            "user_id",
+            type_=sa.Integer(),
+            existing_type=sa.BigInteger(),
+            existing_nullable=False,
+        )
@@ -0,0 +1,34 @@
+"""Login events
+
+Logins without 2FA no longer insert a login attempt: they are recorded in login_event,
+in batches, see sql.login_events. Created on every shard, like the other tables.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2022-08-08 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "login_event",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_login_event_user_id", "login_event", ["user_id"])
+
+
+def downgrade():
+    op.drop_index("ix_login_event_user_id", table_name="login_event")
+    op.drop_table("login_event")
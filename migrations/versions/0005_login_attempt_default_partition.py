@@ -0,0 +1,40 @@
+"""Default partition of login_attempt
+
+On PostgreSQL with LOGIN_ATTEMPT_PARTITIONED, attempts expiring on a day the reaper has not
+created a partition for yet go to a default partition, instead of failing the login. The
+reaper moves them to the partition of their day once it is created, see sql.reaper.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2022-08-16 12:00:00
+"""
+from alembic import op
+
+import config
+from sql.reaper import DEFAULT_PARTITION
+
+
+# revision identifiers, used by Alembic.
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def partitioned() -> bool:
+    return (
+        config.LOGIN_ATTEMPT_PARTITIONED and op.get_bind().dialect.name == "postgresql"
+    )
+
+
+def upgrade():
+    if partitioned():
+        op.execute(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF login_attempt DEFAULT"
+        )
+
+
+def downgrade():
+    if partitioned():
+        # Attempts it holds are dropped: they are only valid for a few minutes
+        op.execute(f"DROP TABLE {DEFAULT_PARTITION}")
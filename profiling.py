@@ -0,0 +1,321 @@
+"""Opt-in profiling of single requests, to investigate slow logins in production.
+
+When PROFILING_ENABLED is set, ProfilingMiddleware profiles the requests carrying a valid
+X-Profile-Token header, and a PROFILING_SAMPLE_RATE share of the others. For each profiled
+request, a JSON file holds:
+
+    - the functions with the highest cumulative time, from cProfile
+    - every SQL statement executed, without its parameters, with its duration
+    - the time spent in each stage of the auth flows, e.g. bcrypt and TOTP, see metrics.stage
+
+Files are kept in PROFILING_DIR, the oldest removed beyond PROFILING_MAX_FILES, and served on
+/internal/profiles. Requests which are not profiled only pay for the trigger check; nothing
+at all is installed when profiling is disabled.
+
+cProfile observes the whole event loop thread: requests handled concurrently by the same
+server worker show up in the profile too. A worker profiles a single request at a time.
+
+Tokens are signed with PROFILING_KEY, and expire: python -m profiling token
+"""
+import argparse
+import cProfile
+import hashlib
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+import config
+import metrics
+
+HEADER = b"x-profile-token"
+RESPONSE_HEADER = b"x-profile-id"
+
+# Functions kept from each cProfile run, by cumulative time
+TOP_FUNCTIONS = 50
+# SQL statements are truncated to this length
+MAX_STATEMENT_LENGTH = 1000
+
+_PROFILE_ID = re.compile(r"^[0-9]{13}-[0-9a-f]{8}$")
+
+# Profile of the current request, shared with the threadpool and greenlets running its DB calls
+_current_profile: ContextVar = ContextVar("current_profile", default=None)
+
+
+def make_token(key: str, ttl: int = 300, now: float = None) -> str:
+    """Token triggering the profiling of requests for ttl seconds"""
+
+    expires = int((now or time.time()) + ttl)
+    signature = hmac.new(
+        key.encode(), str(expires).encode(), hashlib.sha256
+    ).hexdigest()
+    return f"{expires}.{signature}"
+
+
+def verify_token(key: str, token: str, now: float = None) -> bool:
+    if not key:
+        return False
+
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < (now or time.time()):
+        return False
+    expected = hmac.new(key.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+class RequestProfile:
+    """What is recorded while a request is profiled"""
+
+    def __init__(self, method: str, path: str, trigger: str):
+        self.id = f"{int(time.time() * 1000)}-{secrets.token_hex(4)}"
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.status = 500
+        self.duration = 0.0
+        self.queries: List[dict] = []
+        self.stages: List[dict] = []
+        self._lock = threading.Lock()
+
+    def add_query(self, statement: str, duration: float):
+        # DB calls of the sync path run in threadpool threads
+        with self._lock:
+            self.queries.append(
+                {"statement": statement[:MAX_STATEMENT_LENGTH], "seconds": duration}
+            )
+
+    def add_stage(self, name: str, duration: float):
+        with self._lock:
+            self.stages.append({"name": name, "seconds": duration})
+
+    def as_dict(self, profiler: Optional[cProfile.Profile]) -> dict:
+        stage_totals = {}
+        for stage in self.stages:
+            stage_totals[stage["name"]] = (
+                stage_totals.get(stage["name"], 0) + stage["seconds"]
+            )
+
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "trigger": self.trigger,
+            "status": self.status,
+            "seconds": self.duration,
+            "sql": {
+                "count": len(self.queries),
+                "seconds": sum(query["seconds"] for query in self.queries),
+                "statements": self.queries,
+            },
+            "stages": {"totals": stage_totals, "calls": self.stages},
+            "functions": top_functions(profiler) if profiler else [],
+        }
+
+
+def top_functions(profiler: cProfile.Profile, limit: int = TOP_FUNCTIONS) -> List[dict]:
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [
+        {
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "seconds": total_time,
+            "cumulative_seconds": cumulative_time,
+        }
+        for (filename, line, name), (_, calls, total_time, cumulative_time, _) in rows[
+            :limit
+        ]
+    ]
+
+
+class ProfileStore:
+    """Profiles saved as JSON files in a directory, keeping the max_files most recent ones"""
+
+    def __init__(self, directory: str = None, max_files: int = None):
+        self.directory = directory or config.PROFILING_DIR
+        self.max_files = max_files or config.PROFILING_MAX_FILES
+
+    def _path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def ids(self) -> List[str]:
+        """Ids of the stored profiles, oldest first"""
+
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name[: -len(".json")]
+            for name in os.listdir(self.directory)
+            if name.endswith(".json") and _PROFILE_ID.match(name[: -len(".json")])
+        )
+
+    def save(self, profile: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(profile["id"])
+        # Replace atomically, so that a profile is never read half written
+        with open(path + ".tmp", "w") as f:
+            json.dump(profile, f)
+        os.replace(path + ".tmp", path)
+
+        for profile_id in self.ids()[: -self.max_files]:
+            try:
+                os.remove(self._path(profile_id))
+            except FileNotFoundError:
+                # Removed by another server worker
+                pass
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        if not _PROFILE_ID.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def summaries(self) -> List[dict]:
+        """The stored profiles, most recent first, without their details"""
+
+        summaries = []
+        for profile_id in reversed(self.ids()):
+            profile = self.get(profile_id)
+            if profile:
+                summaries.append(
+                    {
+                        key: profile[key]
+                        for key in (
+                            "id",
+                            "method",
+                            "path",
+                            "trigger",
+                            "status",
+                            "seconds",
+                        )
+                    }
+                )
+        return summaries
+
+
+_profile_store: Optional[ProfileStore] = None
+
+
+def get_profile_store() -> ProfileStore:
+    global _profile_store
+
+    if _profile_store is None:
+        _profile_store = ProfileStore()
+    return _profile_store
+
+
+def _on_stage(name: str, duration: float):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_stage(name, duration)
+
+
+def record_queries(engine):
+    """Record the statements executed on the given (sync) engine by profiled requests"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            context._profile_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        start = getattr(context, "_profile_start", None)
+        if profile is not None and start is not None:
+            profile.add_query(statement, time.perf_counter() - start)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests with a valid token header, or sampled"""
+
+    def __init__(self, app, sample_rate: float = None, key: str = None, store=None):
+        self.app = app
+        self.sample_rate = (
+            config.PROFILING_SAMPLE_RATE if sample_rate is None else sample_rate
+        )
+        self.key = config.PROFILING_KEY if key is None else key
+        self.store = store or get_profile_store()
+        # cProfile can only profile one request at a time per thread
+        self._busy = threading.Lock()
+        metrics.add_stage_listener(_on_stage)
+
+    def trigger(self, scope) -> Optional[str]:
+        if self.key:
+            for name, value in scope["headers"]:
+                if name == HEADER:
+                    if verify_token(self.key, value.decode("latin-1")):
+                        return "token"
+                    break
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trigger = self.trigger(scope)
+        if trigger is None or not self._busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"], trigger)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (RESPONSE_HEADER, profile.id.encode())
+                ]
+            await send(message)
+
+        token = _current_profile.set(profile)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.disable()
+            profile.duration = time.perf_counter() - start
+            _current_profile.reset(token)
+            self._busy.release()
+            # The response is already sent
+            await run_in_threadpool(self.save, profile, profiler)
+
+    def save(self, profile: RequestProfile, profiler: cProfile.Profile):
+        self.store.save(profile.as_dict(profiler))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Request profiling")
+    commands = parser.add_subparsers(dest="command", required=True)
+    token = commands.add_parser(
+        "token", help="print a token for the X-Profile-Token header"
+    )
+    token.add_argument("--ttl", type=int, default=300, help="validity in seconds")
+    args = parser.parse_args(argv)
+
+    if not config.PROFILING_KEY:
+        parser.error("PROFILING_KEY is not set")
+    print(make_token(config.PROFILING_KEY, args.ttl))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
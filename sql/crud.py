@@ -1,46 +1,420 @@
-from sqlalchemy.orm import Session
+import heapq
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
 
+from sqlalchemy import and_, bindparam, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from auth.otp import TOTPManager
+from metrics import timed_stage
 from . import models, schemas
+from .database import (
+    DBSession,
+    db_commit,
+    db_execute,
+    db_rollback,
+    dialect_name,
+    reads_from_replicas,
+    shard_count,
+)
+from .replicas import on_replica
+from .shards import on_shard, shard_for_email
+from .user_cache import MISSING, UserRecord, cache_user, invalidate_user, user_cache
+
+# Every function works with both an AsyncSession and a sync Session:
+# on the sync path, DB round trips are moved to the threadpool.
+# Read-only queries marked with on_replica() run on a read replica, when configured.
+# Users and their login attempts live on the shard of the user email: each statement is
+# marked with its shard, and queries not given an email run on every shard.
+
+
+def email_shard(db: DBSession, email: str) -> int:
+    return shard_for_email(email, shard_count(db))
+
+
+def group_by_shard(
+    db: DBSession, items: list, email=lambda item: item["email"]
+) -> dict:
+    """Group the given items by shard of their email"""
+
+    shards = shard_count(db)
+    groups = defaultdict(list)
+    for item in items:
+        groups[shard_for_email(email(item), shards)].append(item)
+    return groups
+
+
+@timed_stage("crud.get_user")
+async def get_user(db: DBSession, user_id: int):
+    """Get user from DB given its ID. Ids do not tell the shard: shards are tried in turn"""
+
+    statement = on_replica(select(models.User).where(models.User.id == user_id))
+    for shard in range(shard_count(db)):
+        result = await db_execute(db, on_shard(statement, shard))
+        db_user = result.scalars().first()
+        if db_user:
+            return db_user
+    return None
+
+
+@timed_stage("crud.get_user_by_email")
+async def get_user_by_email(db: DBSession, email: str):
+    """Get user from DB given its email, through the user cache.
+
+    Return a read-only UserRecord, or None if no user has this email.
+    """
+
+    record = user_cache.get(email)
+    if record is not MISSING:
+        return record
+
+    shard = email_shard(db, email)
+    statement = on_shard(select(models.User).where(models.User.email == email), shard)
+    from_replica = reads_from_replicas(db, shard)
+    result = await db_execute(db, on_replica(statement))
+    db_user = result.scalars().first()
+    if db_user is None and from_replica:
+        # The user may have just signed up, and not be replicated yet: never cache a miss
+        # the primary does not confirm
+        result = await db_execute(db, statement)
+        db_user = result.scalars().first()
+
+    record = UserRecord.from_model(db_user) if db_user else None
+    user_cache.set(email, record)
+    return record
+
+
+# Users per multi-row INSERT of create_users, keeping under the SQLite limit of 999 parameters
+CREATE_USERS_BATCH_SIZE = 200
+
+
+def _insert_users_ignoring_conflicts(dialect: str):
+    """INSERT into users, skipping already registered emails where the dialect supports it"""
+
+    if dialect == "postgresql":
+        return postgresql.insert(models.User).on_conflict_do_nothing(
+            index_elements=[models.User.email]
+        )
+    if dialect == "sqlite":
+        return sqlite.insert(models.User).on_conflict_do_nothing(
+            index_elements=[models.User.email]
+        )
+    return insert(models.User)
+
+
+@timed_stage("crud.create_user")
+async def create_user(
+    db: DBSession, user: schemas.UserCreate, hashed_password: str, commit: bool = True
+) -> Optional[UserRecord]:
+    """Create new user and insert into DB, unless its email is already registered.
+
+    Runs a single INSERT ... ON CONFLICT DO NOTHING, so that concurrent signups for the same
+    email cannot race. Return the new user, or None if the email is already registered.
+    Every value is generated client side, the id included, so the user is never reloaded
+    from the DB. The user is inserted on the shard of its email.
+
+    The password must already be hashed, so that no hashing happens while the transaction is open.
+    With commit=False, the caller must commit, then pass the user to user_cache.cache_user.
+    """
+
+    values = {
+        "id": models.make_user_id(),
+        "email": user.email,
+        "hashed_password": hashed_password,
+        "two_factor_enabled": user.two_factor_enabled,
+        "secret": TOTPManager.generate_secret(),
+    }
+
+    dialect = dialect_name(db)
+    statement = on_shard(
+        _insert_users_ignoring_conflicts(dialect).values(**values),
+        email_shard(db, user.email),
+    )
+    if dialect in ("postgresql", "sqlite"):
+        # Nothing is inserted when the email is already registered
+        result = await db_execute(db, statement)
+        inserted = result.rowcount == 1
+    else:
+        try:
+            await db_execute(db, statement)
+            inserted = True
+        except IntegrityError:
+            await db_rollback(db)
+            inserted = False
+
+    if not inserted:
+        return None
+
+    record = UserRecord(**values)
+    if commit:
+        await db_commit(db)
+        await cache_user(record)
+
+    return record
+
+
+@timed_stage("crud.create_users")
+async def create_users(db: DBSession, users: List[dict]) -> int:
+    """Insert many users with multi-row INSERTs per shard, skipping already registered emails.
+
+    Each dict holds the users columns, with an already hashed password. Does not commit.
+    Like create_user, this bypasses any ORM event, so nothing is hashed while the transaction is open.
+    Return the number of users actually inserted.
+    """
+
+    statement = _insert_users_ignoring_conflicts(dialect_name(db))
+    inserted = 0
+    for shard, shard_users in group_by_shard(db, users).items():
+        # Unlike an executemany, a multi-row INSERT has a reliable rowcount on every driver
+        for start in range(0, len(shard_users), CREATE_USERS_BATCH_SIZE):
+            batch = shard_users[start : start + CREATE_USERS_BATCH_SIZE]
+            result = await db_execute(db, on_shard(statement.values(batch), shard))
+            inserted += result.rowcount
+    return inserted
+
 
+@timed_stage("crud.get_registered_emails")
+async def get_registered_emails(db: DBSession, emails: List[str]) -> set:
+    """Return which of the given emails are already registered, in a single query per shard"""
 
-def get_user(db: Session, user_id: int):
-    """Get user from DB given its ID"""
+    registered = set()
+    for shard, shard_emails in group_by_shard(db, emails, email=str).items():
+        result = await db_execute(
+            db,
+            on_shard(
+                select(models.User.email).where(models.User.email.in_(shard_emails)),
+                shard,
+            ),
+        )
+        registered.update(result.scalars().all())
+    return registered
 
-    return db.query(models.User).filter(models.User.id == user_id).first()
 
+@timed_stage("crud.update_password_hash")
+async def update_password_hash(
+    db: DBSession, db_user: UserRecord, hashed_password: str
+) -> UserRecord:
+    """Replace the password hash of a user, e.g. rehashed with a new cost, and commit.
 
-def get_user_by_email(db: Session, email: str):
-    """Get user from DB given its email"""
+    The hash is only replaced if it did not change meanwhile, so that a concurrent password
+    change is never overwritten. Return the updated user, written through the cache.
+    """
 
-    return db.query(models.User).filter(models.User.email == email).first()
+    result = await db_execute(
+        db,
+        on_shard(
+            update(models.User)
+            .where(
+                models.User.id == db_user.id,
+                models.User.hashed_password == db_user.hashed_password,
+            )
+            .values(hashed_password=hashed_password),
+            email_shard(db, db_user.email),
+        ),
+    )
+    await db_commit(db)
+
+    if result.rowcount != 1:
+        # Changed meanwhile: the cached user is stale
+        await invalidate_user(db_user.email)
+        return db_user
+
+    record = UserRecord(
+        id=db_user.id,
+        email=db_user.email,
+        hashed_password=hashed_password,
+        two_factor_enabled=db_user.two_factor_enabled,
+        secret=db_user.secret,
+    )
+    await cache_user(record)
+    return record
+
+
+@timed_stage("crud.count_users_by_hash_cost")
+async def count_users_by_hash_cost(db: DBSession) -> Dict[str, int]:
+    """Count users per bcrypt cost factor of their password hash. Scans the whole table of every shard"""
+
+    # bcrypt hashes look like $2b$12$..., with a two digits cost
+    cost = func.substr(models.User.hashed_password, 5, 2)
+    statement = on_replica(select(cost, func.count()).group_by(cost))
+
+    users_by_cost = Counter()
+    for shard in range(shard_count(db)):
+        result = await db_execute(db, on_shard(statement, shard))
+        for row in result.all():
+            users_by_cost[str(row[0])] += row[1]
+    return dict(users_by_cost)
+
+
+@timed_stage("crud.get_shared_secrets")
+async def get_shared_secrets(db: DBSession) -> List[str]:
+    """Return the secrets used by more than one user of the same shard.
+
+    A secret whose users were spread over several shards, one per shard, is not found:
+    rotate shared secrets before adding shards.
+    """
+
+    statement = (
+        select(models.User.secret)
+        .group_by(models.User.secret)
+        .having(func.count(models.User.id) > 1)
+    )
+
+    secrets = set()
+    for shard in range(shard_count(db)):
+        result = await db_execute(db, on_shard(statement, shard))
+        secrets.update(result.scalars().all())
+    return sorted(secrets)
+
+
+@timed_stage("crud.count_users_with_secrets")
+async def count_users_with_secrets(db: DBSession, secrets: List[str]) -> int:
+    statement = select(func.count(models.User.id)).where(
+        models.User.secret.in_(secrets)
+    )
+
+    count = 0
+    for shard in range(shard_count(db)):
+        count += (await db_execute(db, on_shard(statement, shard))).scalar()
+    return count
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    """Create new user and insert into DB"""
+@timed_stage("crud.get_users_with_secrets")
+async def get_users_with_secrets(
+    db: DBSession, secrets: List[str], after_id: int, limit: int
+) -> list:
+    """Return the next users using one of the given secrets, by id after after_id, across shards"""
 
-    db_user = models.User(
-        email=user.email,
-        hashed_password=user.password,
-        two_factor_enabled=user.two_factor_enabled,
+    statement = (
+        select(models.User.id, models.User.email, models.User.secret)
+        .where(models.User.id > after_id, models.User.secret.in_(secrets))
+        .order_by(models.User.id)
+        .limit(limit)
     )
-    db.add(db_user)
-    db.commit()
 
-    # Refresh local instance of db_user, so that it contains any new data from the DB
-    # e.g. the generated ID
-    db.refresh(db_user)
-    return db_user
+    per_shard = []
+    for shard in range(shard_count(db)):
+        per_shard.append((await db_execute(db, on_shard(statement, shard))).all())
+    return list(heapq.merge(*per_shard, key=lambda user: user.id))[:limit]
 
 
-def create_login_attempt(db: Session, db_user: models.User):
-    """Create new login attempt and insert into DB"""
+@timed_stage("crud.update_user_secrets")
+async def update_user_secrets(db: DBSession, updates: List[dict]):
+    """Replace user secrets with a single executemany per shard. Does not commit.
 
-    attempt = models.LoginAttempt(user=db_user)
-    db.add(attempt)
-    db.commit()
+    Each dict holds the user id and email, its old and new secret: a secret changed
+    meanwhile is kept.
+    """
 
-    # Refresh local instance of db_user, so that it contains any new data from the DB
-    # e.g. the generated ID
-    db.refresh(attempt)
+    statement = (
+        update(models.User)
+        .where(
+            models.User.id == bindparam("user_id"),
+            models.User.secret == bindparam("old_secret"),
+        )
+        .values(secret=bindparam("new_secret"))
+        .execution_options(synchronize_session=False)
+    )
+    for shard, shard_updates in group_by_shard(db, updates).items():
+        # Keys named after a column would be added to the SET clause
+        params = [
+            {key: value for key, value in update.items() if key != "email"}
+            for update in shard_updates
+        ]
+        await db_execute(db, on_shard(statement, shard), params)
+
+
+@timed_stage("crud.create_login_attempt")
+async def create_login_attempt(
+    db: DBSession, db_user: models.User, commit: bool = True
+) -> str:
+    """Create new login attempt and insert into DB. Return its identifier.
+
+    db_user can be either a User or a cached UserRecord.
+    Every value is generated client side, so the attempt is never reloaded from the DB.
+    The attempt is inserted on the shard of the user, which its identifier starts with.
+    """
+
+    shard = email_shard(db, db_user.email)
+    identifier = models.make_identifier(shard)
+    await db_execute(
+        db,
+        on_shard(
+            insert(models.LoginAttempt).values(
+                identifier=identifier,
+                user_id=db_user.id,
+                timestamp=datetime.utcnow(),
+                expires_at=models.make_expiry(),
+                consumed=False,
+            ),
+            shard,
+        ),
+    )
+    if commit:
+        await db_commit(db)
+
+    return identifier
+
+
+@timed_stage("crud.consume_login_attempt")
+async def consume_login_attempt(db: DBSession, identifier: str):
+    """Mark a valid login attempt as consumed, and return its user id and secret.
 
-    return attempt
+    Return None if the attempt is missing, expired or already consumed, so that it can be
+    consumed at most once, even by concurrent requests. Does not commit.
+
+    On PostgreSQL this is a single UPDATE ... FROM users ... RETURNING statement.
+    SQLAlchemy does not support RETURNING on SQLite, where the secret is then selected
+    in the same transaction, once the attempt has been consumed.
+    """
+
+    shard = models.identifier_shard(identifier)
+    if shard is None or shard >= shard_count(db):
+        return None
+
+    Attempt, User = models.LoginAttempt, models.User
+    now = datetime.utcnow()
+    consumable = and_(
+        Attempt.identifier == identifier,
+        Attempt.consumed.is_(False),
+        Attempt.expires_at > now,
+    )
+
+    if dialect_name(db) == "postgresql":
+        result = await db_execute(
+            db,
+            on_shard(
+                update(Attempt)
+                .where(consumable, Attempt.user_id == User.id)
+                .values(consumed=True)
+                .returning(User.id.label("user_id"), User.secret),
+                shard,
+            ),
+        )
+        return result.first()
+
+    result = await db_execute(
+        db,
+        on_shard(
+            update(Attempt)
+            .where(consumable)
+            .values(consumed=True)
+            .execution_options(synchronize_session=False),
+            shard,
+        ),
+    )
+    if result.rowcount != 1:
+        return None
+
+    result = await db_execute(
+        db,
+        on_shard(
+            select(User.id.label("user_id"), User.secret)
+            .join(Attempt, Attempt.user_id == User.id)
+            .where(Attempt.identifier == identifier),
+            shard,
+        ),
+    )
+    return result.first()
@@ -1,18 +1,293 @@
+from contextlib import asynccontextmanager
+from typing import List, Union
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
 
 import config
+from metrics import count_queries
+from profiling import record_queries
+from .pool_stats import TimedAsyncAdaptedQueuePool, TimedQueuePool, instrument_engine
+from .replicas import Replica, ReplicaSet
+from .shards import MAX_SHARDS, RoutingSession, Shard
 
 SQLALCHEMY_DATABASE_URL = config.SQLALCHEMY_DATABASE_URL
 
+# Time partitioning of login_attempt is only available on PostgreSQL
+LOGIN_ATTEMPT_PARTITIONED = (
+    config.LOGIN_ATTEMPT_PARTITIONED
+    and make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "postgresql"
+)
+
+# Async drivers used for each backend, when the async path is enabled
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+# A DB session, on either the async or the sync path
+DBSession = Union[AsyncSession, Session]
+# Engines and connections used outside of sessions, e.g. by background maintenance
+DBEngine = Union[AsyncEngine, Engine]
+DBConnection = Union[AsyncConnection, Connection]
+
+
+def make_async_url(url):
+    """Return the given URL with its driver replaced by the matching async driver"""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for backend {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def pool_options(url, is_async=False) -> dict:
+    """Return the connection pool arguments configured for the given URL.
+
+    SQLite file databases keep their default NullPool, as there is nothing to pool.
+    """
+
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+
+    return {
+        "poolclass": TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+        "pool_size": config.DATABASE_POOL_SIZE,
+        "max_overflow": config.DATABASE_MAX_OVERFLOW,
+        "pool_timeout": config.DATABASE_POOL_TIMEOUT,
+        "pool_recycle": config.DATABASE_POOL_RECYCLE,
+        "pool_pre_ping": config.DATABASE_POOL_PRE_PING,
+    }
+
 
 def custom_create_engine(url):
     return create_engine(url, connect_args={"check_same_thread": False})
 
 
-# engine = custom_create_engine(SQLALCHEMY_DATABASE_URL)
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def create_engines(url, name: str):
+    """Create the sync and async engines of a database, instrumented under the given name.
+
+    The async engine only connects when first used.
+    """
+
+    # A request session is used from several threadpool threads, one DB step at a time
+    if url.startswith("sqlite"):
+        sync_engine = custom_create_engine(url)
+    else:
+        sync_engine = create_engine(url, **pool_options(url))
+    instrument_engine(sync_engine, f"{name}sync")
+    count_queries(sync_engine)
+    if config.PROFILING_ENABLED:
+        record_queries(sync_engine)
+
+    async_engine = create_async_engine(
+        make_async_url(url), **pool_options(url, is_async=True)
+    )
+    instrument_engine(async_engine.sync_engine, f"{name}async")
+    count_queries(async_engine.sync_engine)
+    if config.PROFILING_ENABLED:
+        record_queries(async_engine.sync_engine)
+
+    return sync_engine, async_engine
+
+
+def create_replicas(urls: List[str], weights: List[float], name: str) -> ReplicaSet:
+    """Create the read replicas at the given URLs, named after the given prefix"""
+
+    weights = weights + [1.0] * len(urls)
+    return ReplicaSet(
+        [
+            Replica(
+                f"{name}replica{i}",
+                *create_engines(url, f"{name}replica{i}-"),
+                weight=weight,
+            )
+            for i, (url, weight) in enumerate(zip(urls, weights))
+        ]
+    )
+
+
+def shard_replicas(shard: int) -> ReplicaSet:
+    """Create the read replicas of the given shard of DATABASE_SHARD_URLS, from 1"""
+
+    def group(groups: list) -> list:
+        return groups[shard - 1] if shard <= len(groups) else []
+
+    return create_replicas(
+        group(config.DATABASE_SHARD_REPLICA_URLS),
+        group(config.DATABASE_SHARD_REPLICA_WEIGHTS),
+        f"shard{shard}-",
+    )
+
+
+engine, async_engine = create_engines(SQLALCHEMY_DATABASE_URL, "")
+
+# Read replicas of the database, receiving the read-only queries when configured
+replicas = create_replicas(
+    config.DATABASE_REPLICA_URLS, config.DATABASE_REPLICA_WEIGHTS, ""
+)
+
+if len(config.DATABASE_SHARD_URLS) + 1 > MAX_SHARDS:
+    raise ValueError(f"At most {MAX_SHARDS} shards are supported")
+if any(config.DATABASE_SHARD_REPLICA_URLS[len(config.DATABASE_SHARD_URLS) :]):
+    raise ValueError("Read replicas are configured for more shards than there are")
+
+# The database is the first shard, followed by the other shards when configured,
+# each with its own read replicas
+shards = [Shard("shard0", engine, async_engine, replicas)] + [
+    Shard(f"shard{i}", *create_engines(url, f"shard{i}-"), shard_replicas(i))
+    for i, url in enumerate(config.DATABASE_SHARD_URLS, start=1)
+]
+
+# Keep loaded attributes after commit, so that ending a transaction does not trigger reloads
+SessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=engine,
+    class_=RoutingSession,
+    shards=shards,
+)
+AsyncSessionLocal = sessionmaker(
+    autoflush=False,
+    expire_on_commit=False,
+    bind=async_engine,
+    class_=AsyncSession,
+    sync_session_class=RoutingSession,
+    shards=shards,
+    is_async=True,
+)
+
+
+async def dispose_engines():
+    """Close the connections of every engine of this process"""
+
+    for shard in shards:
+        await shard.dispose()
+
 
 Base = declarative_base()
+
+
+# Helpers running a DB step on either kind of session.
+# On the sync path, the blocking call is moved to the threadpool.
+
+
+async def db_execute(db: DBSession, statement, params=None):
+    # A list of params runs the statement with executemany
+    if isinstance(db, AsyncSession):
+        return await db.execute(statement, params)
+    return await run_in_threadpool(db.execute, statement, params)
+
+
+async def db_commit(db: DBSession):
+    if isinstance(db, AsyncSession):
+        return await db.commit()
+    return await run_in_threadpool(db.commit)
+
+
+async def db_rollback(db: DBSession):
+    if isinstance(db, AsyncSession):
+        return await db.rollback()
+    return await run_in_threadpool(db.rollback)
+
+
+async def db_refresh(db: DBSession, instance):
+    if isinstance(db, AsyncSession):
+        return await db.refresh(instance)
+    return await run_in_threadpool(db.refresh, instance)
+
+
+async def db_close(db: DBSession):
+    if isinstance(db, AsyncSession):
+        return await db.close()
+    return await run_in_threadpool(db.close)
+
+
+# Same, on a connection of either kind of engine
+
+
+@asynccontextmanager
+async def engine_connect(engine: DBEngine):
+    if isinstance(engine, AsyncEngine):
+        async with engine.connect() as conn:
+            yield conn
+        return
+
+    conn = await run_in_threadpool(engine.connect)
+    try:
+        yield conn
+    finally:
+        await run_in_threadpool(conn.close)
+
+
+@asynccontextmanager
+async def engine_begin(engine: DBEngine):
+    """Yield a connection in a transaction, committed at the end of the block"""
+
+    if isinstance(engine, AsyncEngine):
+        async with engine.begin() as conn:
+            yield conn
+        return
+
+    async with engine_connect(engine) as conn:
+        transaction = await run_in_threadpool(conn.begin)
+        try:
+            yield conn
+        except BaseException:
+            await run_in_threadpool(transaction.rollback)
+            raise
+        await run_in_threadpool(transaction.commit)
+
+
+async def conn_execute(conn: DBConnection, statement, params=None):
+    if isinstance(conn, AsyncConnection):
+        return await conn.execute(statement, params)
+    if params is None:
+        # Legacy connections would take None for a set of parameters
+        return await run_in_threadpool(conn.execute, statement)
+    return await run_in_threadpool(conn.execute, statement, params)
+
+
+async def conn_autocommit(conn: DBConnection) -> DBConnection:
+    """Return the connection, running each statement in a transaction of its own"""
+
+    if isinstance(conn, AsyncConnection):
+        return await conn.execution_options(isolation_level="AUTOCOMMIT")
+    return conn.execution_options(isolation_level="AUTOCOMMIT")
+
+
+def dialect_name(db: DBSession) -> str:
+    """Name of the dialect of the engine the session is bound to, e.g. "postgresql" """
+
+    return db.get_bind().dialect.name
+
+
+def _routing_session(db: DBSession):
+    session = db.sync_session if isinstance(db, AsyncSession) else db
+    return session if isinstance(session, RoutingSession) else None
+
+
+def shard_count(db: DBSession) -> int:
+    """Number of shards the session routes statements to, 1 for plain sessions"""
+
+    session = _routing_session(db)
+    return len(session.shards) if session and session.shards else 1
+
+
+def reads_from_replicas(db: DBSession, shard: int = 0) -> bool:
+    """Whether the session may still run the statements marked with on_replica() on a replica"""
+
+    session = _routing_session(db)
+    return session is not None and session.reads_from_replicas(shard)
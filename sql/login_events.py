@@ -0,0 +1,194 @@
+"""Audit events of the logins without 2FA, written behind the requests in batches.
+
+A login without 2FA is not followed by an OTP check, so it needs no pending login attempt:
+instead of a login_attempt row inserted and committed by the request, a login_event row is
+buffered in the server worker. A background task inserts the buffered events of each shard
+with multi-row INSERT statements, as soon as LOGIN_EVENT_BATCH_SIZE events are pending,
+and at least every LOGIN_EVENT_FLUSH_INTERVAL seconds, through the engines of the path
+selected by DATABASE_ASYNC.
+
+At most LOGIN_EVENT_BUFFER_SIZE events are kept pending: beyond, new events are dropped and
+counted, so that a slow or unavailable database does not grow the memory of the workers.
+Events which could not be inserted are retried on the next flush. Pending events are flushed
+on shutdown; those of a worker killed abruptly are lost. Logins with 2FA still commit their
+attempt before responding, see auth.attempt_store.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert
+
+import config
+from . import models
+from .database import conn_execute, engine_begin, shards as configured_shards
+from .shards import Shard
+
+logger = logging.getLogger(__name__)
+
+
+class LoginEventBuffer:
+    """Login events pending in this server worker, with the shard of their user"""
+
+    def __init__(
+        self, max_size: int = None, batch_size: int = None, shards: List[Shard] = None
+    ):
+        self.max_size = config.LOGIN_EVENT_BUFFER_SIZE if max_size is None else max_size
+        self.batch_size = batch_size or config.LOGIN_EVENT_BATCH_SIZE
+        self.shards = shards or configured_shards
+        self._events: List[Tuple[int, dict]] = []
+        # Set once batch_size events are pending, and when the flusher must stop.
+        # Created by the flusher in its event loop.
+        self._full: Optional[asyncio.Event] = None
+        self._stop: Optional[asyncio.Event] = None
+
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def record(self, shard: int, user_id: int):
+        """Buffer a login of the given user, living on the given shard. Never blocks"""
+
+        if len(self._events) >= self.max_size:
+            self.dropped += 1
+            return
+
+        self._events.append(
+            (shard, {"user_id": user_id, "timestamp": datetime.utcnow()})
+        )
+        self.recorded += 1
+        if len(self._events) >= self.batch_size and self._full is not None:
+            self._full.set()
+
+    async def flush(self) -> int:
+        """Insert every pending event, in batches of batch_size per shard. Return their number.
+
+        Events which were not inserted, e.g. on a DB error, are pending again.
+        """
+
+        events, self._events = self._events, []
+        by_shard = {}
+        for shard, event in events:
+            by_shard.setdefault(shard, []).append(event)
+
+        flushed = 0
+        try:
+            for shard, shard_events in by_shard.items():
+                engine = self.shards[shard].engine_for(config.SQLALCHEMY_ASYNC)
+                while shard_events:
+                    batch = shard_events[: self.batch_size]
+                    async with engine_begin(engine) as conn:
+                        await conn_execute(
+                            conn, insert(models.LoginEvent).values(batch)
+                        )
+                    del shard_events[: len(batch)]
+                    flushed += len(batch)
+        finally:
+            self.flushed += flushed
+            # Ahead of the events recorded meanwhile, within the size limit
+            pending = [
+                (shard, event)
+                for shard, shard_events in by_shard.items()
+                for event in shard_events
+            ]
+            if pending:
+                self._events[:0] = pending
+                self.dropped += max(len(self._events) - self.max_size, 0)
+                del self._events[self.max_size :]
+        return flushed
+
+    async def run(self, interval: float):
+        """Flush every interval seconds, or as soon as a batch is pending, until stopped.
+
+        A flush in progress is never interrupted: cancelling it after its commit would
+        leave the inserted events pending, and insert them again on the next flush.
+        """
+
+        self._full = asyncio.Event()
+        self._stop = asyncio.Event()
+        while not self._stop.is_set():
+            await _wait(self._full, interval)
+            self._full.clear()
+            if self._stop.is_set():
+                break
+
+            try:
+                await self.flush()
+            except Exception:
+                self.failed_flushes += 1
+                logger.exception("Failed to flush %s login events", len(self._events))
+                # Do not retry in a loop while the buffer stays full
+                await _wait(self._stop, interval)
+
+    def stop(self):
+        """Make the flusher return, once done with the flush in progress if any"""
+
+        if self._stop is not None:
+            self._stop.set()
+            self._full.set()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._events),
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+async def _wait(event: asyncio.Event, timeout: float):
+    """Wait for the event to be set, for at most timeout seconds"""
+
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+_login_events: Optional[LoginEventBuffer] = None
+
+
+def get_login_events() -> LoginEventBuffer:
+    global _login_events
+
+    if _login_events is None:
+        _login_events = LoginEventBuffer()
+    return _login_events
+
+
+_flusher_task: Optional[asyncio.Task] = None
+
+
+def start_flusher():
+    """Start flushing the login events in the background, unless they are disabled"""
+
+    global _flusher_task
+
+    if get_login_events().max_size > 0 and _flusher_task is None:
+        _flusher_task = asyncio.create_task(
+            get_login_events().run(config.LOGIN_EVENT_FLUSH_INTERVAL)
+        )
+
+
+async def stop_flusher():
+    """Stop the background flusher, then flush the pending events a last time"""
+
+    global _flusher_task
+
+    if _flusher_task is not None:
+        get_login_events().stop()
+        await _flusher_task
+        _flusher_task = None
+
+    buffer = get_login_events()
+    if len(buffer):
+        try:
+            await buffer.flush()
+        except Exception:
+            logger.exception("Lost %s login events on shutdown", len(buffer))
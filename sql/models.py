@@ -1,23 +1,87 @@
 # SQLAlchemy models
 import secrets
-from datetime import datetime
-from sqlalchemy import Column, Boolean, Integer, String, DateTime, ForeignKey
-from sqlalchemy.event import listen
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Boolean,
+    Integer,
+    String,
+    DateTime,
+    ForeignKey,
+    Index,
+)
 from sqlalchemy.orm import relationship
 
 import config
 from auth.otp import TOTPManager
-from .database import Base
-from auth.pwd.pwd_context import get_password_hash
+from .database import Base, LOGIN_ATTEMPT_PARTITIONED
 
 
-def hash_user_password(mapper, context, target):
-    """SQLAlchemy event hook for hashing raw passwords"""
-    target.hash_password()
+# User ids are generated client side: seconds since 2022-01-01, the node id of the process
+# (USER_ID_NODE), and a sequence within the second. They are unique across shards and server
+# workers as long as no two running processes share a node id, roughly ordered by signup
+# time, and kept when a user moves to another shard. They fit in 53 bits until 2090, so that
+# JavaScript clients read them exactly.
+USER_ID_EPOCH = 1640995200
+USER_ID_NODE_BITS = 10
+USER_ID_SEQUENCE_BITS = 12
 
 
-def make_identifier():
-    return secrets.token_hex(16)
+class UserIdGenerator:
+    """Generates the user ids of a node, thread safe"""
+
+    def __init__(self, node: int, clock=time.time):
+        if not 0 <= node < 1 << USER_ID_NODE_BITS:
+            raise ValueError(
+                f"User id node {node} is not between 0 and {(1 << USER_ID_NODE_BITS) - 1}"
+            )
+        self.node = node
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._second = 0
+        self._sequence = 0
+
+    def __call__(self) -> int:
+        with self._lock:
+            # Never go back in time, e.g. when the clock is adjusted
+            second = max(int(self.clock()) - USER_ID_EPOCH, self._second)
+            if second == self._second:
+                self._sequence += 1
+                if self._sequence >> USER_ID_SEQUENCE_BITS:
+                    # Sequence exhausted: borrow the next second
+                    second += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._second = second
+            return (
+                (second << USER_ID_NODE_BITS | self.node) << USER_ID_SEQUENCE_BITS
+            ) | self._sequence
+
+
+make_user_id = UserIdGenerator(config.USER_ID_NODE)
+
+
+def make_identifier(shard: int = 0):
+    # The first two hex digits are the shard of the user, which holds the attempt
+    return f"{shard:02x}{secrets.token_hex(15)}"
+
+
+def identifier_shard(identifier: str) -> Optional[int]:
+    """Shard of the login attempt with the given identifier, None if it is malformed"""
+
+    try:
+        return int(identifier[:2], 16)
+    except ValueError:
+        return None
+
+
+def make_expiry():
+    return datetime.utcnow() + timedelta(seconds=config.AUTH_OTP_THRESHOLD_SECONDS)
 
 
 class User(Base):
@@ -25,15 +89,20 @@ class User(Base):
 
     __tablename__ = "users"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(
+        BigInteger,
+        primary_key=True,
+        index=True,
+        autoincrement=False,
+        default=make_user_id,
+    )
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     two_factor_enabled = Column(Boolean, default=False, nullable=False)
-    secret = Column(String, default=TOTPManager.generate_secret(), nullable=False)
-
-    def hash_password(self):
-        """Stores hashed password into DB instead of the raw one"""
-        self.hashed_password = get_password_hash(self.hashed_password)
+    # A new secret per row: the callable is evaluated on each insert
+    secret = Column(String, default=TOTPManager.generate_secret, nullable=False)
+    # Used to find users sharing a secret, see auth.rotate_secrets
+    __table_args__ = (Index("ix_users_secret", "secret"),)
 
 
 class LoginAttempt(Base):
@@ -41,21 +110,50 @@ class LoginAttempt(Base):
 
     __tablename__ = "login_attempt"
 
-    id = Column(Integer(), primary_key=True)
-    identifier = Column(String(), index=True, nullable=False, default=make_identifier)
+    id = Column(Integer(), primary_key=True, autoincrement=True)
+    identifier = Column(String(32), nullable=False, default=make_identifier)
     timestamp = Column(DateTime(), default=datetime.utcnow)
-    user_id = Column(Integer(), ForeignKey("users.id"), nullable=False)
+    # On PostgreSQL the table is partitioned by day of expiry, which must then be part of the key
+    expires_at = Column(
+        DateTime(),
+        nullable=False,
+        default=make_expiry,
+        primary_key=LOGIN_ATTEMPT_PARTITIONED,
+    )
+    # Set once the OTP of this attempt has been checked: an attempt can only be used once
+    consumed = Column(Boolean(), default=False, nullable=False)
+    user_id = Column(BigInteger(), ForeignKey("users.id"), nullable=False)
 
     user = relationship("User", uselist=False)
 
     # Possibly, add more meta info ? status, IP, etc
 
+    if LOGIN_ATTEMPT_PARTITIONED:
+        # Unique indexes of a partitioned table must include the partition key.
+        # Identifiers are 120 random bits, so they are still unique in practice.
+        __table_args__ = (
+            Index(
+                "ix_login_attempt_identifier", "identifier", "expires_at", unique=True
+            ),
+            {"postgresql_partition_by": "RANGE (expires_at)"},
+        )
+    else:
+        __table_args__ = (
+            Index("ix_login_attempt_identifier", "identifier", unique=True),
+            # Used by the reaper to find expired attempts
+            Index("ix_login_attempt_expires_at", "expires_at"),
+        )
+
     def is_valid(self) -> bool:
-        return (
-            datetime.utcnow() - self.timestamp
-        ).seconds < config.AUTH_OTP_THRESHOLD_SECONDS
+        return datetime.utcnow() < self.expires_at
+
+
+class LoginEvent(Base):
+    """A successful login without 2FA, kept for auditing. Written in batches, see sql.login_events"""
 
+    __tablename__ = "login_event"
 
-# Register for new user creation event.
-# Hash its password before storing it
-listen(User, "before_insert", hash_user_password)
+    id = Column(Integer(), primary_key=True, autoincrement=True)
+    # No foreign key: events outlive the users, e.g. when a rebalance moves them to another shard
+    user_id = Column(BigInteger(), nullable=False, index=True)
+    timestamp = Column(DateTime(), nullable=False)
@@ -0,0 +1,158 @@
+"""Connection pool statistics, collected from pool events and exposed on an internal endpoint"""
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Upper bounds, in seconds, of the checkout wait histogram buckets
+CHECKOUT_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+
+class PoolStats:
+    """Counters for a single engine pool. Safe to update from several threads"""
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self._lock = threading.Lock()
+
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_count = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.checkout_wait_buckets = [0] * len(CHECKOUT_WAIT_BUCKETS)
+
+    def incr(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_checkout_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.checkout_timeouts += 1
+            self.checkout_wait_count += 1
+            self.checkout_wait_total += seconds
+            self.checkout_wait_max = max(self.checkout_wait_max, seconds)
+            for i, upper_bound in enumerate(CHECKOUT_WAIT_BUCKETS):
+                if seconds <= upper_bound:
+                    self.checkout_wait_buckets[i] += 1
+                    break
+
+    def snapshot(self) -> dict:
+        """Return the counters, together with the current occupancy of the pool"""
+
+        pool = self.engine.pool
+        with self._lock:
+            waits = self.checkout_wait_count
+            return {
+                "pool_class": type(pool).__name__,
+                # Occupancy gauges are only available on queue pools
+                "size": _gauge(pool, "size"),
+                "checked_in": _gauge(pool, "checkedin"),
+                "checked_out": _gauge(pool, "checkedout"),
+                "overflow": _gauge(pool, "overflow"),
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "soft_invalidations": self.soft_invalidations,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checkout_wait": {
+                    "count": waits,
+                    "avg_seconds": self.checkout_wait_total / waits if waits else 0.0,
+                    "max_seconds": self.checkout_wait_max,
+                    "buckets": {
+                        str(upper_bound): count
+                        for upper_bound, count in zip(
+                            CHECKOUT_WAIT_BUCKETS, self.checkout_wait_buckets
+                        )
+                    },
+                },
+            }
+
+
+def _gauge(pool, name) -> Optional[int]:
+    method = getattr(pool, name, None)
+    return method() if method else None
+
+
+class _TimedCheckoutMixin:
+    """Measures how long a checkout waits for a connection to be available"""
+
+    _pool_stats: Optional[PoolStats] = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            if self._pool_stats is not None:
+                self._pool_stats.record_checkout_wait(
+                    time.perf_counter() - start, timed_out=timed_out
+                )
+
+    def recreate(self):
+        # Pools are recreated on dispose and after a disconnect: keep collecting on the same stats
+        pool = super().recreate()
+        pool._pool_stats = self._pool_stats
+        return pool
+
+
+class TimedQueuePool(_TimedCheckoutMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# Stats of every instrumented engine, by name
+_registry: Dict[str, PoolStats] = {}
+
+
+def instrument_engine(engine, name: str) -> PoolStats:
+    """Start collecting pool statistics for the given (sync) engine"""
+
+    stats = PoolStats(name, engine)
+    if isinstance(engine.pool, _TimedCheckoutMixin):
+        engine.pool._pool_stats = stats
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        stats.incr("connects")
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.incr("checkouts")
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        stats.incr("checkins")
+
+    @event.listens_for(engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        stats.incr("invalidations")
+
+    @event.listens_for(engine, "soft_invalidate")
+    def on_soft_invalidate(dbapi_connection, connection_record, exception):
+        stats.incr("soft_invalidations")
+
+    _registry[name] = stats
+    return stats
+
+
+def get_pool_stats() -> Dict[str, dict]:
+    """Return a snapshot of the stats of every instrumented engine"""
+
+    return {name: stats.snapshot() for name, stats in _registry.items()}
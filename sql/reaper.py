@@ -0,0 +1,311 @@
+"""Background maintenance of the login_attempt table, so that it does not grow without bound.
+
+On PostgreSQL the table is partitioned by day of expiry: partitions are created in advance,
+and whole partitions are dropped once every attempt they hold has expired. Server workers take
+turns through an advisory lock, so that they never run the same DDL concurrently. Attempts
+expiring on a day without a partition yet, e.g. while the reaper was down, go to the default
+partition: they are moved to the partition of their day once it is created.
+Elsewhere, expired attempts are deleted in small batches, each in its own short transaction.
+
+The engines of the configured path are used: async ones with DATABASE_ASYNC, sync ones with
+their calls run in the threadpool otherwise.
+"""
+import asyncio
+import logging
+import random
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, select, text
+
+import config
+from . import models
+from .database import (
+    LOGIN_ATTEMPT_PARTITIONED,
+    DBEngine,
+    conn_autocommit,
+    conn_execute,
+    dispose_engines,
+    engine_begin,
+    engine_connect,
+    shards,
+)
+
+logger = logging.getLogger(__name__)
+
+PARTITION_PREFIX = "login_attempt_p"
+# Partition of the attempts expiring on a day without a partition of its own
+DEFAULT_PARTITION = "login_attempt_default"
+
+# Key of the PostgreSQL advisory lock held while partitions are created or dropped
+PARTITIONS_LOCK_KEY = 0x6C6F67696E5F61
+
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def default_engine() -> DBEngine:
+    """Engine of the first shard, on the configured path"""
+
+    return shards[0].engine_for(config.SQLALCHEMY_ASYNC)
+
+
+async def create_partition(conn, day: date):
+    """Create the partition of login_attempt of the given day, unless it exists.
+
+    Attempts of that day already in the default partition are moved to it.
+    """
+
+    name = partition_name(day)
+    start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+    bounds = f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    exists = (
+        await conn_execute(conn, text(f"SELECT to_regclass('{name}') IS NOT NULL"))
+    ).scalar()
+    if exists:
+        return
+
+    in_default = f"WHERE expires_at >= '{start}' AND expires_at < '{end}'"
+    stranded = (
+        await conn_execute(
+            conn,
+            text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} {in_default})"),
+        )
+    ).scalar()
+    if not stranded:
+        await conn_execute(
+            conn, text(f"CREATE TABLE {name} PARTITION OF login_attempt {bounds}")
+        )
+        return
+
+    # The default partition must not hold attempts of the new partition when attached
+    await conn_execute(
+        conn,
+        text(
+            f"CREATE TABLE {name} "
+            f"(LIKE login_attempt INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        ),
+    )
+    moved = await conn_execute(
+        conn,
+        text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} {in_default} RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ),
+    )
+    await conn_execute(
+        conn, text(f"ALTER TABLE login_attempt ATTACH PARTITION {name} {bounds}")
+    )
+    logger.warning(
+        "Moved %s login attempts from the default partition to %s", moved.rowcount, name
+    )
+
+
+async def ensure_partitions(
+    engine: DBEngine = None, today: date = None, days_ahead: int = None
+):
+    """Create the daily partitions of login_attempt from today to days_ahead days from now"""
+
+    engine = engine or default_engine()
+    today = today or datetime.utcnow().date()
+    days_ahead = (
+        config.LOGIN_ATTEMPT_PARTITIONS_AHEAD if days_ahead is None else days_ahead
+    )
+
+    async with engine_begin(engine) as conn:
+        for i in range(days_ahead + 1):
+            await create_partition(conn, today + timedelta(days=i))
+
+
+async def drop_expired_partitions(engine: DBEngine = None, now: datetime = None) -> int:
+    """Drop the partitions of login_attempt whose attempts have all expired.
+
+    Partitions are detached concurrently first, so that no long lock is taken on the parent table.
+    """
+
+    engine = engine or default_engine()
+    now = now or datetime.utcnow()
+
+    # DETACH ... CONCURRENTLY cannot run inside a transaction block
+    async with engine_connect(engine) as conn:
+        conn = await conn_autocommit(conn)
+        result = await conn_execute(
+            conn,
+            text(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "WHERE parent.relname = 'login_attempt'"
+            ),
+        )
+
+        dropped = 0
+        for (name,) in result.all():
+            try:
+                day = datetime.strptime(name[len(PARTITION_PREFIX) :], "%Y%m%d")
+            except ValueError:
+                # Not one of ours
+                continue
+
+            # The partition holds attempts expiring before the end of its day
+            if day + timedelta(days=1) > now:
+                continue
+
+            await conn_execute(
+                conn,
+                text(f"ALTER TABLE login_attempt DETACH PARTITION {name} CONCURRENTLY"),
+            )
+            await conn_execute(conn, text(f"DROP TABLE {name}"))
+            dropped += 1
+            logger.info("Dropped login attempts partition %s", name)
+
+        # Expired attempts of the default partition, usually none
+        await conn_execute(
+            conn,
+            text(f"DELETE FROM {DEFAULT_PARTITION} WHERE expires_at <= :now"),
+            {"now": now},
+        )
+
+    return dropped
+
+
+async def delete_expired_attempts(
+    engine: DBEngine = None, now: datetime = None, batch_size: int = None
+) -> int:
+    """Delete expired login attempts in batches, committing after each batch"""
+
+    engine = engine or default_engine()
+    now = now or datetime.utcnow()
+    batch_size = batch_size or config.LOGIN_ATTEMPT_REAPER_BATCH_SIZE
+
+    deleted = 0
+    while True:
+        async with engine_begin(engine) as conn:
+            # Workers running the reaper at the same time skip each other's rows (PostgreSQL)
+            expired = (
+                select(models.LoginAttempt.id)
+                .where(models.LoginAttempt.expires_at <= now)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            result = await conn_execute(
+                conn,
+                delete(models.LoginAttempt).where(
+                    models.LoginAttempt.id.in_(expired.scalar_subquery())
+                ),
+            )
+
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+        # Let other transactions through between batches
+        await asyncio.sleep(0)
+
+
+@asynccontextmanager
+async def partitions_lock(engine: DBEngine = None):
+    """Try to take the advisory lock of the partition maintenance, and yield whether it was.
+
+    The lock is held by a connection of its own, for the duration of the block.
+    """
+
+    async with engine_connect(engine or default_engine()) as conn:
+        conn = await conn_autocommit(conn)
+        acquired = (
+            await conn_execute(
+                conn,
+                text("SELECT pg_try_advisory_lock(:key)"),
+                {"key": PARTITIONS_LOCK_KEY},
+            )
+        ).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await conn_execute(
+                    conn,
+                    text("SELECT pg_advisory_unlock(:key)"),
+                    {"key": PARTITIONS_LOCK_KEY},
+                )
+
+
+async def reap_login_attempts(engine: DBEngine = None, now: datetime = None) -> int:
+    """Run a single reaper pass. Return the number of deleted attempts or dropped partitions"""
+
+    engine = engine or default_engine()
+    if LOGIN_ATTEMPT_PARTITIONED:
+        async with partitions_lock(engine) as acquired:
+            if not acquired:
+                # Another server worker is maintaining the partitions right now
+                return 0
+            await ensure_partitions(engine)
+            return await drop_expired_partitions(engine, now=now)
+    return await delete_expired_attempts(engine, now=now)
+
+
+async def reap_all_shards(now: datetime = None) -> int:
+    """Run a reaper pass on every shard"""
+
+    reaped = 0
+    for shard in shards:
+        reaped += await reap_login_attempts(
+            shard.engine_for(config.SQLALCHEMY_ASYNC), now=now
+        )
+    return reaped
+
+
+async def run_reaper(interval: int):
+    """Reap expired login attempts every interval seconds, until cancelled"""
+
+    while True:
+        # Spread the runs of the different server workers
+        await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+        try:
+            reaped = await reap_all_shards()
+            if reaped:
+                logger.debug("Reaped %s expired login attempts", reaped)
+        except Exception:
+            logger.exception("Failed to reap expired login attempts")
+
+
+_reaper_task: Optional[asyncio.Task] = None
+
+
+def start_reaper():
+    """Start the reaper in the background, unless disabled by configuration"""
+
+    global _reaper_task
+
+    if config.LOGIN_ATTEMPT_REAPER_INTERVAL > 0 and _reaper_task is None:
+        _reaper_task = asyncio.create_task(
+            run_reaper(config.LOGIN_ATTEMPT_REAPER_INTERVAL)
+        )
+
+
+async def stop_reaper():
+    global _reaper_task
+
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+        try:
+            await _reaper_task
+        except asyncio.CancelledError:
+            pass
+        _reaper_task = None
+
+
+async def run_once():
+    try:
+        reaped = await reap_all_shards()
+    finally:
+        await dispose_engines()
+    print(f"Reaped {reaped} expired login attempts or partitions")
+
+
+if __name__ == "__main__":
+    # A single pass, e.g. on deployment after the migrations, so that the partitions of the
+    # coming days exist before the server starts
+    asyncio.run(run_once())
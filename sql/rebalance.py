@@ -0,0 +1,127 @@
+"""Offline rebalancing of users across shards, after shards were added to DATABASE_SHARD_URLS.
+
+Every user whose email now hashes to another shard is moved there, with its id. Thanks to the
+jump consistent hash, adding shards only moves users from the existing shards to the new ones,
+about 1 / n of them for n shards. Each shard is scanned in batches by user id:
+
+    - the users of a batch are first inserted on their new shards, skipping emails already
+      there, then deleted from their old shard with their login attempts, each step in its
+      own transaction: an interrupted run is simply run again
+    - progress is reported as a JSON line per batch
+
+Run it while no server worker is running, once the new shards are migrated
+(`alembic upgrade head` migrates every shard). Pending login attempts of the moved users
+are dropped: these users must log in again.
+
+Usage:
+
+    python -m sql.rebalance [--batch-size 1000] [--dry-run]
+"""
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+from typing import Iterator, List
+
+from sqlalchemy import delete, select
+
+from . import models
+from .crud import _insert_users_ignoring_conflicts
+from .database import shards as configured_shards
+from .shards import Shard, shard_for_email
+
+USER_COLUMNS = list(models.User.__table__.columns)
+
+
+def rebalance(
+    shards: List[Shard], batch_size: int = 1000, dry_run: bool = False
+) -> Iterator[dict]:
+    """Move the users which are not on the shard of their email, yielding progress after each batch"""
+
+    for index, shard in enumerate(shards):
+        start = time.perf_counter()
+        last_id = None
+        scanned = 0
+        moved = Counter()
+
+        while True:
+            statement = select(*USER_COLUMNS).order_by(models.User.id).limit(batch_size)
+            if last_id is not None:
+                statement = statement.where(models.User.id > last_id)
+            with shard.engine.connect() as conn:
+                users = [dict(row._mapping) for row in conn.execute(statement)]
+            if not users:
+                break
+            last_id = users[-1]["id"]
+            scanned += len(users)
+
+            targets = {}
+            for user in users:
+                target = shard_for_email(user["email"], len(shards))
+                if target != index:
+                    targets.setdefault(target, []).append(user)
+
+            if not dry_run:
+                move_users(shard, shards, targets)
+            for target, target_users in targets.items():
+                moved[shards[target].name] += len(target_users)
+
+            yield {
+                "shard": shard.name,
+                "scanned": scanned,
+                "moved": dict(moved),
+                "last_id": last_id,
+                "seconds": round(time.perf_counter() - start, 3),
+            }
+
+
+def move_users(source: Shard, shards: List[Shard], targets: dict):
+    """Copy the users to their target shards, then delete them from the source shard"""
+
+    for target, users in targets.items():
+        engine = shards[target].engine
+        with engine.begin() as conn:
+            conn.execute(_insert_users_ignoring_conflicts(engine.dialect.name), users)
+
+    user_ids = [user["id"] for users in targets.values() for user in users]
+    if not user_ids:
+        return
+    with source.engine.begin() as conn:
+        conn.execute(
+            delete(models.LoginAttempt).where(models.LoginAttempt.user_id.in_(user_ids))
+        )
+        conn.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+
+
+def run(batch_size: int, dry_run: bool) -> int:
+    moved = Counter()
+    try:
+        for progress in rebalance(configured_shards, batch_size, dry_run):
+            print(json.dumps(progress), file=sys.stderr, flush=True)
+            moved[progress["shard"]] = sum(progress["moved"].values())
+    finally:
+        for shard in configured_shards:
+            shard.engine.dispose()
+
+    total = sum(moved.values())
+    print(json.dumps({"moved": total, "dry_run": dry_run, "done": True}))
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move users to the shard of their email, after adding shards"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count the users which would move"
+    )
+    args = parser.parse_args(argv)
+
+    run(args.batch_size, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""Routing of read-only queries to read replicas of the primary database.
+
+Statements marked with on_replica() run on a healthy replica, picked at random according to
+the replica weights, see sql.shards.RoutingSession. Everything else runs on the primary.
+Once a session has sent a statement to the primary, its later reads stay there too,
+so that a request reads its own writes.
+
+Replicas are checked in the background: one that cannot be reached, or lags too far
+behind the primary, receives no reads until it recovers. Without any healthy replica,
+reads go to the primary. Each shard has its own replicas, see sql.shards.Shard.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import List, Optional
+
+from sqlalchemy import event, text
+from starlette.concurrency import run_in_threadpool
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Execution option marking the statements which may run on a replica
+REPLICA_OPTION = "replica"
+
+# Seconds since the last transaction replayed by a PostgreSQL replica,
+# 0 when it has replayed everything it received
+POSTGRESQL_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+def on_replica(statement):
+    """Mark a read-only statement as allowed to run on a replica"""
+
+    return statement.execution_options(**{REPLICA_OPTION: True})
+
+
+class Replica:
+    """A read replica, with an engine for each of the sync and async paths"""
+
+    def __init__(self, name: str, engine, async_engine, weight: float = 1):
+        self.name = name
+        self.engine = engine
+        self.async_engine = async_engine
+        self.weight = weight
+
+        self.healthy = True
+        self.lag: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self.reads = 0
+
+        # Stop reading from a replica as soon as one of its connections is lost,
+        # without waiting for the next health check
+        for sync_engine in (engine, async_engine.sync_engine):
+            event.listen(sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect:
+            self.mark_down(str(context.original_exception))
+
+    def mark_down(self, error: str):
+        if self.healthy:
+            logger.warning("Read replica %s is down: %s", self.name, error)
+        self.healthy = False
+        self.last_error = error
+
+    def mark_up(self, lag: Optional[float]):
+        if not self.healthy:
+            logger.warning("Read replica %s is back up", self.name)
+        self.healthy = True
+        self.lag = lag
+        self.last_error = None
+
+    def bind(self, is_async: bool):
+        """Sync engine to bind the sessions of the given path to"""
+
+        return self.async_engine.sync_engine if is_async else self.engine
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "weight": self.weight,
+            "lag_seconds": self.lag,
+            "last_error": self.last_error,
+            "checked_at": self.checked_at,
+            "reads": self.reads,
+        }
+
+
+class ReplicaSet:
+    """Replicas of the primary database, and their health"""
+
+    def __init__(self, replicas: List[Replica], max_lag: float = None):
+        self.replicas = replicas
+        self.max_lag = config.DATABASE_REPLICA_MAX_LAG if max_lag is None else max_lag
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def choose(self) -> Optional[Replica]:
+        """Pick a healthy replica at random, according to the weights. None when all are down"""
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        replica = (
+            healthy[0]
+            if len(healthy) == 1
+            else random.choices(healthy, [replica.weight for replica in healthy])[0]
+        )
+        with self._lock:
+            replica.reads += 1
+        return replica
+
+    async def check(self, replica: Replica, is_async: bool, timeout: float = None):
+        """Check that the replica answers, and does not lag too far behind the primary"""
+
+        timeout = config.DATABASE_REPLICA_CHECK_TIMEOUT if timeout is None else timeout
+
+        try:
+            if is_async:
+                lag = await asyncio.wait_for(self._lag_async(replica), timeout)
+            else:
+                lag = await asyncio.wait_for(
+                    run_in_threadpool(self._lag_sync, replica), timeout
+                )
+        except Exception as e:
+            replica.mark_down(repr(e))
+        else:
+            if lag is not None and lag > self.max_lag:
+                replica.mark_down(f"replication lag of {lag:.1f}s")
+                replica.lag = lag
+            else:
+                replica.mark_up(lag)
+        finally:
+            replica.checked_at = time.time()
+
+    @staticmethod
+    async def _lag_async(replica: Replica) -> Optional[float]:
+        async with replica.async_engine.connect() as conn:
+            return await conn.run_sync(_replication_lag)
+
+    @staticmethod
+    def _lag_sync(replica: Replica) -> Optional[float]:
+        with replica.engine.connect() as conn:
+            return _replication_lag(conn)
+
+    async def check_all(self, is_async: bool):
+        await asyncio.gather(
+            *(self.check(replica, is_async) for replica in self.replicas)
+        )
+
+    async def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+            await replica.async_engine.dispose()
+
+    def stats(self) -> dict:
+        return {replica.name: replica.stats() for replica in self.replicas}
+
+
+def _replication_lag(conn) -> Optional[float]:
+    """Replication lag of the replica behind the connection, in seconds.
+
+    None where it cannot be measured, e.g. on SQLite, where only reachability is checked.
+    """
+
+    if conn.dialect.name == "postgresql":
+        lag = conn.execute(POSTGRESQL_LAG_QUERY).scalar()
+        return float(lag or 0)
+
+    conn.execute(text("SELECT 1"))
+    return None
+
+
+async def run_health_checks(
+    replica_sets: List[ReplicaSet], interval: float, is_async: bool
+):
+    """Check every replica every interval seconds, until cancelled"""
+
+    while True:
+        try:
+            await asyncio.gather(
+                *(replicas.check_all(is_async) for replicas in replica_sets)
+            )
+        except Exception:
+            logger.exception("Failed to check the read replicas")
+        await asyncio.sleep(interval)
+
+
+_health_check_task: Optional[asyncio.Task] = None
+
+
+def start_health_checks(replica_sets: List[ReplicaSet]):
+    """Start checking the replicas of every shard in the background, when there are any"""
+
+    global _health_check_task
+
+    replica_sets = [replicas for replicas in replica_sets if replicas]
+    if replica_sets and _health_check_task is None:
+        _health_check_task = asyncio.create_task(
+            run_health_checks(
+                replica_sets,
+                config.DATABASE_REPLICA_CHECK_INTERVAL,
+                config.SQLALCHEMY_ASYNC,
+            )
+        )
+
+
+async def stop_health_checks():
+    global _health_check_task
+
+    if _health_check_task is not None:
+        _health_check_task.cancel()
+        try:
+            await _health_check_task
+        except asyncio.CancelledError:
+            pass
+        _health_check_task = None
@@ -1,18 +1,28 @@
 # Pydantic models
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
+
+
+def clean_email(email: str) -> str:
+    """Email as stored and looked up, on signup, login and bulk import alike"""
+
+    return email.strip()
 
 
 class UserLogin(BaseModel):
     email: str
     password: str
 
+    _clean_email = validator("email", allow_reuse=True)(clean_email)
+
 
 class UserBase(BaseModel):
     email: str
     two_factor_enabled: bool
 
+    _clean_email = validator("email", allow_reuse=True)(clean_email)
+
 
 class UserCreate(UserBase):
     password: str
@@ -42,3 +52,10 @@ class Response(BaseModel):
 
 class ResponseToken(Response):
     access_token: str
+
+
+class AccessTokenInfo(Response):
+    user_id: int
+    issued_at: int
+    expires_at: int
+    two_factor: bool
@@ -0,0 +1,123 @@
+"""Hash sharding of users across several databases.
+
+Each user lives on the shard picked by a jump consistent hash of their normalized email,
+together with their login attempts. When shards are added, only the users whose shard
+changed have to move, see sql.rebalance.
+
+Request sessions are RoutingSessions, bound to every shard: crud marks each statement with
+the shard it targets, and the read-only ones with on_replica(). Statements without a shard,
+e.g. ORM flushes, run on the first shard.
+"""
+import hashlib
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from .replicas import REPLICA_OPTION, ReplicaSet
+
+# Execution option holding the index of the shard a statement runs on
+SHARD_OPTION = "shard"
+
+# Login attempt identifiers start with the shard index, on two hex digits
+MAX_SHARDS = 256
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash of a 64 bits key, see https://arxiv.org/abs/1406.2294.
+
+    Going from n to n + 1 buckets only moves 1 / (n + 1) of the keys, all to the new bucket.
+    """
+
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_for_email(email: str, shards: int) -> int:
+    """Index of the shard holding the user with the given email, stable across processes"""
+
+    if shards == 1:
+        return 0
+
+    digest = hashlib.blake2b(normalize_email(email).encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "big"), shards)
+
+
+def on_shard(statement, shard: int):
+    """Mark a statement as running on the given shard"""
+
+    return statement.execution_options(**{SHARD_OPTION: shard})
+
+
+class Shard:
+    """A database holding a share of the users, with its own engines and read replicas"""
+
+    def __init__(self, name: str, engine, async_engine, replicas: ReplicaSet = None):
+        self.name = name
+        self.engine = engine
+        self.async_engine = async_engine
+        self.replicas = replicas or ReplicaSet([])
+
+    def bind(self, is_async: bool):
+        """Sync engine to bind the sessions of the given path to"""
+
+        return self.async_engine.sync_engine if is_async else self.engine
+
+    def engine_for(self, is_async: bool):
+        """Engine of the given path, for work done outside of sessions"""
+
+        return self.async_engine if is_async else self.engine
+
+    async def dispose(self):
+        self.engine.dispose()
+        await self.async_engine.dispose()
+        await self.replicas.dispose()
+
+
+def _execution_options(clause) -> dict:
+    get_execution_options = getattr(clause, "get_execution_options", None)
+    return get_execution_options() if get_execution_options else {}
+
+
+class RoutingSession(Session):
+    """Session running each statement on its shard, or on a replica of it when allowed.
+
+    Once a statement ran on a primary, later reads stay on the primaries, so that they see
+    its writes. Used as the sync session of AsyncSession too: is_async then selects the
+    engines of the async path.
+    """
+
+    def __init__(
+        self, *args, shards: List[Shard] = None, is_async: bool = False, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.shards = shards or []
+        self.is_async = is_async
+        # Set once a statement ran on a primary
+        self.sticky = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if clause is None or bind is not None or not self.shards:
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+        options = _execution_options(clause)
+        shard = self.shards[options.get(SHARD_OPTION, 0)]
+        if options.get(REPLICA_OPTION) and not self.sticky and not self._flushing:
+            replica = shard.replicas.choose()
+            if replica is not None:
+                return replica.bind(self.is_async)
+
+        self.sticky = True
+        return shard.bind(self.is_async)
+
+    def reads_from_replicas(self, shard: int = 0) -> bool:
+        """Whether the next statement marked with on_replica() may run on a replica"""
+
+        return bool(self.shards and self.shards[shard].replicas) and not self.sticky
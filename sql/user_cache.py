@@ -0,0 +1,217 @@
+"""Cache of user records by email, in front of crud.get_user_by_email.
+
+Lookups of unknown emails are cached too ("negative" entries), with a shorter TTL, unless
+other server workers could create these users without invalidating the entries.
+crud writes through the cache, and publishes invalidations to the other server workers
+when USER_CACHE_INVALIDATION is "redis".
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import config
+from kv.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "user_cache:invalidate"
+
+# Identifies this server worker in invalidation messages
+WORKER_ID = f"{os.getpid()}-{id(object())}"
+
+# Returned by UserCache.get when there is no usable entry
+MISSING = object()
+
+
+class UserRecord:
+    """Read-only copy of a user row, safe to share between requests and sessions"""
+
+    __slots__ = ("id", "email", "hashed_password", "two_factor_enabled", "secret")
+
+    def __init__(self, id, email, hashed_password, two_factor_enabled, secret):
+        self.id = id
+        self.email = email
+        self.hashed_password = hashed_password
+        self.two_factor_enabled = two_factor_enabled
+        self.secret = secret
+
+    @classmethod
+    def from_model(cls, db_user) -> "UserRecord":
+        return cls(
+            id=db_user.id,
+            email=db_user.email,
+            hashed_password=db_user.hashed_password,
+            two_factor_enabled=db_user.two_factor_enabled,
+            secret=db_user.secret,
+        )
+
+
+class UserCache:
+    """Bounded LRU cache with per-entry expiry"""
+
+    def __init__(
+        self, max_size: int, ttl: float, negative_ttl: float, cache_missing: bool = True
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_missing = cache_missing
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, email: str):
+        """Return the cached record, None for a known missing user, or MISSING"""
+
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            expires_at, record = entry
+            if expires_at <= time.monotonic():
+                del self._entries[email]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(email)
+            if record is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return record
+
+    def set(self, email: str, record: Optional[UserRecord]):
+        if self.max_size <= 0 or (record is None and not self.cache_missing):
+            return
+
+        ttl = self.ttl if record is not None else self.negative_ttl
+        with self._lock:
+            self._entries[email] = (time.monotonic() + ttl, record)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, email: str):
+        with self._lock:
+            if self._entries.pop(email, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.negative_hits) / lookups
+                if lookups
+                else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+user_cache = UserCache(
+    max_size=config.USER_CACHE_SIZE,
+    ttl=config.USER_CACHE_TTL,
+    negative_ttl=config.USER_CACHE_NEGATIVE_TTL,
+    cache_missing=(
+        config.USER_CACHE_INVALIDATION == "redis" or config.WEB_CONCURRENCY == 1
+    ),
+)
+
+
+async def cache_user(record: UserRecord):
+    """Write a new or updated user through the cache, replacing entries in every server worker"""
+
+    user_cache.set(record.email, record)
+    await publish_invalidation(record.email)
+
+
+async def invalidate_user(email: str):
+    """Drop the cached user in this server worker, and in the others if configured"""
+
+    user_cache.invalidate(email)
+    await publish_invalidation(email)
+
+
+async def publish_invalidation(email: str):
+    """Ask the other server workers to drop their cached entry for the given email"""
+
+    if config.USER_CACHE_INVALIDATION != "redis":
+        return
+
+    message = json.dumps({"email": email, "origin": WORKER_ID})
+    try:
+        await get_redis().publish(INVALIDATION_CHANNEL, message)
+    except Exception:
+        # Other workers fall back to the entry TTL
+        logger.exception("Failed to publish user cache invalidation")
+
+
+async def run_invalidation_listener():
+    """Drop cached users invalidated by other server workers, until cancelled"""
+
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Entries cached while not subscribed may have missed invalidations
+            user_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                data = json.loads(message["data"])
+                if data["origin"] != WORKER_ID:
+                    user_cache.invalidate(data["email"])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("User cache invalidation listener failed, reconnecting")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
+
+
+_listener_task: Optional[asyncio.Task] = None
+
+
+def start_invalidation_listener():
+    global _listener_task
+
+    if config.USER_CACHE_INVALIDATION == "redis" and _listener_task is None:
+        _listener_task = asyncio.create_task(run_invalidation_listener())
+
+
+async def stop_invalidation_listener():
+    global _listener_task
+
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
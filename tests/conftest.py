@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from sql.database import Base, custom_create_engine, make_async_url
+
+
+class TestingDatabase:
+    """SQLite file database of a single test, reached through a sync and an async engine"""
+
+    def __init__(self, path):
+        self.url = f"sqlite:///{path}"
+        self.engine = custom_create_engine(self.url)
+        self.async_engine = create_async_engine(make_async_url(self.url))
+        self.SessionLocal = sessionmaker(
+            autocommit=False, autoflush=False, expire_on_commit=False, bind=self.engine
+        )
+        self.AsyncSessionLocal = sessionmaker(
+            autoflush=False,
+            expire_on_commit=False,
+            bind=self.async_engine,
+            class_=AsyncSession,
+        )
+
+    def dispose(self):
+        self.engine.dispose()
+        asyncio.run(self.async_engine.dispose())
+
+
+# Each test gets a database of its own, with the tables of the models
+@pytest.fixture()
+def database(tmp_path):
+    database = TestingDatabase(tmp_path / "test.db")
+    Base.metadata.create_all(bind=database.engine)
+    yield database
+    database.dispose()
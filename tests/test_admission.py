@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from auth import admission
+from auth.admission import AdmissionController
+from auth.rate_limit import get_rate_limiter
+from main import app
+from sql.user_cache import user_cache
+
+
+def test_requests_beyond_the_queue_are_shed():
+    controller = AdmissionController(max_in_flight=2, max_queue=1, queue_timeout=1)
+    order = []
+
+    async def hash_password(name, release):
+        async with controller.admit("signup"):
+            order.append(name)
+            await release.wait()
+
+    async def overload():
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hash_password(i, release)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert (controller.in_flight, controller.queued) == (2, 1)
+
+        with pytest.raises(HTTPException) as e:
+            await hash_password(3, release)
+        assert e.value.status_code == 503
+        assert e.value.headers == {"Retry-After": "1"}
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(overload())
+    # The queued request got the first released slot
+    assert order == [0, 1, 2]
+    assert controller.stats() == {
+        "max_in_flight": 2,
+        "max_queue": 1,
+        "queue_timeout": 1,
+        "in_flight": 0,
+        "queued": 0,
+        "admitted": 3,
+        "shed": {"queue_full": 1},
+    }
+
+
+def test_queued_requests_are_shed_after_the_timeout():
+    controller = AdmissionController(max_in_flight=1, max_queue=10, queue_timeout=0.05)
+
+    async def overload():
+        await controller.acquire("login")
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        results = await asyncio.gather(
+            *(controller.acquire("login") for _ in range(3)), return_exceptions=True
+        )
+        assert loop.time() - start < 0.5
+        assert all(isinstance(result, HTTPException) for result in results)
+
+        # The slot is free again once released
+        controller.release()
+        await controller.acquire("login")
+        controller.release()
+
+    asyncio.run(overload())
+    assert controller.stats()["shed"] == {"timeout": 3}
+    assert (controller.in_flight, controller.queued) == (0, 0)
+
+
+def test_overloaded_signups_get_a_503(monkeypatch):
+    controller = AdmissionController(max_in_flight=1, max_queue=0)
+    # A hash already running
+    controller.in_flight = 1
+    monkeypatch.setattr(admission, "_hash_admission", controller)
+
+    user = {
+        "email": "walterwhite@gmail.com",
+        "password": "password",
+        "two_factor_enabled": False,
+    }
+    # Known not to be registered, so that the signup reaches the hashing
+    user_cache.set(user["email"], None)
+    try:
+        response = TestClient(app).post("/auth/signup/", json=user)
+    finally:
+        get_rate_limiter().clear()
+        user_cache.clear()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert controller.stats()["shed"] == {"queue_full": 1}
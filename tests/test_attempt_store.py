@@ -0,0 +1,100 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+from fakeredis.aioredis import FakeRedis
+
+from auth.attempt_store import (
+    AttemptStore,
+    MemoryAttemptStore,
+    RedisAttemptStore,
+    SQLAttemptStore,
+)
+from sql import models
+
+
+@pytest.fixture(params=["sql", "memory", "redis"])
+def store(request):
+    return {
+        "sql": lambda: SQLAttemptStore(),
+        "memory": lambda: MemoryAttemptStore(),
+        "redis": lambda: RedisAttemptStore(client=FakeRedis()),
+    }[request.param]()
+
+
+async def create_user(db):
+    db_user = models.User(email="walterwhite@gmail.com", hashed_password="x")
+    db.add(db_user)
+    await db.commit()
+    return db_user
+
+
+def test_create_and_consume_attempt(store, database):
+    async def run():
+        async with database.AsyncSessionLocal() as db:
+            db_user = await create_user(db)
+            identifier = await store.create(db, db_user)
+            await db.commit()
+
+            attempt = await store.consume(db, identifier)
+            replayed = await store.consume(db, identifier)
+            missing = await store.consume(db, "x")
+            await db.commit()
+            return db_user, attempt, replayed, missing
+
+    db_user, attempt, replayed, missing = asyncio.run(run())
+
+    assert attempt.user_id == db_user.id
+    assert attempt.secret == db_user.secret
+    # An attempt can only be consumed once
+    assert replayed is None
+    assert missing is None
+
+
+def test_memory_store_expires_and_evicts():
+    store = MemoryAttemptStore(ttl=60, max_size=2)
+    db_user = models.User(id=1, secret="JBSWY3DPEHPK3PXP")
+
+    async def run():
+        first = await store.create(None, db_user)
+        second = await store.create(None, db_user)
+        third = await store.create(None, db_user)
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+
+    # The oldest attempt is evicted once the store is full
+    assert asyncio.run(store.consume(None, first)) is None
+    assert asyncio.run(store.consume(None, third)) is not None
+
+    store.ttl = 0
+    expired = asyncio.run(store.create(None, db_user))
+    assert asyncio.run(store.consume(None, expired)) is None
+
+
+def test_incomplete_stores_cannot_be_created():
+    class CreateOnlyStore(AttemptStore):
+        async def create(self, db, db_user):
+            return "identifier"
+
+    with pytest.raises(TypeError):
+        CreateOnlyStore()
+
+
+@pytest.mark.parametrize(
+    "backend,workers,fails",
+    [("memory", 4, True), ("memory", 1, False), ("sql", 4, False)],
+)
+def test_memory_store_is_refused_with_several_workers(backend, workers, fails):
+    env = dict(os.environ, LOGIN_ATTEMPT_STORE=backend, WEB_CONCURRENCY=str(workers))
+    # Checked on import, so that a misconfigured server does not start
+    result = subprocess.run(
+        [sys.executable, "-c", "import auth.attempt_store"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert (result.returncode != 0) == fails
+    assert ("LOGIN_ATTEMPT_STORE=memory" in result.stderr) == fails
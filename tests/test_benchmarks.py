@@ -0,0 +1,21 @@
+from benchmarks.results import compare, percentile, summarize
+
+
+def test_summarize_percentiles():
+    summary = summarize([i / 1000 for i in range(1, 101)], elapsed=2.0)
+
+    assert summary["count"] == 100
+    assert summary["ops_per_sec"] == 50
+    assert round(summary["p50_ms"]) == 50
+    assert round(summary["p99_ms"]) == 99
+    assert percentile([], 0.5) == 0.0
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": {"load.login": {"p99_ms": 100.0, "ops_per_sec": 50.0}}}
+    current = {"results": {"load.login": {"p99_ms": 150.0, "ops_per_sec": 52.0}}}
+
+    rows = {row["metric"]: row for row in compare(current, baseline, threshold=0.1)}
+
+    assert rows["p99_ms"]["regression"] is True
+    assert rows["ops_per_sec"]["regression"] is False
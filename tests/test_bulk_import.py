@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+
+from auth.bulk_import import aiter_lines, import_users
+from auth.pwd.pwd_context import get_password_hash, verify_password
+from sql import crud, models
+
+
+def run_import(database, lines, fmt, chunk_size):
+    async def run():
+        return [
+            report.as_dict()
+            async for report in import_users(
+                aiter_lines(lines), fmt, chunk_size, database.AsyncSessionLocal
+            )
+        ]
+
+    return asyncio.run(run())
+
+
+def test_import_jsonl_in_chunks(database):
+    hashed = get_password_hash("Heisenberg")
+    lines = [
+        json.dumps({"email": "walterwhite@gmail.com", "password": "SayMyName"}),
+        json.dumps(
+            {
+                "email": "jessepinkman@gmail.com",
+                "hashed_password": hashed,
+                "two_factor_enabled": True,
+            }
+        ),
+        json.dumps({"email": "walterwhite@gmail.com", "password": "Again"}),
+        "not json",
+        json.dumps({"email": "saulgoodman@gmail.com", "hashed_password": "plain"}),
+    ]
+
+    reports = run_import(database, lines, "jsonl", chunk_size=3)
+
+    assert [report["received"] for report in reports] == [3, 2]
+    assert reports[0]["inserted"] == 2
+    assert reports[0]["duplicates"] == 1
+    assert [error["line"] for error in reports[1]["errors"]] == [4, 5]
+
+    with database.SessionLocal() as db:
+        users = {user.email: user for user in db.query(models.User).all()}
+
+    assert set(users) == {"walterwhite@gmail.com", "jessepinkman@gmail.com"}
+    assert verify_password("SayMyName", users["walterwhite@gmail.com"].hashed_password)
+    assert users["jessepinkman@gmail.com"].hashed_password == hashed
+    assert users["jessepinkman@gmail.com"].two_factor_enabled is True
+    assert (
+        users["walterwhite@gmail.com"].secret != users["jessepinkman@gmail.com"].secret
+    )
+
+
+def test_import_csv_skips_registered_emails(database):
+    hashed = get_password_hash("SayMyName")
+    lines = [
+        "email,hashed_password,two_factor_enabled\n",
+        f"walterwhite@gmail.com,{hashed},true\n",
+    ]
+
+    assert run_import(database, lines, "csv", chunk_size=10)[0]["inserted"] == 1
+
+    report = run_import(database, lines, "csv", chunk_size=10)[0]
+    assert report["inserted"] == 0
+    assert report["already_registered"] == 1
+
+
+def test_csv_fields_may_span_lines(database):
+    hashed = get_password_hash("SayMyName")
+    lines = [
+        "email,hashed_password,comment\n",
+        f'walterwhite@gmail.com,{hashed},"Chemistry\n',
+        'teacher, ""Heisenberg"""\n',
+        "\n",
+        f"jessepinkman@gmail.com,{hashed}\n",
+    ]
+
+    report = run_import(database, lines, "csv", chunk_size=10)[0]
+    assert report["inserted"] == 1
+    assert report["errors"] == [{"line": 5, "error": "expected 3 fields"}]
+
+
+def test_emails_registered_meanwhile_are_not_counted(database, monkeypatch):
+    lines = [json.dumps({"email": "walterwhite@gmail.com", "password": "SayMyName"})]
+    assert run_import(database, lines, "jsonl", chunk_size=10)[0]["inserted"] == 1
+
+    # As if the user signed up between the check and the insert
+    async def nothing_registered(db, emails):
+        return set()
+
+    monkeypatch.setattr(crud, "get_registered_emails", nothing_registered)
+    report = run_import(database, lines, "jsonl", chunk_size=10)[0]
+    assert report["inserted"] == 0
+    assert report["errors"] == []
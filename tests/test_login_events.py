@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+import config
+from auth.rate_limit import get_rate_limiter
+from main import app, get_db
+from sql import login_events, models
+from sql.database import Base, db_close
+from sql.login_events import LoginEventBuffer
+from sql.shards import Shard
+from sql.user_cache import user_cache
+
+
+@pytest.fixture()
+def shard(database):
+    return Shard("shard0", database.engine, database.async_engine)
+
+
+def count(shard, model):
+    with shard.engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(model)).scalar()
+
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_events_are_flushed_in_batches_within_the_size_limit(
+    shard, is_async, monkeypatch
+):
+    # The sync path runs the inserts in the threadpool
+    monkeypatch.setattr(config, "SQLALCHEMY_ASYNC", is_async)
+    buffer = LoginEventBuffer(max_size=5, batch_size=2, shards=[shard])
+    for user_id in range(7):
+        buffer.record(0, user_id)
+    assert buffer.stats()["pending"] == 5
+    assert buffer.dropped == 2
+
+    assert asyncio.run(buffer.flush()) == 5
+    assert count(shard, models.LoginEvent) == 5
+    assert buffer.stats() == {
+        "pending": 0,
+        "recorded": 5,
+        "flushed": 5,
+        "dropped": 2,
+        "failed_flushes": 0,
+    }
+
+
+def test_events_are_kept_when_a_flush_fails(shard):
+    buffer = LoginEventBuffer(max_size=3, batch_size=2, shards=[shard])
+    buffer.record(0, 1)
+    buffer.record(0, 2)
+    Base.metadata.tables["login_event"].drop(bind=shard.engine)
+
+    with pytest.raises(Exception):
+        asyncio.run(buffer.flush())
+    assert len(buffer) == 2
+
+    Base.metadata.tables["login_event"].create(bind=shard.engine)
+    buffer.record(0, 3)
+    buffer.record(0, 4)
+    assert buffer.dropped == 1
+
+    assert asyncio.run(buffer.flush()) == 3
+    with shard.engine.connect() as conn:
+        user_ids = conn.execute(select(models.LoginEvent.user_id)).scalars().all()
+    assert sorted(user_ids) == [1, 2, 3]
+
+
+def test_logins_without_2fa_only_record_an_event(shard, database, monkeypatch):
+    buffer = LoginEventBuffer(max_size=100, batch_size=10, shards=[shard])
+    monkeypatch.setattr(login_events, "_login_events", buffer)
+
+    async def get_testing_db():
+        db = database.SessionLocal()
+        try:
+            yield db
+        finally:
+            await db_close(db)
+
+    app.dependency_overrides[get_db] = get_testing_db
+    client = TestClient(app)
+    try:
+        for email, two_factor_enabled in (
+            ("plain@gmail.com", False),
+            ("2fa@gmail.com", True),
+        ):
+            user = {
+                "email": email,
+                "password": "password",
+                "two_factor_enabled": two_factor_enabled,
+            }
+            assert client.post("/auth/signup/", json=user).status_code == 200
+            assert client.post("/auth/login/", json=user).status_code == 200
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        get_rate_limiter().clear()
+        user_cache.clear()
+
+    # Signup and login of the 2FA user each saved an attempt, signups record no event
+    assert count(shard, models.LoginAttempt) == 2
+    assert count(shard, models.LoginEvent) == 0
+    assert buffer.recorded == 1
+
+    asyncio.run(login_events.stop_flusher())
+    assert count(shard, models.LoginEvent) == 1
+
+
+def test_stopping_the_flusher_lets_the_flush_in_progress_finish(shard):
+    buffer = LoginEventBuffer(max_size=10, batch_size=2, shards=[shard])
+
+    async def stop_while_flushing():
+        task = asyncio.create_task(buffer.run(interval=60))
+        await asyncio.sleep(0)
+        buffer.record(0, 1)
+        buffer.record(0, 2)
+        # Wait for the flusher to take the batch
+        while len(buffer):
+            await asyncio.sleep(0)
+        buffer.stop()
+        await task
+        return await buffer.flush()
+
+    assert asyncio.run(stop_while_flushing()) == 0
+    assert count(shard, models.LoginEvent) == 2
+    assert buffer.flushed == 2
@@ -0,0 +1,69 @@
+import logging
+import logging.handlers
+import queue
+
+from logs import LazyQueueHandler, QueueListener, RedactingFormatter, SamplingFilter
+from sql import schemas
+
+
+def make_record(msg, *args, level=logging.DEBUG, name="test"):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_redacts_models_dicts_and_messages():
+    formatter = RedactingFormatter("%(message)s")
+
+    user = schemas.UserLogin(email="a@b.com", password="hunter22")
+    message = formatter.format(make_record("received data: %s", user))
+    assert "a@b.com" in message
+    assert "hunter22" not in message
+
+    message = formatter.format(make_record("%(otp_code)s", {"otp_code": "123456"}))
+    assert "123456" not in message
+
+    message = formatter.format(
+        make_record('body {"password": "hunter22", "email": "a@b.com"}')
+    )
+    assert "hunter22" not in message
+    assert "a@b.com" in message
+
+    message = formatter.format(
+        make_record("received data: otp_code='123456' identifier='abc'")
+    )
+    assert "123456" not in message
+    assert "identifier='abc'" in message
+
+
+def test_sampling_filter_per_logger():
+    sampling = SamplingFilter(rate=0.001, burst=3)
+
+    passed = [sampling.filter(make_record("x")) for _ in range(5)]
+    assert passed == [True, True, True, False, False]
+    assert sampling.dropped == {"test": 2}
+
+    # Other loggers have their own budget, and warnings are never sampled
+    assert sampling.filter(make_record("x", name="other"))
+    assert sampling.filter(make_record("x", level=logging.WARNING))
+
+
+def test_queue_handler_formats_in_listener():
+    log_queue = queue.Queue(maxsize=1)
+    handler = LazyQueueHandler(log_queue)
+
+    record = make_record("received data: %s", {"password": "hunter22"})
+    handler.handle(record)
+    handler.handle(make_record("dropped"))
+
+    # Records are queued unformatted, and dropped once the queue is full
+    queued = log_queue.get_nowait()
+    assert queued.args == record.args
+    assert handler.dropped == 1
+
+    target = logging.handlers.BufferingHandler(10)
+    target.setFormatter(RedactingFormatter("%(message)s"))
+    listener = QueueListener(log_queue, target)
+    listener.start()
+    handler.handle(record)
+    listener.stop()
+
+    assert target.format(target.buffer[0]) == "received data: {'password': '***'}"
@@ -1,34 +1,47 @@
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import sessionmaker
-
-from sql.database import Base, custom_create_engine
+from passlib.hash import bcrypt
+
+from sql import models
+from sql.database import db_close
+import config
+from auth import managers
+from auth.otp import totp_engine
+from auth.pwd.pwd_context import hash_cost
+from auth.rate_limit import get_rate_limiter
+from sql.user_cache import user_cache
 from main import app, get_db
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-
-engine = custom_create_engine(SQLALCHEMY_DATABASE_URL)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-
-# Dependency override, using TestingSession
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
-
-
-app.dependency_overrides[get_db] = override_get_db
-
-
-# Use pytest fixture to create tables and drop them between each test
-@pytest.fixture()
-def test_db():
-    Base.metadata.create_all(bind=engine)
-    yield
-    Base.metadata.drop_all(bind=engine)
+# Dependency overrides, using a sync session on the sync path and an async one on the async path
+def override_get_db(session_factory):
+    async def get_testing_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            await db_close(db)
+
+    return get_testing_db
+
+
+# Every test runs against both the async and the sync DB path, on a database of its own.
+@pytest.fixture(params=["async", "sync"])
+def test_db(request, database):
+    session_factory = {
+        "async": database.AsyncSessionLocal,
+        "sync": database.SessionLocal,
+    }[request.param]
+    app.dependency_overrides[get_db] = override_get_db(session_factory)
+
+    yield database
+    # The database is discarded under the cache
+    user_cache.clear()
+    get_rate_limiter().clear()
+    # User ids are reused by the next test
+    totp_engine.clear()
+    # The client keeps the access token cookie between requests
+    client.cookies.clear()
+    app.dependency_overrides.pop(get_db, None)
 
 
 client = TestClient(app)
@@ -48,6 +61,8 @@ def test_signup_2fa_disabled(test_db):
     data = response.json()
     assert "status" in data
     assert data["status"] == "OK"
+    # Signup sets no cookie
+    assert "set-cookie" not in response.headers
 
 
 def test_signup_2fa_enabled(test_db):
@@ -65,6 +80,29 @@ def test_signup_2fa_enabled(test_db):
     assert data["email"] == "walterwhite@gmail.com"
     assert "id" in data
     assert data["two_factor_enabled"] is True
+    # Only the schemas.User fields are returned
+    assert set(data) == {"email", "id", "two_factor_enabled"}
+
+
+def test_emails_are_stored_without_surrounding_spaces(test_db):
+    response = client.post(
+        app.url_path_for("signup"),
+        json={
+            "email": " walterwhite@gmail.com ",
+            "password": "SayMyName",
+            "two_factor_enabled": False,
+        },
+    )
+    assert response.status_code == 200, response.text
+
+    # As a bulk import stores them
+    with test_db.SessionLocal() as db:
+        assert db.query(models.User.email).scalar() == "walterwhite@gmail.com"
+    response = client.post(
+        app.url_path_for("login"),
+        json={"email": "walterwhite@gmail.com", "password": "SayMyName"},
+    )
+    assert response.status_code == 200, response.text
 
 
 def test_signup_already_registered(test_db):
@@ -92,6 +130,61 @@ def test_signup_already_registered(test_db):
     assert data["detail"] == "Email already registered"
 
 
+def test_signup_already_registered_conflict(test_db):
+    client.post(
+        app.url_path_for("signup"),
+        json={
+            "email": "walterwhite@gmail.com",
+            "password": "SayMyName",
+            "two_factor_enabled": True,
+        },
+    )
+
+    # Against a stale entry of the cache, the conflict is detected by the insert itself
+    user_cache.set("walterwhite@gmail.com", None)
+    response = client.post(
+        app.url_path_for("signup"),
+        json={
+            "email": "walterwhite@gmail.com",
+            "password": "SayMyName",
+            "two_factor_enabled": True,
+        },
+    )
+
+    assert response.status_code == 400, response.text
+    data = response.json()
+    assert data["detail"] == "Email already registered"
+
+
+def test_signup_already_registered_is_rejected_before_hashing(test_db, monkeypatch):
+    client.post(
+        app.url_path_for("signup"),
+        json={
+            "email": "walterwhite@gmail.com",
+            "password": "SayMyName",
+            "two_factor_enabled": True,
+        },
+    )
+
+    async def no_hashing(password):
+        raise AssertionError("Password hashed for a registered email")
+
+    # Not cached, e.g. after a restart: found in the database
+    user_cache.clear()
+    monkeypatch.setattr(managers, "hash_password_async", no_hashing)
+    response = client.post(
+        app.url_path_for("signup"),
+        json={
+            "email": "walterwhite@gmail.com",
+            "password": "SayMyName",
+            "two_factor_enabled": True,
+        },
+    )
+
+    assert response.status_code == 400, response.text
+    assert response.json()["detail"] == "Email already registered"
+
+
 def test_login_two_factor_disabled_correct_password(test_db):
     signup_response = client.post(
         app.url_path_for("signup"),
@@ -121,6 +214,12 @@ def test_login_two_factor_disabled_correct_password(test_db):
     assert data["status"] == "OK"
 
     assert "access_token" in data
+    assert login_response.cookies["access_token"] == data["access_token"]
+
+    # The cookie is enough to verify the token
+    verify_response = client.get(app.url_path_for("verify"))
+    assert verify_response.status_code == 200, verify_response.text
+    assert verify_response.json()["two_factor"] is False
 
 
 def test_login_two_factor_disabled_wrong_password(test_db):
@@ -252,3 +351,107 @@ def test_login_two_factor_enabled_correct_otp(test_db):
     assert data["status"] == "OK"
 
     assert "access_token" in data
+
+    verify_response = client.get(
+        app.url_path_for("verify"),
+        headers={"Authorization": f"Bearer {data['access_token']}"},
+    )
+    assert verify_response.status_code == 200, verify_response.text
+    data = verify_response.json()
+    assert data["user_id"] == signup_user_id
+    assert data["two_factor"] is True
+
+    # The same OTP cannot be replayed on the same attempt
+    replay_response = client.post(
+        app.url_path_for("two_factor_auth"),
+        json={"identifier": login_identifier, "otp_code": login_otp_code},
+    )
+
+    assert replay_response.status_code == 401, replay_response.text
+    assert replay_response.json()["detail"] == "Invalid OTP received"
+
+
+def test_verify_invalid_token(test_db):
+    verify_response = client.get(
+        app.url_path_for("verify"), headers={"Authorization": "Bearer invalid"}
+    )
+    assert verify_response.status_code == 401, verify_response.text
+    assert verify_response.json()["detail"] == "Invalid access token"
+
+    verify_response = client.get(app.url_path_for("verify"))
+    assert verify_response.status_code == 401, verify_response.text
+
+
+def test_login_rate_limited_per_email(test_db, monkeypatch):
+    monkeypatch.setattr("config.RATE_LIMIT_PER_EMAIL", 2)
+
+    for _ in range(2):
+        response = client.post(
+            app.url_path_for("login"),
+            json={"email": "walterwhite@gmail.com", "password": "SayMyName"},
+        )
+        assert response.status_code == 401, response.text
+
+    # The email is normalized, and the limit applies before any DB access
+    async def get_user_by_email(*args, **kwargs):
+        raise AssertionError("The user should not be looked up")
+
+    monkeypatch.setattr("sql.crud.get_user_by_email", get_user_by_email)
+    response = client.post(
+        app.url_path_for("login"),
+        json={"email": " WalterWhite@gmail.com", "password": "SayMyName"},
+    )
+    assert response.status_code == 429, response.text
+    assert int(response.headers["Retry-After"]) > 0
+
+    monkeypatch.undo()
+    response = client.post(
+        app.url_path_for("login"),
+        json={"email": "jessepinkman@gmail.com", "password": "SayMyName"},
+    )
+    assert response.status_code == 401, response.text
+
+
+def test_two_factor_rate_limited_per_identifier(test_db, monkeypatch):
+    monkeypatch.setattr("config.RATE_LIMIT_PER_IDENTIFIER", 1)
+
+    response = client.post(
+        app.url_path_for("two_factor_auth"),
+        json={"identifier": "1372c333fd8c3e54abd528a56208cb40", "otp_code": "000000"},
+    )
+    assert response.status_code == 401, response.text
+
+    response = client.post(
+        app.url_path_for("two_factor_auth"),
+        json={"identifier": "1372c333fd8c3e54abd528a56208cb40", "otp_code": "000001"},
+    )
+    assert response.status_code == 429, response.text
+
+
+def test_login_rehashes_password_with_other_cost(test_db):
+    db = test_db.SessionLocal()
+    db.add(
+        models.User(
+            email="walterwhite@gmail.com",
+            hashed_password=bcrypt.using(rounds=4).hash("SayMyName"),
+            two_factor_enabled=False,
+        )
+    )
+    db.commit()
+
+    response = client.post(
+        app.url_path_for("login"),
+        json={"email": "walterwhite@gmail.com", "password": "SayMyName"},
+    )
+    assert response.status_code == 200, response.text
+
+    db_user = db.query(models.User).filter_by(email="walterwhite@gmail.com").one()
+    assert hash_cost(db_user.hashed_password) == config.AUTH_BCRYPT_ROUNDS
+    db.close()
+
+    # Later logins use the new hash
+    response = client.post(
+        app.url_path_for("login"),
+        json={"email": "walterwhite@gmail.com", "password": "SayMyName"},
+    )
+    assert response.status_code == 200, response.text
@@ -0,0 +1,45 @@
+import re
+
+import metrics
+from main import app
+from tests.test_main import client, test_db  # noqa: F401
+
+
+def test_metrics_endpoint(test_db):
+    # The tests use their own engines, instead of the application ones
+    metrics.count_queries(test_db.engine)
+    metrics.count_queries(test_db.async_engine.sync_engine)
+
+    client.post(
+        app.url_path_for("signup"),
+        json={
+            "email": "walterwhite@gmail.com",
+            "password": "SayMyName",
+            "two_factor_enabled": False,
+        },
+    )
+    client.post(
+        app.url_path_for("login"),
+        json={"email": "walterwhite@gmail.com", "password": "SayMyName"},
+    )
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200, response.text
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert (
+        'http_request_duration_seconds_count{endpoint="login",method="POST",status="200"}'
+        in body
+    )
+    for stage in (
+        "verify_password",
+        "hash_password",
+        "crud.get_user_by_email",
+        "crud.create_user",
+        "attempt_store.create",
+        "issue_access_token",
+    ):
+        assert f'auth_stage_duration_seconds_count{{stage="{stage}"}}' in body
+    queries = re.search(r'db_queries_per_request_sum\{endpoint="signup"\} (\S+)', body)
+    assert float(queries.group(1)) > 0
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, inspect
+
+from sql.database import Base
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def alembic_config(url):
+    alembic_cfg = Config(os.path.join(ROOT, "alembic.ini"))
+    alembic_cfg.set_main_option("script_location", os.path.join(ROOT, "migrations"))
+    alembic_cfg.set_main_option("sqlalchemy.url", url)
+    return alembic_cfg
+
+
+def test_migrations_match_models(tmp_path):
+    url = f"sqlite:///{tmp_path / 'migrations.db'}"
+    alembic_cfg = alembic_config(url)
+    engine = create_engine(url)
+
+    command.upgrade(alembic_cfg, "head")
+    with engine.connect() as conn:
+        assert compare_metadata(MigrationContext.configure(conn), Base.metadata) == []
+
+    command.downgrade(alembic_cfg, "base")
+    assert inspect(engine).get_table_names() == ["alembic_version"]
+
+
+def test_import_does_no_ddl(tmp_path):
+    path = tmp_path / "import.db"
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}", PYTHONPATH=ROOT)
+
+    subprocess.run(
+        [sys.executable, "-c", "import main"], cwd=str(tmp_path), env=env, check=True
+    )
+
+    # The database is not even connected to, which would create the file
+    assert not path.exists()
@@ -0,0 +1,68 @@
+import pyotp
+
+from auth.otp import TOTPEngine
+
+SECRET = "JBSWY3DPEHPK3PXP"
+
+
+def test_codes_match_pyotp():
+    engine = TOTPEngine(step=30, valid_window=1, future_steps=1)
+    totp = pyotp.TOTP(SECRET, interval=30)
+
+    for now in (0, 59, 1656940141, 2**32 + 7):
+        assert engine.generate(SECRET, now=now) == totp.at(now)
+    # Unpadded and lower case secrets are decoded like pyotp does
+    assert engine.generate("jbswy3dpehpk3pxpab", now=1000) == pyotp.TOTP(
+        "JBSWY3DPEHPK3PXPAB", interval=30
+    ).at(1000)
+
+
+def test_valid_window():
+    engine = TOTPEngine(step=30, valid_window=1, future_steps=1)
+    code = engine.generate(SECRET, now=1000)
+
+    assert engine.verify(SECRET, code, now=1000 - 30)
+    assert engine.verify(SECRET, code, now=1000 + 30)
+    assert not engine.verify(SECRET, code, now=1000 + 60)
+    assert not engine.verify(SECRET, "", now=1000)
+    assert not engine.verify(SECRET, "12345a", now=1000)
+
+    assert not TOTPEngine(step=30, valid_window=0, future_steps=0).verify(
+        SECRET, code, now=1000 + 30
+    )
+
+
+def test_window_covers_the_past_attempt_lifetime_and_one_future_step():
+    engine = TOTPEngine(step=30, valid_window=10, future_steps=1)
+    code = engine.generate(SECRET, now=990)
+
+    # Generated at the start of the attempt, checked at its end
+    assert engine.verify(SECRET, code, now=990 + 300)
+    assert not engine.verify(SECRET, code, now=990 + 330)
+    # Codes of the future are only accepted for a step of clock drift
+    assert engine.verify(SECRET, code, now=990 - 30)
+    assert not engine.verify(SECRET, code, now=990 - 60)
+
+
+def test_replay_cache():
+    engine = TOTPEngine(step=30, valid_window=1, future_steps=1, replay_cache_size=2)
+    code = engine.generate(SECRET, now=1000)
+
+    assert engine.verify(SECRET, code, user_id=1, now=1000)
+    # Rejected for the same user, even later in the window
+    assert not engine.verify(SECRET, code, user_id=1, now=1020)
+    assert engine.verify(SECRET, code, user_id=2, now=1000)
+
+    # Expired entries are forgotten, and the cache is bounded
+    engine.verify(SECRET, engine.generate(SECRET, now=2000), user_id=1, now=2000)
+    assert list(engine._replays) == [(1, 2000 // 30)]
+
+
+def test_key_cache_is_bounded():
+    engine = TOTPEngine(step=30, valid_window=1, future_steps=1, key_cache_size=1)
+    other = pyotp.random_base32()
+
+    engine.generate(SECRET, now=1000)
+    engine.generate(other, now=1000)
+    assert list(engine._keys) == [other]
+    assert engine.generate(SECRET, now=1000) == pyotp.TOTP(SECRET).at(1000)
@@ -0,0 +1,48 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+import config
+from main import app
+from sql.pool_stats import TimedQueuePool, instrument_engine
+
+client = TestClient(app)
+
+
+def test_pool_stats_collects_checkouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        poolclass=TimedQueuePool,
+        pool_size=2,
+        max_overflow=1,
+    )
+    stats = instrument_engine(engine, "test")
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        snapshot = stats.snapshot()
+        assert snapshot["checked_out"] == 1
+
+    snapshot = stats.snapshot()
+    assert snapshot["connects"] == 1
+    assert snapshot["checkouts"] == 1
+    assert snapshot["checkins"] == 1
+    assert snapshot["checked_out"] == 0
+    assert snapshot["checkout_wait"]["count"] == 1
+
+    # Stats survive the pool being recreated
+    engine.dispose()
+    with engine.connect():
+        pass
+    assert stats.snapshot()["checkout_wait"]["count"] == 2
+
+
+def test_pool_endpoint_requires_token(monkeypatch):
+    monkeypatch.setattr(config, "INTERNAL_API_TOKEN", "")
+    assert client.get("/internal/pool").status_code == 404
+
+    monkeypatch.setattr(config, "INTERNAL_API_TOKEN", "s3cret")
+    assert client.get("/internal/pool").status_code == 403
+
+    response = client.get("/internal/pool", headers={"X-Internal-Token": "s3cret"})
+    assert response.status_code == 200, response.text
+    assert {"sync", "async"} <= set(response.json())
@@ -0,0 +1,99 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import config
+import profiling
+from auth.rate_limit import get_rate_limiter
+from main import app, get_db
+from profiling import ProfileStore, ProfilingMiddleware, make_token, verify_token
+from sql.database import db_close
+from sql.user_cache import user_cache
+
+KEY = "profiling-key"
+
+
+@pytest.fixture()
+def store(database, tmp_path, monkeypatch):
+    profiling.record_queries(database.engine)
+
+    async def get_testing_db():
+        db = database.SessionLocal()
+        try:
+            yield db
+        finally:
+            await db_close(db)
+
+    store = ProfileStore(str(tmp_path / "profiles"), max_files=2)
+    monkeypatch.setattr(profiling, "_profile_store", store)
+    app.dependency_overrides[get_db] = get_testing_db
+    yield store
+    user_cache.clear()
+    get_rate_limiter().clear()
+    app.dependency_overrides.pop(get_db, None)
+
+
+def signup(client, email, headers=None):
+    user = {"email": email, "password": "password", "two_factor_enabled": False}
+    return client.post("/auth/signup/", json=user, headers=headers or {})
+
+
+def test_tokens_expire_and_are_signed():
+    token = make_token(KEY, ttl=60, now=1000)
+    assert verify_token(KEY, token, now=1059)
+    assert not verify_token(KEY, token, now=1061)
+    assert not verify_token("other-key", token, now=1000)
+    assert not verify_token("", token, now=1000)
+    assert not verify_token(KEY, "garbage", now=1000)
+    assert not verify_token(KEY, f"2000.{token.split('.')[1]}", now=1000)
+
+
+def test_only_requests_with_a_valid_token_are_profiled(store):
+    client = TestClient(ProfilingMiddleware(app, sample_rate=0, key=KEY, store=store))
+
+    response = signup(client, "walterwhite@gmail.com")
+    assert response.status_code == 200
+    assert "x-profile-id" not in response.headers
+
+    response = signup(client, "jessepinkman@gmail.com", {"X-Profile-Token": "1.bad"})
+    assert "x-profile-id" not in response.headers
+    assert store.ids() == []
+
+    headers = {"X-Profile-Token": make_token(KEY)}
+    response = signup(client, "skylerwhite@gmail.com", headers)
+    assert response.status_code == 200
+    profile = store.get(response.headers["x-profile-id"])
+
+    assert profile["path"] == "/auth/signup/"
+    assert profile["trigger"] == "token"
+    assert profile["status"] == 200
+    statements = [query["statement"] for query in profile["sql"]["statements"]]
+    assert any("INSERT INTO users" in statement for statement in statements)
+    # Statements are recorded without their parameters
+    assert "skylerwhite" not in str(profile["sql"])
+    assert "hash_password" in profile["stages"]["totals"]
+    assert profile["functions"]
+
+
+def test_sampled_profiles_are_kept_in_a_ring(store, monkeypatch):
+    client = TestClient(ProfilingMiddleware(app, sample_rate=1, key="", store=store))
+
+    ids = [
+        signup(client, f"user{i}@gmail.com").headers["x-profile-id"] for i in range(3)
+    ]
+    assert store.ids() == ids[1:]
+
+    monkeypatch.setattr(config, "INTERNAL_API_TOKEN", "s3cret")
+    headers = {"X-Internal-Token": "s3cret"}
+    summaries = client.get("/internal/profiles", headers=headers).json()
+    assert [summary["id"] for summary in summaries] == ids[:0:-1]
+    assert summaries[0]["trigger"] == "sample"
+
+    response = client.get(f"/internal/profiles/{ids[2]}", headers=headers)
+    assert response.json()["id"] == ids[2]
+    assert (
+        client.get(f"/internal/profiles/{ids[0]}", headers=headers).status_code == 404
+    )
+    assert (
+        client.get("/internal/profiles/..%2Fsecrets", headers=headers).status_code
+        == 404
+    )
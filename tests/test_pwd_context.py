@@ -0,0 +1,60 @@
+import asyncio
+
+from passlib.hash import bcrypt
+
+import config
+from auth.pwd.calibrate import calibrate
+from auth.pwd.pwd_context import (
+    hash_cost,
+    hash_password_async,
+    shutdown_hash_pool,
+    verify_and_update_password,
+    verify_password,
+    verify_password_async,
+)
+
+
+def test_hash_and_verify_in_hash_pool():
+    async def roundtrip():
+        hashed = await hash_password_async("SayMyName")
+        return (
+            hashed,
+            await verify_password_async("SayMyName", hashed),
+            await verify_password_async("test", hashed),
+        )
+
+    try:
+        hashed, correct, wrong = asyncio.run(roundtrip())
+    finally:
+        shutdown_hash_pool()
+
+    assert hashed != "SayMyName"
+    assert verify_password("SayMyName", hashed)
+    assert correct is True
+    assert wrong is False
+
+
+def test_verify_and_update_rehashes_other_costs():
+    old_hash = bcrypt.using(rounds=4).hash("SayMyName")
+    assert hash_cost(old_hash) == 4
+
+    verified, new_hash = verify_and_update_password("SayMyName", old_hash)
+    assert verified is True
+    assert hash_cost(new_hash) == config.AUTH_BCRYPT_ROUNDS
+    assert verify_and_update_password("SayMyName", new_hash) == (True, None)
+
+    assert verify_and_update_password("test", old_hash) == (False, None)
+
+
+def test_calibrate():
+    # Doubling with each cost, 1ms with the lowest one
+    rounds, timings = calibrate(
+        0.05, min_rounds=4, measure=lambda rounds: 0.001 * 2 ** (rounds - 4)
+    )
+    assert rounds == 9
+    assert list(timings) == [4, 5, 6, 7, 8, 9, 10]
+
+    rounds, _ = calibrate(
+        0.05, min_rounds=10, measure=lambda rounds: 0.001 * 2 ** (rounds - 4)
+    )
+    assert rounds == 10
@@ -0,0 +1,117 @@
+import asyncio
+import ipaddress
+
+import pytest
+from fakeredis.aioredis import FakeRedis
+from fastapi import HTTPException
+from prometheus_client import REGISTRY
+from starlette.requests import Request
+
+import config
+from auth import rate_limit
+from auth.rate_limit import (
+    MemoryRateLimiter,
+    RateLimiter,
+    RateLimiterUnavailable,
+    RedisRateLimiter,
+    client_ip,
+)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def limiter(request):
+    return {
+        "memory": lambda: MemoryRateLimiter(window=60),
+        "redis": lambda: RedisRateLimiter(window=60, client=FakeRedis()),
+    }[request.param]()
+
+
+def hits(limiter, limits, now, count=1):
+    async def run():
+        return [await limiter.hit(limits, now=now) for _ in range(count)]
+
+    return asyncio.run(run())
+
+
+def test_limit_per_key(limiter):
+    assert hits(limiter, {"email:a": 3}, now=6000, count=3) == [0, 0, 0]
+
+    # Rejected hits count too: the 4 hits must slide to 2, halfway through the next window
+    (retry_after,) = hits(limiter, {"email:a": 3}, now=6010)
+    assert retry_after == 50 + 30
+
+    # Other keys have their own counters, but a request is rejected if any key is over
+    assert hits(limiter, {"email:b": 3}, now=6010) == [0]
+    assert hits(limiter, {"email:b": 3, "email:a": 3}, now=6010)[0] > 0
+
+
+def test_sliding_window(limiter):
+    hits(limiter, {"ip:1": 4}, now=6000, count=4)
+
+    # Halfway through the next window, half of the previous hits still count
+    assert hits(limiter, {"ip:1": 4}, now=6090, count=2) == [0, 0]
+    (retry_after,) = hits(limiter, {"ip:1": 4}, now=6090)
+    assert retry_after > 0
+
+    # Two windows later, previous hits are forgotten
+    assert hits(limiter, {"ip:1": 4}, now=6240, count=4) == [0, 0, 0, 0]
+
+
+def test_memory_eviction():
+    limiter = MemoryRateLimiter(window=60, max_size=2)
+    hits(limiter, {"a": 1}, now=6000)
+    hits(limiter, {"b": 1}, now=6000)
+    hits(limiter, {"c": 1}, now=6000)
+    assert list(limiter._counters) == ["b", "c"]
+
+    # Stale keys are dropped
+    hits(limiter, {"d": 1}, now=6200)
+    assert list(limiter._counters) == ["d"]
+
+
+def test_incomplete_limiters_cannot_be_created():
+    with pytest.raises(TypeError):
+        type("NoHitLimiter", (RateLimiter,), {})()
+
+
+def test_client_ip_behind_trusted_proxies():
+    proxies = [ipaddress.ip_network("10.0.0.0/8")]
+
+    def request(peer, forwarded=None):
+        headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+        return Request({"type": "http", "client": (peer, 1234), "headers": headers})
+
+    assert client_ip(request("10.0.0.1", "1.2.3.4, 10.0.0.2"), proxies) == "1.2.3.4"
+    # Addresses added by the client itself are ignored
+    assert client_ip(request("10.0.0.1", "6.6.6.6, 1.2.3.4"), proxies) == "1.2.3.4"
+    # Only trusted proxies are believed
+    assert client_ip(request("5.6.7.8", "1.2.3.4"), proxies) == "5.6.7.8"
+    assert client_ip(request("10.0.0.1", "1.2.3.4"), []) == "10.0.0.1"
+    assert client_ip(request("10.0.0.1"), proxies) == "10.0.0.1"
+
+
+@pytest.mark.parametrize("policy", ["open", "closed"])
+def test_unreachable_counters(policy, monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMIT_ON_ERROR", policy)
+    # Every command fails with a ConnectionError, as with Redis down
+    broken = RedisRateLimiter(window=60, client=FakeRedis(connected=False))
+    monkeypatch.setattr(rate_limit, "_rate_limiter", broken)
+
+    with pytest.raises(RateLimiterUnavailable):
+        hits(broken, {"ip:1": 4}, now=6000)
+
+    errors = REGISTRY.get_sample_value(
+        "auth_rate_limit_errors_total", {"scope": "login"}
+    )
+    check = rate_limit.check_rate_limits("login", {"ip:1": 4})
+    if policy == "open":
+        asyncio.run(check)
+    else:
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(check)
+        assert e.value.status_code == 503
+        assert e.value.headers == {"Retry-After": "1"}
+    assert (
+        REGISTRY.get_sample_value("auth_rate_limit_errors_total", {"scope": "login"})
+        == (errors or 0) + 1
+    )
@@ -0,0 +1,47 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import config
+from sql import models, reaper
+
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_delete_expired_attempts_in_batches(database, is_async):
+    now = datetime.utcnow()
+    with database.SessionLocal() as db:
+        user = models.User(email="walterwhite@gmail.com", hashed_password="x")
+        db.add(user)
+        db.add_all(
+            models.LoginAttempt(user=user, expires_at=now - timedelta(seconds=i + 1))
+            for i in range(5)
+        )
+        valid = models.LoginAttempt(user=user, expires_at=now + timedelta(seconds=60))
+        db.add(valid)
+        db.commit()
+        valid_identifier = valid.identifier
+
+    # The sync engine runs in the threadpool
+    engine = database.async_engine if is_async else database.engine
+    assert (
+        asyncio.run(reaper.delete_expired_attempts(engine, now=now, batch_size=2)) == 5
+    )
+
+    with database.SessionLocal() as db:
+        remaining = db.query(models.LoginAttempt).all()
+        assert [attempt.identifier for attempt in remaining] == [valid_identifier]
+        assert remaining[0].is_valid()
+
+
+def test_partition_name():
+    assert (
+        reaper.partition_name(datetime(2022, 7, 4).date()) == "login_attempt_p20220704"
+    )
+
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_default_engine_follows_the_configured_path(is_async, monkeypatch):
+    monkeypatch.setattr(config, "SQLALCHEMY_ASYNC", is_async)
+    assert isinstance(reaper.default_engine(), AsyncEngine) == is_async
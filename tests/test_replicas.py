@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import config
+from main import app
+from sql import crud, models, schemas
+from sql.database import Base, custom_create_engine, db_close, make_async_url
+from sql.replicas import Replica, ReplicaSet
+from sql.shards import RoutingSession, Shard
+from sql.user_cache import user_cache
+
+
+def make_replica(name, url, weight=1):
+    return Replica(
+        name,
+        custom_create_engine(url),
+        create_async_engine(make_async_url(url)),
+        weight=weight,
+    )
+
+
+def session_factory(primary, is_async, replicas):
+    shards = [Shard("shard0", primary.engine, primary.async_engine, replicas)]
+    if is_async:
+        return sessionmaker(
+            autoflush=False,
+            expire_on_commit=False,
+            bind=primary.async_engine,
+            class_=AsyncSession,
+            sync_session_class=RoutingSession,
+            shards=shards,
+            is_async=True,
+        )
+    return sessionmaker(
+        autoflush=False,
+        expire_on_commit=False,
+        bind=primary.engine,
+        class_=RoutingSession,
+        shards=shards,
+    )
+
+
+def add_user(engine, email):
+    with engine.begin() as conn:
+        conn.execute(
+            insert(models.User).values(
+                email=email,
+                hashed_password="hash",
+                two_factor_enabled=False,
+                secret="SECRET",
+            )
+        )
+
+
+@pytest.fixture(params=["async", "sync"])
+def routed(request, database, tmp_path):
+    replica = make_replica("replica0", f"sqlite:///{tmp_path / 'replica.db'}")
+    replicas = ReplicaSet([replica], max_lag=5)
+    Base.metadata.create_all(bind=replica.engine)
+
+    yield replicas, session_factory(database, request.param == "async", replicas)
+
+    user_cache.clear()
+    asyncio.run(replicas.dispose())
+
+
+def run(coroutine_function, factory):
+    async def with_session():
+        db = factory()
+        try:
+            return await coroutine_function(db)
+        finally:
+            await db_close(db)
+
+    return asyncio.run(with_session())
+
+
+def test_reads_go_to_replica(routed):
+    replicas, factory = routed
+    add_user(replicas.replicas[0].engine, "replica@example.com")
+
+    user = run(lambda db: crud.get_user_by_email(db, "replica@example.com"), factory)
+    assert user.email == "replica@example.com"
+    assert replicas.replicas[0].reads == 1
+
+
+def test_replica_miss_is_confirmed_on_primary(routed, database):
+    replicas, factory = routed
+    # Signed up on the primary, not replicated yet
+    add_user(database.engine, "new@example.com")
+
+    user = run(lambda db: crud.get_user_by_email(db, "new@example.com"), factory)
+    assert user.email == "new@example.com"
+    assert replicas.replicas[0].reads == 1
+
+
+def test_reads_after_write_stick_to_primary(routed):
+    replicas, factory = routed
+    user = schemas.UserCreate(
+        email="user@example.com", password="password", two_factor_enabled=False
+    )
+
+    async def signup_then_read(db):
+        db_user = await crud.create_user(db, user, "hash", commit=False)
+        user_cache.clear()
+        return db_user, await crud.get_user(db, db_user.id)
+
+    db_user, read_back = run(signup_then_read, factory)
+    assert read_back.email == db_user.email
+    assert replicas.replicas[0].reads == 0
+
+
+def test_unhealthy_replica_receives_no_reads(routed, database, tmp_path):
+    replicas, factory = routed
+    down = make_replica(
+        "replica1", f"sqlite:///{tmp_path / 'missing' / 'replica.db'}", weight=1000
+    )
+    replicas.replicas.append(down)
+
+    asyncio.run(replicas.check_all(is_async=True))
+    assert replicas.replicas[0].healthy
+    assert not down.healthy
+    assert down.last_error
+
+    for _ in range(10):
+        assert replicas.choose() is replicas.replicas[0]
+
+    # Without any healthy replica, reads go to the primary
+    replicas.replicas[0].mark_down("stopped")
+    add_user(database.engine, "user@example.com")
+    user = run(lambda db: crud.get_user_by_email(db, "user@example.com"), factory)
+    assert user.email == "user@example.com"
+    assert replicas.replicas[0].reads == 10
+
+
+def test_choose_follows_weights(tmp_path):
+    url = f"sqlite:///{tmp_path / 'replica.db'}"
+    replicas = ReplicaSet(
+        [
+            make_replica("heavy", url, weight=1),
+            make_replica("unused", url, weight=0),
+        ]
+    )
+    assert all(replicas.choose().name == "heavy" for _ in range(100))
+    assert replicas.stats()["heavy"]["reads"] == 100
+    assert replicas.stats()["unused"]["reads"] == 0
+
+
+def test_replicas_endpoint(monkeypatch):
+    monkeypatch.setattr(config, "INTERNAL_API_TOKEN", "s3cret")
+    client = TestClient(app)
+
+    response = client.get("/internal/replicas", headers={"X-Internal-Token": "s3cret"})
+    assert response.status_code == 200, response.text
+    # No replica configured
+    assert response.json() == {}
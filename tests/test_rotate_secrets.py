@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+
+from auth.rotate_secrets import RotationState, rotate_secrets
+from sql import models
+
+
+def add_users(database, secrets):
+    db = database.SessionLocal()
+    for i, secret in enumerate(secrets):
+        db.add(
+            models.User(email=f"user{i}@gmail.com", hashed_password="x", secret=secret)
+        )
+    db.commit()
+    db.close()
+
+
+def get_users(database):
+    db = database.SessionLocal()
+    try:
+        return db.query(models.User).order_by(models.User.id).all()
+    finally:
+        db.close()
+
+
+def get_secrets(database):
+    return [user.secret for user in get_users(database)]
+
+
+def run_rotation(database, state, batch_size, batches=None):
+    async def run():
+        progress = []
+        async for report in rotate_secrets(
+            state, batch_size, db_factory=database.AsyncSessionLocal
+        ):
+            progress.append(report)
+            if len(progress) == batches:
+                break
+        return progress
+
+    return asyncio.run(run())
+
+
+def test_secrets_are_generated_per_user(database):
+    db = database.SessionLocal()
+    db.add_all(
+        [
+            models.User(email="walterwhite@gmail.com", hashed_password="x"),
+            models.User(email="jessepinkman@gmail.com", hashed_password="x"),
+        ]
+    )
+    db.commit()
+    db.close()
+
+    first, second = get_secrets(database)
+    assert first != second
+
+
+def test_rotate_shared_secrets_resumable(database, tmp_path):
+    shared = ["A" * 32, "B" * 32]
+    add_users(
+        database, [shared[0], "C" * 32, shared[0], shared[1], shared[0], shared[1]]
+    )
+    path = str(tmp_path / "state.json")
+
+    # Interrupted after the first batch
+    progress = run_rotation(database, RotationState.load(path), batch_size=2, batches=1)
+    assert progress[0]["rotated"] == 2
+    assert progress[0]["total"] == 5
+    saved = json.loads(open(path).read())
+    assert sorted(saved["secrets"]) == shared
+    # Users are ordered by id, generated in insertion order
+    assert saved["last_id"] == get_users(database)[2].id
+
+    # The remaining users sharing the first secret are rotated too on resume,
+    # although the secret is not shared by several users anymore
+    progress = run_rotation(database, RotationState.load(path), batch_size=2)
+    assert [report["rotated"] for report in progress] == [4, 5]
+
+    secrets = get_secrets(database)
+    assert secrets[1] == "C" * 32
+    assert len(set(secrets)) == len(secrets)
+    assert not set(secrets) & set(shared)
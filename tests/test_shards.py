@@ -0,0 +1,310 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from auth.otp import totp_engine
+from auth.rate_limit import get_rate_limiter
+from main import app, get_db
+from sql import crud, models, schemas
+from sql.database import Base, custom_create_engine, db_close, db_commit, make_async_url
+from sql.rebalance import rebalance
+from sql.replicas import Replica, ReplicaSet
+from sql.shards import RoutingSession, Shard, jump_hash, shard_for_email
+from sql.user_cache import user_cache
+
+EMAILS = [f"user{i}@example.com" for i in range(40)]
+
+
+def make_shards(count):
+    shards = []
+    for i in range(count):
+        url = f"sqlite:///./test_shard{i}.db"
+        shards.append(
+            Shard(
+                f"shard{i}",
+                custom_create_engine(url),
+                create_async_engine(make_async_url(url)),
+            )
+        )
+        Base.metadata.create_all(bind=shards[-1].engine)
+    return shards
+
+
+def session_factory(shards, is_async):
+    if is_async:
+        return sessionmaker(
+            autoflush=False,
+            expire_on_commit=False,
+            bind=shards[0].async_engine,
+            class_=AsyncSession,
+            sync_session_class=RoutingSession,
+            shards=shards,
+            is_async=True,
+        )
+    return sessionmaker(
+        autoflush=False,
+        expire_on_commit=False,
+        bind=shards[0].engine,
+        class_=RoutingSession,
+        shards=shards,
+    )
+
+
+def cleanup(shards):
+    for shard in shards:
+        asyncio.run(shard.dispose())
+        os.remove(f"./{shard.name.replace('shard', 'test_shard')}.db")
+    user_cache.clear()
+    totp_engine.clear()
+
+
+@pytest.fixture(params=["async", "sync"])
+def sharded(request):
+    shards = make_shards(3)
+    yield shards, session_factory(shards, request.param == "async")
+    cleanup(shards)
+
+
+def run(coroutine_function, factory):
+    async def with_session():
+        db = factory()
+        try:
+            return await coroutine_function(db)
+        finally:
+            await db_close(db)
+
+    return asyncio.run(with_session())
+
+
+def emails_on(shard):
+    with shard.engine.connect() as conn:
+        return set(conn.execute(select(models.User.email)).scalars())
+
+
+def test_jump_hash_only_moves_keys_to_new_buckets():
+    for key in range(0, 2**64, 2**54 + 12345):
+        for buckets in range(1, 10):
+            before, after = jump_hash(key, buckets), jump_hash(key, buckets + 1)
+            assert 0 <= before < buckets
+            assert after in (before, buckets)
+
+
+def test_shard_for_email_is_stable_and_normalized():
+    shards = [shard_for_email(email, 3) for email in EMAILS]
+    assert set(shards) == {0, 1, 2}
+    assert shard_for_email(" User0@Example.com", 3) == shards[0]
+    assert all(shard_for_email(email, 1) == 0 for email in EMAILS)
+
+
+def test_user_ids_are_unique_and_fit_in_53_bits():
+    ids = [models.make_user_id() for _ in range(1000)]
+    assert len(set(ids)) == len(ids)
+    assert all(0 < user_id < 2**53 for user_id in ids)
+
+    last = models.UserIdGenerator(
+        1023, clock=lambda: 2**31 - 1 + models.USER_ID_EPOCH
+    )
+    assert last() < 2**53
+    with pytest.raises(ValueError):
+        models.UserIdGenerator(1024)
+
+
+def test_user_ids_of_forked_workers_are_disjoint():
+    # Two workers forked from the same parent, generating ids in the same second,
+    # beyond the capacity of the sequence
+    now = time.time()
+    count = 3 * (1 << models.USER_ID_SEQUENCE_BITS)
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        generator = models.UserIdGenerator(1, clock=lambda: now)
+        os.write(writer, json.dumps([generator() for _ in range(count)]).encode())
+        os._exit(0)
+    os.close(writer)
+    generator = models.UserIdGenerator(0, clock=lambda: now)
+    ids = [generator() for _ in range(count)]
+    with os.fdopen(reader) as child:
+        child_ids = json.load(child)
+    os.waitpid(pid, 0)
+
+    assert len(set(ids)) == len(set(child_ids)) == count
+    assert not set(ids) & set(child_ids)
+    # Increasing, as the exhausted sequence borrows the next seconds
+    assert ids == sorted(ids)
+
+
+def test_reads_go_to_the_replicas_of_the_shard(sharded):
+    shards, factory = sharded
+    url = "sqlite:///./test_shard1_replica.db"
+    replica = Replica(
+        "shard1-replica0",
+        custom_create_engine(url),
+        create_async_engine(make_async_url(url)),
+    )
+    Base.metadata.create_all(bind=replica.engine)
+    shards[1].replicas = ReplicaSet([replica])
+    email = next(email for email in EMAILS if shard_for_email(email, 3) == 1)
+    # Only on the replica, to tell where the read went
+    with replica.engine.begin() as conn:
+        conn.execute(
+            insert(models.User).values(
+                email=email, hashed_password="hash", secret="SECRET"
+            )
+        )
+
+    try:
+        user = run(lambda db: crud.get_user_by_email(db, email), factory)
+        assert user.email == email
+        assert replica.reads == 1
+        # Users of the other shards are read from their primary
+        assert run(lambda db: crud.get_user_by_email(db, EMAILS[0]), factory) is None
+        assert replica.reads == 1
+    finally:
+        os.remove("./test_shard1_replica.db")
+
+
+def test_users_and_attempts_live_on_the_shard_of_their_email(sharded):
+    shards, factory = sharded
+
+    async def signup_all(db):
+        records = []
+        for email in EMAILS:
+            user = schemas.UserCreate(
+                email=email, password="password", two_factor_enabled=True
+            )
+            db_user = await crud.create_user(db, user, "$2b$04$hash", commit=False)
+            identifier = await crud.create_login_attempt(db, db_user, commit=False)
+            records.append((db_user, identifier))
+        await db_commit(db)
+        return records
+
+    records = run(signup_all, factory)
+    for i, shard in enumerate(shards):
+        assert emails_on(shard) == {
+            email for email in EMAILS if shard_for_email(email, 3) == i
+        }
+
+    user_cache.clear()
+    db_user, identifier = records[0]
+    shard = shard_for_email(db_user.email, 3)
+    assert identifier.startswith(f"{shard:02x}")
+
+    async def read_back(db):
+        attempt = await crud.consume_login_attempt(db, identifier)
+        await db_commit(db)
+        return (
+            await crud.get_user_by_email(db, db_user.email),
+            await crud.get_user(db, records[-1][0].id),
+            attempt,
+            await crud.consume_login_attempt(db, "ff" + identifier[2:]),
+            await crud.get_registered_emails(db, EMAILS[:10] + ["new@example.com"]),
+            await crud.count_users_by_hash_cost(db),
+        )
+
+    by_email, by_id, attempt, unknown_shard, registered, by_cost = run(
+        read_back, factory
+    )
+    assert by_email.id == db_user.id
+    assert by_id.email == records[-1][0].email
+    assert attempt.user_id == db_user.id
+    assert attempt.secret == db_user.secret
+    assert unknown_shard is None
+    assert registered == set(EMAILS[:10])
+    assert by_cost == {"04": len(EMAILS)}
+
+
+def test_auth_flow_on_shards(sharded):
+    shards, factory = sharded
+
+    async def get_sharded_db():
+        db = factory()
+        try:
+            yield db
+        finally:
+            await db_close(db)
+
+    app.dependency_overrides[get_db] = get_sharded_db
+    client = TestClient(app)
+    try:
+        for email in EMAILS[:6]:
+            user = {"email": email, "password": "password", "two_factor_enabled": True}
+            assert client.post("/auth/signup/", json=user).status_code == 200
+
+            response = client.post("/auth/login/", json=user)
+            assert response.status_code == 200, response.text
+            data = response.json()
+
+            response = client.post(
+                "/auth/two_factor/",
+                json={
+                    "identifier": data["login_identifier"],
+                    "otp_code": data["otp_code"],
+                },
+            )
+            assert response.status_code == 200, response.text
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        get_rate_limiter().clear()
+
+    assert set().union(*(emails_on(shard) for shard in shards)) == set(EMAILS[:6])
+
+
+def test_rebalance_moves_users_to_added_shards():
+    shards = make_shards(3)
+    try:
+        # Users placed while there were only two shards, each with a pending attempt
+        for email in EMAILS:
+            shard = shards[shard_for_email(email, 2)]
+            with shard.engine.begin() as conn:
+                user_id = models.make_user_id()
+                conn.execute(
+                    insert(models.User).values(
+                        id=user_id, email=email, hashed_password="x", secret="S"
+                    )
+                )
+                conn.execute(
+                    insert(models.LoginAttempt).values(
+                        identifier=models.make_identifier(),
+                        user_id=user_id,
+                        expires_at=models.make_expiry(),
+                    )
+                )
+
+        progress = list(rebalance(shards, batch_size=7, dry_run=True))
+        assert emails_on(shards[2]) == set()
+        expected_moves = sum(
+            1
+            for email in EMAILS
+            if shard_for_email(email, 3) != shard_for_email(email, 2)
+        )
+        moved = {}
+        for report in progress:
+            moved[report["shard"]] = sum(report["moved"].values())
+        assert sum(moved.values()) == expected_moves > 0
+
+        list(rebalance(shards, batch_size=7))
+        for i, shard in enumerate(shards):
+            assert emails_on(shard) == {
+                email for email in EMAILS if shard_for_email(email, 3) == i
+            }
+
+        # Attempts of the moved users were dropped, the others kept
+        attempts = 0
+        for shard in shards:
+            with shard.engine.connect() as conn:
+                attempts += conn.execute(
+                    select(func.count(models.LoginAttempt.id))
+                ).scalar()
+        assert attempts == len(EMAILS) - expected_moves
+
+        # Nothing left to move
+        assert all(not report["moved"] for report in rebalance(shards, batch_size=7))
+    finally:
+        cleanup(shards)
@@ -0,0 +1,61 @@
+import pytest
+
+from auth.tokens import (
+    PASSWORD_ONLY,
+    TWO_FACTOR,
+    InvalidToken,
+    TokenSigner,
+    TokenVerifier,
+    parse_keys,
+)
+
+
+def test_issue_and_verify():
+    signer = TokenSigner({"k1": b"secret"}, ttl=60)
+    token = signer.issue(42, TWO_FACTOR, now=1000)
+
+    claims = TokenVerifier({"k1": b"secret"}).verify(token, now=1059)
+    assert claims.as_dict() == {
+        "user_id": 42,
+        "issued_at": 1000,
+        "expires_at": 1060,
+        "two_factor": True,
+    }
+
+    with pytest.raises(InvalidToken, match="Expired"):
+        signer.verify(token, now=1060)
+
+
+def test_tampered_tokens_are_rejected():
+    signer = TokenSigner({"k1": b"secret"}, ttl=60)
+    kid, payload, signature = signer.issue(42, PASSWORD_ONLY, now=1000).split(".")
+    other_payload = signer.issue(43, TWO_FACTOR, now=1000).split(".")[1]
+
+    for token in (
+        f"{kid}.{other_payload}.{signature}",
+        f"{kid}.{payload}.{signature[:-2]}",
+        f"other.{payload}.{signature}",
+        f"{kid}.{payload}",
+        "",
+        f"{kid}.{payload}.{signature}é",
+    ):
+        with pytest.raises(InvalidToken):
+            signer.verify(token, now=1000)
+
+    with pytest.raises(InvalidToken):
+        TokenVerifier({"k1": b"other secret"}).verify(
+            f"{kid}.{payload}.{signature}", now=1000
+        )
+
+
+def test_key_rotation():
+    old_signer = TokenSigner(parse_keys("old:secret1"), ttl=60)
+    new_signer = TokenSigner(parse_keys("new:secret2,old:secret1"), ttl=60)
+
+    old_token = old_signer.issue(1, PASSWORD_ONLY, now=1000)
+    new_token = new_signer.issue(1, PASSWORD_ONLY, now=1000)
+
+    assert new_token.startswith("new.")
+    assert new_signer.verify(old_token, now=1000).user_id == 1
+    with pytest.raises(InvalidToken, match="Unknown key"):
+        old_signer.verify(new_token, now=1000)
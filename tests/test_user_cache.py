@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+
+import config
+from sql import user_cache as user_cache_module
+from sql.user_cache import MISSING, UserCache, UserRecord
+
+
+def make_record(email):
+    return UserRecord(1, email, "hash", False, "JBSWY3DPEHPK3PXP")
+
+
+def test_lru_eviction_and_stats():
+    cache = UserCache(max_size=2, ttl=60, negative_ttl=60)
+    cache.set("a@b.com", make_record("a@b.com"))
+    cache.set("c@d.com", None)
+
+    # Touch the first entry, so that the negative one is the least recently used
+    assert cache.get("a@b.com").email == "a@b.com"
+    cache.set("e@f.com", make_record("e@f.com"))
+
+    assert cache.get("c@d.com") is MISSING
+    assert cache.get("e@f.com") is not MISSING
+
+    stats = cache.stats()
+    assert stats["size"] == 2
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+
+
+def test_negative_entries_expire_sooner():
+    cache = UserCache(max_size=10, ttl=60, negative_ttl=0)
+    cache.set("a@b.com", None)
+    cache.set("c@d.com", make_record("c@d.com"))
+
+    assert cache.get("a@b.com") is MISSING
+    assert cache.get("c@d.com") is not MISSING
+    assert cache.stats()["expirations"] == 1
+
+
+def test_negative_entries_can_be_disabled():
+    cache = UserCache(max_size=10, ttl=60, negative_ttl=60, cache_missing=False)
+    cache.set("a@b.com", None)
+    cache.set("c@d.com", make_record("c@d.com"))
+
+    assert cache.get("a@b.com") is MISSING
+    assert cache.get("c@d.com") is not MISSING
+
+
+def test_invalidations_from_other_workers(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(config, "USER_CACHE_INVALIDATION", "redis")
+    monkeypatch.setattr(
+        user_cache_module, "get_redis", lambda: FakeRedis(server=server)
+    )
+    cache = user_cache_module.user_cache
+
+    async def run():
+        user_cache_module.start_invalidation_listener()
+        # Let the listener subscribe before caching the entry
+        await asyncio.sleep(0.1)
+        cache.set("walterwhite@gmail.com", None)
+
+        message = json.dumps({"email": "walterwhite@gmail.com", "origin": "other"})
+        await FakeRedis(server=server).publish(
+            user_cache_module.INVALIDATION_CHANNEL, message
+        )
+        await asyncio.sleep(0.1)
+        await user_cache_module.stop_invalidation_listener()
+
+    try:
+        asyncio.run(run())
+        assert cache.get("walterwhite@gmail.com") is MISSING
+    finally:
+        cache.clear()